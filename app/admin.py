@@ -8,6 +8,7 @@ from datetime import datetime, timezone
 from aiohttp import web
 
 from app.config import config, persist_env_var
+from app import cache
 from app import database as db
 
 logger = logging.getLogger(__name__)
@@ -691,7 +692,7 @@ async def dashboard(request: web.Request):
                         balance -= txn.amount
                 stars_balance = str(balance)
     except Exception as e:
-        logger.warning(f"Could not fetch Stars balance: {e}")
+        logger.warning("Could not fetch Stars balance: %s", e)
         stars_balance = "N/A"
 
     # Get last restart time
@@ -707,7 +708,7 @@ async def dashboard(request: web.Request):
                 msk_time = start_time + msk_offset
                 last_restart = msk_time.strftime("%d.%m.%Y %H:%M:%S")
     except Exception as e:
-        logger.warning(f"Could not get restart time: {e}")
+        logger.warning("Could not get restart time: %s", e)
 
     # Get last deploy time (from git commit date)
     last_deploy = "—"
@@ -736,7 +737,7 @@ async def dashboard(request: web.Request):
         except Exception:
             pass
     except Exception as e:
-        logger.warning(f"Could not get deploy time: {e}")
+        logger.warning("Could not get deploy time: %s", e)
 
     model = config.suno_model
     model_options = "".join(
@@ -1398,7 +1399,7 @@ async def set_model(request: web.Request):
         # Reset suno client so it picks up any changes
         from app.suno_api import close_suno_client
         await close_suno_client()
-        logger.info(f"Model changed to {new_model} via admin panel")
+        logger.info("Model changed to %s via admin panel", new_model)
     raise web.HTTPFound(f"/admin/?{tp}&success=model_set")
 
 
@@ -1412,7 +1413,7 @@ async def set_free_credits(request: web.Request):
         if 0 <= new_value <= 100:
             config.free_credits_on_signup = new_value
             persist_env_var("FREE_CREDITS_ON_SIGNUP", str(new_value))
-            logger.info(f"Free credits on signup changed to {new_value} via admin panel")
+            logger.info("Free credits on signup changed to %s via admin panel", new_value)
     except (ValueError, TypeError):
         pass
     raise web.HTTPFound(f"/admin/?{tp}&success=credits_set")
@@ -1428,7 +1429,7 @@ async def set_signup_credits(request: web.Request):
         if 0 <= new_value <= 100:
             config.credits_on_signup = new_value
             persist_env_var("CREDITS_ON_SIGNUP", str(new_value))
-            logger.info(f"Paid credits on signup changed to {new_value} via admin panel")
+            logger.info("Paid credits on signup changed to %s via admin panel", new_value)
     except (ValueError, TypeError):
         pass
     raise web.HTTPFound(f"/admin/?{tp}&success=signup_credits_set")
@@ -1444,11 +1445,11 @@ async def credit_user(request: web.Request):
     try:
         amount = int(data.get("amount", 0))
         if 1 <= amount <= 1000:
-            await db.update_user_credits(telegram_id, amount)
-            await db.log_balance_transaction(
+            await db.charge_and_log(
                 telegram_id, amount, 'admin', 'Начисление администратором',
             )
-            logger.info(f"Admin credited {amount} to user {telegram_id}")
+            cache.invalidate_user(telegram_id)
+            logger.info("Admin credited %s to user %s", amount, telegram_id)
             # Notify user in bot
             get_bot = request.app.get("get_bot")
             if get_bot:
@@ -1467,9 +1468,9 @@ async def credit_user(request: web.Request):
                         err = str(e).lower()
                         if any(kw in err for kw in ("blocked", "deactivated", "not found")):
                             await db.mark_user_blocked(telegram_id)
-                            logger.info(f"User {telegram_id} blocked the bot (detected on admin credit)")
+                            logger.info("User %s blocked the bot (detected on admin credit)", telegram_id)
                         else:
-                            logger.warning(f"Failed to notify user {telegram_id} about admin credit: {e}")
+                            logger.warning("Failed to notify user %s about admin credit: %s", telegram_id, e)
     except (ValueError, TypeError):
         amount = 0
     raise web.HTTPFound(f"/admin/user/{telegram_id}?{tp}&success=credited&amount={amount}")
@@ -1485,10 +1486,11 @@ async def credit_user_free(request: web.Request):
         amount = int(data.get("amount", 0))
         if 1 <= amount <= 100:
             await db.update_free_credits(telegram_id, amount)
-            await db.log_balance_transaction(
+            cache.invalidate_user(telegram_id)
+            db.balance_log.put_nowait(
                 telegram_id, amount, 'admin', 'Бесплатные кредиты (превью) от админа',
             )
-            logger.info(f"Admin gave {amount} free credits to user {telegram_id}")
+            logger.info("Admin gave %s free credits to user %s", amount, telegram_id)
             # Notify user in bot
             get_bot = request.app.get("get_bot")
             if get_bot:
@@ -1507,9 +1509,9 @@ async def credit_user_free(request: web.Request):
                         err = str(e).lower()
                         if any(kw in err for kw in ("blocked", "deactivated", "not found")):
                             await db.mark_user_blocked(telegram_id)
-                            logger.info(f"User {telegram_id} blocked the bot (detected on admin free credit)")
+                            logger.info("User %s blocked the bot (detected on admin free credit)", telegram_id)
                         else:
-                            logger.warning(f"Failed to notify user {telegram_id} about free credit: {e}")
+                            logger.warning("Failed to notify user %s about free credit: %s", telegram_id, e)
     except (ValueError, TypeError):
         amount = 0
     raise web.HTTPFound(f"/admin/user/{telegram_id}?{tp}&success=free_credited&amount={amount}")
@@ -1525,7 +1527,7 @@ async def set_daily_limit(request: web.Request):
         if 1 <= new_value <= 1000:
             config.max_generations_per_user_per_day = new_value
             persist_env_var("MAX_GENERATIONS_PER_USER_PER_DAY", str(new_value))
-            logger.info(f"Daily generation limit changed to {new_value} via admin panel")
+            logger.info("Daily generation limit changed to %s via admin panel", new_value)
     except (ValueError, TypeError):
         pass
     raise web.HTTPFound(f"/admin/?{tp}&success=daily_limit_set")
@@ -1541,7 +1543,7 @@ async def set_hourly_limit(request: web.Request):
         if 1 <= new_value <= 1000:
             config.max_generations_per_hour = new_value
             persist_env_var("MAX_GENERATIONS_PER_HOUR", str(new_value))
-            logger.info(f"Global hourly limit changed to {new_value} via admin panel")
+            logger.info("Global hourly limit changed to %s via admin panel", new_value)
     except (ValueError, TypeError):
         pass
     raise web.HTTPFound(f"/admin/?{tp}&success=hourly_limit_set")
@@ -1553,7 +1555,8 @@ async def reset_daily_counter(request: web.Request):
     tp = token_param(request)
     telegram_id = int(request.match_info["id"])
     await db.reset_user_daily_generations(telegram_id)
-    logger.info(f"Admin reset daily generation counter for user {telegram_id}")
+    cache.invalidate_user(telegram_id)
+    logger.info("Admin reset daily generation counter for user %s", telegram_id)
     raise web.HTTPFound(f"/admin/user/{telegram_id}?{tp}&success=counter_reset")
 
 
@@ -1564,7 +1567,7 @@ async def toggle_russian_prefix(request: web.Request):
     new_value = not config.russian_language_prefix
     config.russian_language_prefix = new_value
     persist_env_var("RUSSIAN_LANGUAGE_PREFIX", "1" if new_value else "0")
-    logger.info(f"Admin toggled russian_language_prefix to {new_value}")
+    logger.info("Admin toggled russian_language_prefix to %s", new_value)
     raise web.HTTPFound(f"/admin/?{tp}&success=russian_prefix")
 
 
@@ -1575,7 +1578,7 @@ async def toggle_video_generation(request: web.Request):
     new_value = not config.video_generation_enabled
     config.video_generation_enabled = new_value
     persist_env_var("VIDEO_GENERATION_ENABLED", "1" if new_value else "0")
-    logger.info(f"Admin toggled video_generation_enabled to {new_value}")
+    logger.info("Admin toggled video_generation_enabled to %s", new_value)
     raise web.HTTPFound(f"/admin/?{tp}&success=video_generation")
 
 
@@ -1592,7 +1595,7 @@ async def set_preview_settings(request: web.Request):
     config.preview_duration_sec = dur_sec
     persist_env_var("PREVIEW_START_PERCENT", str(start_pct))
     persist_env_var("PREVIEW_DURATION_SEC", str(dur_sec))
-    logger.info(f"Admin set preview: start={start_pct}%, duration={dur_sec}s")
+    logger.info("Admin set preview: start=%s%%, duration=%ss", start_pct, dur_sec)
     raise web.HTTPFound(f"/admin/?{tp}&success=preview_settings")
 
 
@@ -1657,15 +1660,15 @@ async def mass_credit_execute(request: web.Request):
     credited = 0
     for uid in user_ids:
         try:
-            await db.update_user_credits(uid, amount)
-            await db.log_balance_transaction(
+            await db.charge_and_log(
                 uid, amount, 'admin', f'Массовое начисление: {message_text[:80]}',
             )
+            cache.invalidate_user(uid)
             credited += 1
         except Exception as e:
-            logger.warning(f"Mass credit DB error for {uid}: {e}")
+            logger.warning("Mass credit DB error for %s: %s", uid, e)
 
-    logger.info(f"Mass credit: {credited}/{total} users got {amount} credits")
+    logger.info("Mass credit: %s/%s users got %s credits", credited, total, amount)
 
     # Send notifications in background
     get_bot = request.app.get("get_bot")
@@ -1697,7 +1700,8 @@ async def mass_credit_execute(request: web.Request):
                         failed += 1
                 await asyncio.sleep(0.04)
             logger.info(
-                f"Mass credit notifications: sent={sent} blocked={blocked} failed={failed} total={total}"
+                "Mass credit notifications: sent=%s blocked=%s failed=%s total=%s",
+                sent, blocked, failed, total,
             )
 
             # Send final report to admins
@@ -1,5 +1,6 @@
 """Audio preview utilities for creating short voice previews."""
 
+import asyncio
 import logging
 from io import BytesIO
 
@@ -22,6 +23,12 @@ async def create_preview(audio_data: bytes) -> bytes:
     Returns:
         OGG Opus bytes suitable for Telegram voice message
     """
+    # Decoding, fading and the ffmpeg export are blocking CPU/subprocess
+    # work; run them in a thread so other updates keep being handled
+    return await asyncio.to_thread(_create_preview_sync, audio_data)
+
+
+def _create_preview_sync(audio_data: bytes) -> bytes:
     from pydub import AudioSegment
 
     duration_sec = config.preview_duration_sec
@@ -51,5 +58,5 @@ async def create_preview(audio_data: bytes) -> bytes:
         return buf.read()
         
     except Exception as e:
-        logger.error(f"Failed to create audio preview: {e}")
+        logger.error("Failed to create audio preview: %s", e)
         raise
@@ -0,0 +1,104 @@
+"""Short-lived in-process caches for hot per-user DB reads.
+
+Every tap in the creation wizard re-checks limits and credits; these
+wrappers collapse repeated identical reads within a few seconds into a
+single query. Call invalidate_user() after mutating a user's balance or
+generation count so the next check sees fresh data, and
+invalidate_generation() after completing, unlocking or re-uploading a
+generation.
+"""
+
+import asyncio
+import functools
+import time
+from typing import Any
+
+from app import database as db
+
+USER_CACHE_TTL = 3.0  # seconds
+# The global hourly count is shared by every user, so it can live longer
+GLOBAL_COUNT_CACHE_TTL = 10.0  # seconds
+# Track buttons (download, rate, regenerate) re-read the same
+# generation row on every tap; finished generations barely change
+GENERATION_CACHE_TTL = 120.0  # seconds
+
+
+def async_ttl_cache(ttl: float, maxsize: int = 10_000):
+    """Cache an async function's result per positional args for ``ttl`` seconds.
+
+    Concurrent misses for the same key share one underlying call. The
+    wrapper exposes ``invalidate(*args)`` and ``cache_clear()``.
+    """
+    def decorator(func):
+        entries: dict[tuple, tuple[float, Any]] = {}
+        # Per-key lock and the number of callers holding or waiting on it;
+        # the entry is dropped only when the last of them is done
+        locks: dict[tuple, list] = {}
+        # Bumped on invalidate so an in-flight fetch can't store stale data
+        epochs: dict[tuple, int] = {}
+
+        @functools.wraps(func)
+        async def wrapper(*args):
+            hit = entries.get(args)
+            if hit and hit[0] > time.monotonic():
+                return hit[1]
+
+            slot = locks.get(args)
+            if slot is None:
+                slot = locks[args] = [asyncio.Lock(), 0]
+            slot[1] += 1
+            try:
+                async with slot[0]:
+                    hit = entries.get(args)
+                    if hit and hit[0] > time.monotonic():
+                        return hit[1]
+                    epoch = epochs.get(args, 0)
+                    value = await func(*args)
+                    if epochs.get(args, 0) == epoch:
+                        if len(entries) >= maxsize:
+                            now = time.monotonic()
+                            for key in [k for k, (exp, _) in entries.items() if exp <= now]:
+                                del entries[key]
+                            if len(entries) >= maxsize:
+                                entries.clear()
+                        entries[args] = (time.monotonic() + ttl, value)
+                    return value
+            finally:
+                slot[1] -= 1
+                if not slot[1]:
+                    del locks[args]
+
+        def invalidate(*args):
+            entries.pop(args, None)
+            epochs[args] = epochs.get(args, 0) + 1
+            if len(epochs) > maxsize:
+                epochs.clear()
+
+        def cache_clear():
+            entries.clear()
+            epochs.clear()
+
+        wrapper.invalidate = invalidate
+        wrapper.cache_clear = cache_clear
+        return wrapper
+
+    return decorator
+
+
+# ─── Cached DB reads ───
+
+get_user = async_ttl_cache(USER_CACHE_TTL)(db.get_user)
+count_user_generations_today = async_ttl_cache(USER_CACHE_TTL)(db.count_user_generations_today)
+count_generations_last_hour = async_ttl_cache(GLOBAL_COUNT_CACHE_TTL)(db.count_generations_last_hour)
+get_generation = async_ttl_cache(GENERATION_CACHE_TTL, maxsize=1024)(db.get_generation)
+
+
+def invalidate_user(user_id: int):
+    """Drop cached reads for a user after their balance or history changed."""
+    get_user.invalidate(user_id)
+    count_user_generations_today.invalidate(user_id)
+
+
+def invalidate_generation(gen_id: int):
+    """Drop a cached generation row after it was completed or changed."""
+    get_generation.invalidate(gen_id)
@@ -0,0 +1,25 @@
+"""Parsing of "kind:value" inline-button callback data."""
+
+import re
+from dataclasses import dataclass
+
+_CB_IDS_RE = re.compile(r"([a-z_]+):((\d+)(?::(\d+))?)$")
+
+
+@dataclass(frozen=True, slots=True)
+class CallbackAction:
+    """Parsed "kind:value" callback data, e.g. "rate:42:5" → kind="rate", ints=(42, 5)."""
+    kind: str
+    value: str
+    ints: tuple[int, ...]
+
+    @classmethod
+    def parse(cls, data: str) -> "CallbackAction":
+        # Fast path for the common "kind:<id>[:<n>]" shape: one C-level match
+        m = _CB_IDS_RE.match(data)
+        if m:
+            kind, value, a, b = m.groups()
+            return cls(kind, value, (int(a),) if b is None else (int(a), int(b)))
+        kind, _, value = data.partition(":")
+        ints = tuple(int(p) for p in value.split(":") if p.isdigit())
+        return cls(kind, value, ints)
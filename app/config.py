@@ -35,9 +35,9 @@ def persist_env_var(key: str, value: str):
             lines.append(f"{key}={value}")
 
         _ENV_FILE.write_text("\n".join(lines) + "\n")
-        _logger.info(f"Persisted {key}={value} to .env")
+        _logger.info("Persisted %s=%s to .env", key, value)
     except Exception as e:
-        _logger.warning(f"Failed to persist {key} to .env: {e}")
+        _logger.warning("Failed to persist %s to .env: %s", key, e)
 
 
 # SunoAPI.org configuration
@@ -83,6 +83,10 @@ class Config:
     unlock_price_stars: int = int(os.getenv("UNLOCK_PRICE_STARS", "75"))
     unlock_price_rub: int = int(os.getenv("UNLOCK_PRICE_RUB", "100"))
 
+    # Suno API concurrency and submit rate (SunoAPI.org allows ~20 requests / 10 s)
+    max_concurrent_suno: int = int(os.getenv("MAX_CONCURRENT_SUNO", "10"))
+    suno_requests_per_sec: float = float(os.getenv("SUNO_REQUESTS_PER_SEC", "2"))
+
     # Preview settings (for free generations)
     preview_start_percent: int = int(os.getenv("PREVIEW_START_PERCENT", "33"))
     preview_duration_sec: int = int(os.getenv("PREVIEW_DURATION_SEC", "30"))
@@ -103,6 +107,9 @@ class Config:
     # Credit packages: (credits, stars_price)
     credit_packages: list = None
     credit_packages_rub: list = None
+    # Same packages keyed by credits, for looking up a pressed button
+    credit_packages_by_credits: dict = None
+    credit_packages_rub_by_credits: dict = None
 
     def __post_init__(self):
         if not self.bot_token:
@@ -124,6 +131,8 @@ class Config:
             {"credits": 10, "rub": 800, "label": "10🎵 — 800₽"},
             {"credits": 50, "rub": 3500, "label": "50🎵 — 3500₽"},
         ]
+        self.credit_packages_by_credits = {p["credits"]: p for p in self.credit_packages}
+        self.credit_packages_rub_by_credits = {p["credits"]: p for p in self.credit_packages_rub}
         self.tbank_enabled = bool(self.tbank_terminal_key)
         # Admin user IDs (can override via env ADMIN_IDS=123,456)
         env_ids = os.getenv("ADMIN_IDS", "")
@@ -1,5 +1,6 @@
 """Database connection and models using raw asyncpg."""
 
+import asyncio
 import asyncpg
 import logging
 from datetime import datetime
@@ -17,12 +18,14 @@ async def init_db():
     pool = await asyncpg.create_pool(config.database_url, min_size=2, max_size=10)
     async with pool.acquire() as conn:
         await conn.execute(SCHEMA_SQL)
+    balance_log.start()
     logger.info("Database initialized")
 
 
 async def close_db():
     """Close the connection pool."""
     global pool
+    await balance_log.stop()
     if pool:
         await pool.close()
         pool = None
@@ -166,7 +169,7 @@ async def get_or_create_user(telegram_id: int, username: str | None, first_name:
             config.free_credits_on_signup,  # free preview credits
             referred_by,
         )
-        logger.info(f"New user registered: {telegram_id} ({username}), referred_by={referred_by}")
+        logger.info("New user registered: %s (%s), referred_by=%s", telegram_id, username, referred_by)
         return dict(row)
 
 
@@ -176,27 +179,49 @@ async def get_user(telegram_id: int) -> dict | None:
         return dict(row) if row else None
 
 
-async def update_user_credits(telegram_id: int, delta: int) -> int:
-    """Add (positive) or subtract (negative) credits. Returns new balance."""
+async def charge_and_log(
+    telegram_id: int, delta: int, source: str, description: str = "",
+) -> int:
+    """Change a user's credits and log the transaction in one round trip.
+
+    Returns the new credit balance.
+    """
     async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "UPDATE users SET credits = credits + $2 WHERE telegram_id = $1 RETURNING credits",
-            telegram_id, delta,
-        )
-        return row["credits"]
+        async with conn.transaction():
+            row = await conn.fetchrow(
+                "UPDATE users SET credits = credits + $2 WHERE telegram_id = $1 RETURNING credits",
+                telegram_id, delta,
+            )
+            await conn.execute(
+                """INSERT INTO balance_transactions (user_id, amount, source, description)
+                   VALUES ($1, $2, $3, $4)""",
+                telegram_id, delta, source, description,
+            )
+            return row["credits"]
 
 
-async def use_free_generation(telegram_id: int) -> bool:
-    """Try to use a free generation. Returns True if successful."""
+async def spend_credit(telegram_id: int, source: str, description: str = "") -> int | None:
+    """Take one credit if the user has one, logging it in the same transaction.
+
+    The balance check is part of the UPDATE, so concurrent taps can't spend
+    the same credit twice. Returns the new balance, or None if there was none.
+    """
     async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            """UPDATE users
-               SET free_generations_left = free_generations_left - 1
-               WHERE telegram_id = $1 AND free_generations_left > 0
-               RETURNING free_generations_left""",
-            telegram_id,
-        )
-        return row is not None
+        async with conn.transaction():
+            credits = await conn.fetchval(
+                """UPDATE users SET credits = credits - 1
+                   WHERE telegram_id = $1 AND credits >= 1
+                   RETURNING credits""",
+                telegram_id,
+            )
+            if credits is None:
+                return None
+            await conn.execute(
+                """INSERT INTO balance_transactions (user_id, amount, source, description)
+                   VALUES ($1, -1, $2, $3)""",
+                telegram_id, source, description,
+            )
+            return credits
 
 
 async def update_free_credits(telegram_id: int, delta: int) -> int:
@@ -209,14 +234,6 @@ async def update_free_credits(telegram_id: int, delta: int) -> int:
         return row["free_generations_left"]
 
 
-async def update_last_generation(telegram_id: int):
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE users SET last_generation_at = NOW() WHERE telegram_id = $1",
-            telegram_id,
-        )
-
-
 async def increment_content_violations(telegram_id: int) -> int:
     """Increment violations and block if >= 3. Returns new count."""
     async with pool.acquire() as conn:
@@ -241,7 +258,7 @@ async def mark_user_blocked(telegram_id: int):
                 telegram_id,
             )
     except Exception as e:
-        logger.warning(f"Failed to mark user {telegram_id} as blocked: {e}")
+        logger.warning("Failed to mark user %s as blocked: %s", telegram_id, e)
 
 
 async def mark_user_unblocked(telegram_id: int):
@@ -254,7 +271,7 @@ async def mark_user_unblocked(telegram_id: int):
                 telegram_id,
             )
     except Exception as e:
-        logger.warning(f"Failed to mark user {telegram_id} as unblocked: {e}")
+        logger.warning("Failed to mark user %s as unblocked: %s", telegram_id, e)
 
 
 async def count_referrals(telegram_id: int) -> int:
@@ -267,6 +284,21 @@ async def count_referrals(telegram_id: int) -> int:
         return row["cnt"]
 
 
+async def get_profile(telegram_id: int) -> dict | None:
+    """User balance plus finished-track and referral counts, in one query."""
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            """SELECT u.credits, u.free_generations_left, u.created_at,
+                      (SELECT COUNT(*) FROM generations g
+                       WHERE g.user_id = u.telegram_id AND g.status = 'complete') AS tracks,
+                      (SELECT COUNT(*) FROM users r
+                       WHERE r.referred_by = u.telegram_id) AS referrals
+               FROM users u WHERE u.telegram_id = $1""",
+            telegram_id,
+        )
+        return dict(row) if row else None
+
+
 # ─── Generation operations ───
 
 async def create_generation(user_id: int, prompt: str, style: str,
@@ -276,32 +308,31 @@ async def create_generation(user_id: int, prompt: str, style: str,
                             generated_lyrics: str | None = None,
                             edited_lyrics: str | None = None,
                             generated_title: str | None = None,
-                            accented_lyrics: str | None = None) -> int:
-    """Create a generation record and return its ID."""
+                            accented_lyrics: str | None = None,
+                            status: str = "pending",
+                            suno_song_ids: list[str] | None = None,
+                            callback_chat_id: int | None = None,
+                            callback_message_id: int | None = None) -> int:
+    """Create a generation record and return its ID.
+
+    A generation already submitted to Suno is inserted in one go with its
+    status, task_id and callback target.
+    """
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
             """INSERT INTO generations (user_id, prompt, style, voice_gender, mode, status,
                    user_mode, raw_input, generated_lyrics, edited_lyrics, generated_title,
-                   accented_lyrics)
-               VALUES ($1, $2, $3, $4, $5, 'pending', $6, $7, $8, $9, $10, $11)
+                   accented_lyrics, suno_song_ids, callback_chat_id, callback_message_id)
+               VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15)
                RETURNING id""",
-            user_id, prompt, style, voice_gender, mode,
+            user_id, prompt, style, voice_gender, mode, status,
             user_mode or mode, raw_input,
             generated_lyrics, edited_lyrics, generated_title,
-            accented_lyrics,
+            accented_lyrics, suno_song_ids, callback_chat_id, callback_message_id,
         )
         return row["id"]
 
 
-async def update_generation_callback_info(gen_id: int, chat_id: int, message_id: int):
-    """Store chat_id and message_id for async callback delivery."""
-    async with pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE generations SET callback_chat_id = $2, callback_message_id = $3 WHERE id = $1",
-            gen_id, chat_id, message_id,
-        )
-
-
 async def get_generation_by_task_id(task_id: str) -> dict | None:
     """Find a generation by its Suno task_id (stored in suno_song_ids array)."""
     async with pool.acquire() as conn:
@@ -356,6 +387,78 @@ async def update_generation_status(gen_id: int, status: str, **kwargs):
         await conn.execute(query, *values)
 
 
+async def finalize_generation(
+    user_id: int, gen_id: int, audio_urls: list[str],
+    song_titles: list[str], suno_audio_ids: list[str], label: str = "",
+) -> str | None:
+    """Charge the user and mark a finished generation complete.
+
+    A free generation is spent if one is left, otherwise one credit. Paid
+    generations are unlocked right away; with neither left the tracks stay
+    locked. ``label`` is appended to the balance transaction description.
+    Returns "free", "paid" or "uncharged" for what was spent, or None if the
+    generation was already complete.
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            # Lock the balance first so the snapshot the charge is decided on
+            # is the one the UPDATEs below apply to (no concurrent spend_credit
+            # can drain it in between)
+            await conn.execute(
+                "SELECT 1 FROM users WHERE telegram_id = $1 FOR UPDATE", user_id,
+            )
+            # Complete the row unless the webhook or poller already did, and
+            # only then spend a free generation if there is one, else a
+            # credit, and log it
+            return await conn.fetchval(
+                """WITH bal AS (
+                       SELECT free_generations_left > 0 AS has_free,
+                              credits > 0 AS has_credit
+                       FROM users WHERE telegram_id = $1
+                   ), g AS (
+                       UPDATE generations
+                       SET status = 'complete', audio_urls = $3, song_titles = $4,
+                           suno_audio_ids = $5,
+                           credits_spent = CASE WHEN NOT bal.has_free AND bal.has_credit
+                                                THEN 1 ELSE 0 END,
+                           is_unlocked = is_unlocked OR (NOT bal.has_free AND bal.has_credit),
+                           completed_at = $6
+                       FROM bal
+                       WHERE id = $2 AND status <> 'complete'
+                       RETURNING bal.has_free
+                   ), free AS (
+                       UPDATE users
+                       SET free_generations_left = free_generations_left - 1,
+                           last_generation_at = NOW()
+                       WHERE telegram_id = $1 AND free_generations_left > 0
+                         AND EXISTS (SELECT 1 FROM g WHERE has_free)
+                       RETURNING TRUE AS used
+                   ), paid AS (
+                       UPDATE users
+                       SET credits = credits - 1, last_generation_at = NOW()
+                       WHERE telegram_id = $1 AND credits > 0
+                         AND EXISTS (SELECT 1 FROM g WHERE NOT has_free)
+                       RETURNING TRUE AS used
+                   ), charge AS (
+                       SELECT EXISTS (SELECT 1 FROM free) AS is_free
+                       WHERE EXISTS (SELECT 1 FROM free) OR EXISTS (SELECT 1 FROM paid)
+                   ), log AS (
+                       INSERT INTO balance_transactions (user_id, amount, source, description)
+                       SELECT $1, -1,
+                              CASE WHEN is_free THEN 'free_generation' ELSE 'generation' END,
+                              CASE WHEN is_free THEN 'Бесплатная генерация #' ELSE 'Генерация #' END
+                                  || $2::int || $7::text
+                       FROM charge
+                   )
+                   SELECT CASE WHEN EXISTS (SELECT 1 FROM free) THEN 'free'
+                               WHEN EXISTS (SELECT 1 FROM paid) THEN 'paid'
+                               ELSE 'uncharged' END
+                   FROM g""",
+                user_id, gen_id, audio_urls, song_titles, suno_audio_ids,
+                datetime.utcnow(), label,
+            )
+
+
 async def update_generation_rating(gen_id: int, rating: int):
     """Save user rating for a generation."""
     async with pool.acquire() as conn:
@@ -405,6 +508,26 @@ async def is_generation_unlocked(gen_id: int) -> bool:
         return row["is_unlocked"] if row else False
 
 
+async def set_generation_file_id(gen_id: int, idx: int, file_id: str):
+    """Remember the Telegram file_id of an uploaded track (idx is 0-based).
+
+    Rebuilds the array with one slot replaced so both tracks can be stored
+    concurrently without NULL-array lower-bound surprises.
+    """
+    async with pool.acquire() as conn:
+        await conn.execute(
+            """UPDATE generations
+               SET tg_file_ids = ARRAY(
+                   SELECT CASE WHEN i = $2 THEN $3 ELSE tg_file_ids[i] END
+                   FROM generate_series(
+                       1, GREATEST($2, COALESCE(array_length(tg_file_ids, 1), 0))
+                   ) AS i
+               )
+               WHERE id = $1""",
+            gen_id, idx + 1, file_id,
+        )
+
+
 async def get_generation(gen_id: int) -> dict | None:
     async with pool.acquire() as conn:
         row = await conn.fetchrow("SELECT * FROM generations WHERE id = $1", gen_id)
@@ -453,6 +576,24 @@ async def get_stuck_generations(timeout_minutes: int = 10) -> list[dict]:
         return [dict(r) for r in rows]
 
 
+async def get_resumable_generations() -> list[dict]:
+    """Generations submitted to Suno whose result hasn't been delivered yet.
+
+    Only rows that know their task_id and the chat/status message to answer
+    in are returned, so the completion poller can pick them up after a restart.
+    """
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """SELECT * FROM generations
+               WHERE status = 'processing'
+                 AND cardinality(suno_song_ids) > 0
+                 AND callback_chat_id IS NOT NULL
+                 AND callback_message_id IS NOT NULL
+               ORDER BY created_at ASC""",
+        )
+        return [dict(r) for r in rows]
+
+
 # ─── Payment operations ───
 
 async def create_payment(user_id: int, tg_payment_id: str, stars: int, credits: int) -> int:
@@ -650,7 +791,83 @@ async def log_balance_transaction(
                 user_id, amount, source, description,
             )
     except Exception as e:
-        logger.warning(f"Failed to log balance transaction: {e}")
+        logger.warning("Failed to log balance transaction: %s", e)
+
+
+BALANCE_LOG_BATCH = 200
+BALANCE_LOG_INTERVAL = 0.2  # seconds
+# Rows include Stars purchases and admin adjustments, so a failed batch is
+# retried before it is given up (and then logged row by row at ERROR)
+BALANCE_LOG_ATTEMPTS = 3
+BALANCE_LOG_RETRY_DELAY = 1.0  # seconds, grows with each attempt
+
+
+class BalanceLogQueue:
+    """Write-behind buffer for balance_transactions rows.
+
+    The log only needs eventual durability, so handlers enqueue rows and a
+    background task inserts them in batches with synchronous_commit off.
+    Rows still queued on shutdown are flushed by stop().
+    """
+
+    def __init__(self):
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+
+    def put_nowait(self, user_id: int, amount: int, source: str, description: str = ""):
+        self._queue.put_nowait((user_id, amount, source, description))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        self._task = None
+
+    async def _run(self):
+        while True:
+            rows = [await self._queue.get()]
+            await asyncio.sleep(BALANCE_LOG_INTERVAL)
+            while len(rows) < BALANCE_LOG_BATCH and not self._queue.empty():
+                rows.append(self._queue.get_nowait())
+            try:
+                await self._write(rows)
+            finally:
+                for _ in rows:
+                    self._queue.task_done()
+
+    async def _write(self, rows: list[tuple]):
+        user_ids, amounts, sources, descriptions = zip(*rows)
+        for attempt in range(1, BALANCE_LOG_ATTEMPTS + 1):
+            try:
+                async with pool.acquire() as conn:
+                    async with conn.transaction():
+                        await conn.execute("SET LOCAL synchronous_commit = off")
+                        await conn.execute(
+                            """INSERT INTO balance_transactions (user_id, amount, source, description)
+                               SELECT * FROM unnest($1::bigint[], $2::int[], $3::text[], $4::text[])""",
+                            user_ids, amounts, sources, descriptions,
+                        )
+                return
+            except Exception as e:
+                if attempt < BALANCE_LOG_ATTEMPTS:
+                    logger.warning(
+                        "Failed to log %s balance transactions (attempt %s), retrying: %s",
+                        len(rows), attempt, e,
+                    )
+                    await asyncio.sleep(BALANCE_LOG_RETRY_DELAY * attempt)
+                else:
+                    logger.error(
+                        "Dropped %s balance transactions after %s attempts: %s; rows: %r",
+                        len(rows), attempt, e, rows,
+                    )
+
+
+balance_log = BalanceLogQueue()
 
 
 async def admin_get_balance_transactions(
@@ -0,0 +1,151 @@
+"""Per-track delivery of finished generations, shared by the poller and the Suno webhook."""
+
+import asyncio
+import logging
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, Message, URLInputFile
+
+from app import cache
+from app import database as db
+from app.audio_preview import create_preview
+from app.config import config
+from app.http_client import fetch_audio
+from app.keyboards import track_kb, preview_track_kb
+from app.suno_api import Track
+from app.texts import PREVIEW_CAPTION
+
+logger = logging.getLogger(__name__)
+
+
+async def remember_file_id(gen_id: int, idx: int, sent: Message):
+    """Store an uploaded track's file_id so later sends skip the CDN."""
+    if not sent.audio:
+        return
+    try:
+        await db.set_generation_file_id(gen_id, idx, sent.audio.file_id)
+        cache.invalidate_generation(gen_id)
+    except Exception as e:
+        logger.warning("Failed to store file_id for %s/%s: %s", gen_id, idx, e)
+
+
+async def send_cover(bot: Bot, chat_id: int, i: int, img_url: str, title: str):
+    """Send a track's cover image; failures are logged and ignored."""
+    if not img_url:
+        return
+    try:
+        await bot.send_photo(
+            chat_id=chat_id,
+            photo=img_url,
+            caption=f"🎵 Обложка для трека: <b>{title}</b>",
+            parse_mode="HTML",
+        )
+    except Exception as e:
+        logger.warning("Failed to send cover image %s: %s", i, e)
+
+
+async def prepare_preview(url: str) -> tuple[bytes, bytes | Exception]:
+    """Download a track and cut its 30-sec preview (or the error doing so)."""
+    audio_data = await fetch_audio(url)
+    try:
+        return audio_data, await create_preview(audio_data)
+    except Exception as e:
+        return audio_data, e
+
+
+async def deliver_preview_track(
+    bot: Bot, chat_id: int, gen_id: int, user_id: int, i: int, track: Track,
+    prepared: asyncio.Task | None = None,
+):
+    """Send cover + 30-sec voice preview for one track of a free generation.
+
+    ``prepared`` is a running ``prepare_preview`` task, for callers that
+    start both tracks early; otherwise it is started here, while the cover
+    goes out.
+    """
+    title = track.title
+    try:
+        if prepared is None:
+            prepared = asyncio.create_task(prepare_preview(track.url))
+        # Voice messages have no thumbnail, so the cover goes first
+        await send_cover(bot, chat_id, i, track.img, title)
+        audio_data, preview_data = await prepared
+
+        bot_link = f"https://t.me/{config.bot_username}?start=ref{user_id}"
+        try:
+            if isinstance(preview_data, Exception):
+                raise preview_data
+            voice_file = BufferedInputFile(
+                preview_data,
+                filename=f"preview_{i+1}.ogg",
+            )
+            await bot.send_voice(
+                chat_id=chat_id,
+                voice=voice_file,
+                caption=PREVIEW_CAPTION.format(title=title, bot_link=bot_link),
+                parse_mode="HTML",
+                reply_markup=preview_track_kb(gen_id, i, user_id=user_id),
+            )
+        except Exception as e:
+            logger.warning("Preview creation failed for track %s, sending full audio as fallback: %s", i, e)
+            # Fallback: send full audio file
+            audio_file = BufferedInputFile(
+                audio_data,
+                filename=f"{title}.mp3",
+            )
+            await bot.send_audio(
+                chat_id=chat_id,
+                audio=audio_file,
+                title=f"🎧 {title}",
+                performer="AI Melody",
+                caption=PREVIEW_CAPTION.format(title=title, bot_link=bot_link),
+                parse_mode="HTML",
+                reply_markup=preview_track_kb(gen_id, i, user_id=user_id),
+            )
+    except Exception as e:
+        logger.error("Failed to send preview %s: %s", i, e)
+
+
+async def deliver_paid_track(
+    bot: Bot, chat_id: int, gen_id: int, user_id: int, i: int, track: Track,
+):
+    """Send the full MP3 for one track of a paid generation.
+
+    The cover always goes out as its own photo first: Telegram silently
+    drops thumbnails over 200 kB or 320 px, which Suno covers usually are.
+    It is also attached as the audio thumbnail for clients that show it;
+    if Telegram rejects that, the audio is sent without one.
+    """
+    title = track.title
+    bot_link = f"https://t.me/{config.bot_username}?start=ref{user_id}"
+    paid_caption = (
+        f"🎵 <a href=\"{bot_link}\">Создай свою песню с помощью ИИ</a> — "
+        f"получи +1🎵 за каждого друга!"
+    )
+
+    async def send_audio(thumbnail: URLInputFile | None = None):
+        # Streamed from the CDN into the upload in chunks, never held in RAM
+        sent = await bot.send_audio(
+            chat_id=chat_id,
+            audio=URLInputFile(track.url, filename=f"{title}.mp3", timeout=60),
+            title=title,
+            performer="AI Melody",
+            caption=paid_caption,
+            parse_mode="HTML",
+            thumbnail=thumbnail,
+            reply_markup=track_kb(gen_id, i, user_id=user_id),
+        )
+        await remember_file_id(gen_id, i, sent)
+
+    try:
+        await send_cover(bot, chat_id, i, track.img, title)
+        if track.img:
+            try:
+                await send_audio(URLInputFile(track.img, filename="cover.jpg", timeout=30))
+                return
+            except TelegramBadRequest as e:
+                logger.warning("Thumbnail rejected for track %s, sending audio without it: %s", i, e)
+        await send_audio()
+    except Exception as e:
+        logger.error("Failed to send track %s: %s", i, e)
@@ -9,6 +9,23 @@ from app.config import config
 
 logger = logging.getLogger(__name__)
 
+# Shared client — keeps the TLS connection to the OpenAI API alive between calls
+_client: httpx.AsyncClient | None = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(timeout=30.0)
+    return _client
+
+
+async def close_gpt_client():
+    global _client
+    if _client and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
 _SYSTEM_PROMPT = (
     "Ты — помощник для сжатия описаний песен. "
     "Тебе дают описание песни на русском языке, которое слишком длинное. "
@@ -29,43 +46,43 @@ async def compress_prompt(text: str, limit: int = 200) -> Optional[str]:
         return None
 
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {config.openai_api_key}",
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "model": "gpt-4o-mini",
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": _SYSTEM_PROMPT.format(limit=limit),
-                        },
-                        {
-                            "role": "user",
-                            "content": f"Сожми это описание песни до {limit} символов:\n\n{text}",
-                        },
-                    ],
-                    "max_tokens": 300,
-                    "temperature": 0.3,
-                },
-            )
-            response.raise_for_status()
-            data = response.json()
-
-            compressed = data["choices"][0]["message"]["content"].strip()
-
-            # Safety: if GPT returned something longer, truncate
-            if len(compressed) > limit:
-                compressed = compressed[:limit]
-
-            logger.info(
-                f"GPT compressed prompt: {len(text)} -> {len(compressed)} chars"
-            )
-            return compressed
+        client = _get_client()
+        response = await client.post(
+            "https://api.openai.com/v1/chat/completions",
+            headers={
+                "Authorization": f"Bearer {config.openai_api_key}",
+                "Content-Type": "application/json",
+            },
+            json={
+                "model": "gpt-4o-mini",
+                "messages": [
+                    {
+                        "role": "system",
+                        "content": _SYSTEM_PROMPT.format(limit=limit),
+                    },
+                    {
+                        "role": "user",
+                        "content": f"Сожми это описание песни до {limit} символов:\n\n{text}",
+                    },
+                ],
+                "max_tokens": 300,
+                "temperature": 0.3,
+            },
+        )
+        response.raise_for_status()
+        data = response.json()
+
+        compressed = data["choices"][0]["message"]["content"].strip()
+
+        # Safety: if GPT returned something longer, truncate
+        if len(compressed) > limit:
+            compressed = compressed[:limit]
+
+        logger.info(
+            "GPT compressed prompt: %s -> %s chars", len(text), len(compressed)
+        )
+        return compressed
 
     except Exception as e:
-        logger.error(f"GPT compression failed: {e}")
+        logger.error("GPT compression failed: %s", e)
         return None
@@ -2,22 +2,26 @@
 
 import asyncio
 import logging
+import re
 
-import httpx
 from aiohttp import web
 
+from app import cache
 from app import database as db
 from app.config import config
-from app.keyboards import track_kb, after_generation_kb, preview_track_kb, preview_after_generation_kb
-from app.suno_api import get_suno_client
-from app.audio_preview import create_preview
+from app.delivery import deliver_paid_track, deliver_preview_track, prepare_preview
+from app.keyboards import after_generation_kb, preview_after_generation_kb
+from app.suno_api import Track, get_suno_client, parse_tracks
+from app.tasks import spawn
 from app.texts import (
     GENERATION_COMPLETE, GENERATION_ERROR,
-    PREVIEW_CAPTION, PREVIEW_GENERATION_COMPLETE,
+    PREVIEW_GENERATION_COMPLETE,
 )
 
 logger = logging.getLogger(__name__)
 
+_ARTIST_NAME_RE = re.compile(r"artist name\s+(\w+)")
+
 # In-memory store: video_task_id → {chat_id, title, bot_getter}
 _pending_video_tasks: dict[str, dict] = {}
 
@@ -29,7 +33,26 @@ def register_video_task(video_task_id: str, chat_id: int, title: str, get_bot):
         "title": title,
         "get_bot": get_bot,
     }
-    logger.info(f"Registered pending video task {video_task_id} for chat_id={chat_id}")
+    logger.info("Registered pending video task %s for chat_id=%s", video_task_id, chat_id)
+
+
+async def request_videos(
+    task_id: str, tracks: list[tuple[str, str]], chat_id: int, get_bot,
+):
+    """Ask Suno for MP4 clips of several tracks at once and register each task.
+
+    ``tracks`` holds (audio_id, title). Failures are logged per track.
+    """
+    client = get_suno_client()
+    results = await asyncio.gather(
+        *(client.generate_video(task_id, audio_id) for audio_id, _ in tracks),
+        return_exceptions=True,
+    )
+    for i, ((_, title), result) in enumerate(zip(tracks, results)):
+        if isinstance(result, BaseException):
+            logger.warning("Video generation request failed for track %s: %s", i, result)
+            continue
+        register_video_task(result["task_id"], chat_id, title, get_bot)
 
 
 async def handle_suno_callback(request: web.Request) -> web.Response:
@@ -69,21 +92,21 @@ async def handle_suno_callback(request: web.Request) -> web.Response:
     task_id = data.get("task_id", "")
     callback_type = data.get("callbackType", "")
 
-    logger.info(f"Suno callback received: code={code}, task_id={task_id}, type={callback_type}")
+    logger.info("Suno callback received: code=%s, task_id=%s, type=%s", code, task_id, callback_type)
 
     if not task_id:
-        logger.warning(f"Callback: no task_id in payload: {payload}")
+        logger.warning("Callback: no task_id in payload: %s", payload)
         return web.json_response({"status": "ok"})
 
     # Handle intermediate callback types (text, first) — just log and acknowledge
     if callback_type in ("text", "first"):
-        logger.info(f"Callback: intermediate type '{callback_type}' for task_id={task_id}, ignoring")
+        logger.info("Callback: intermediate type '%s' for task_id=%s, ignoring", callback_type, task_id)
         return web.json_response({"status": "ok"})
 
     # Find generation by task_id (stored in suno_song_ids)
     gen = await db.get_generation_by_task_id(task_id)
     if not gen:
-        logger.warning(f"Callback: generation not found for task_id={task_id}")
+        logger.warning("Callback: generation not found for task_id=%s", task_id)
         return web.json_response({"status": "ok"})
 
     gen_id = gen["id"]
@@ -91,7 +114,7 @@ async def handle_suno_callback(request: web.Request) -> web.Response:
 
     # Idempotency: skip if already completed
     if gen["status"] == "complete":
-        logger.info(f"Callback: generation {gen_id} already complete, skipping duplicate")
+        logger.info("Callback: generation %s already complete, skipping duplicate", gen_id)
         return web.json_response({"status": "ok"})
 
     # Get bot instance from app context
@@ -102,58 +125,34 @@ async def handle_suno_callback(request: web.Request) -> web.Response:
         # Success — extract audio URLs, image URLs, titles
         suno_data = data.get("data", [])
 
-        audio_urls = []
-        image_urls = []
-        song_titles = []
-        song_ids = []
-        for s in suno_data:
-            url = s.get("audio_url") or s.get("stream_audio_url", "")
-            audio_urls.append(url)
-            image_urls.append(s.get("image_url", ""))
-            song_titles.append(s.get("title", "AI Melody Track"))
-            song_ids.append(s.get("id", ""))
-
-        if not audio_urls:
-            logger.warning(f"Callback: no audio URLs in data for task_id={task_id}")
+        tracks = parse_tracks(suno_data)
+
+        if not tracks:
+            logger.warning("Callback: no audio URLs in data for task_id=%s", task_id)
             return web.json_response({"status": "ok"})
 
-        # Deduct credit (free = preview only, paid = full MP3)
-        user = await db.get_user(user_id)
-        is_free = False
-        if user:
-            is_free = user["free_generations_left"] > 0
-            if is_free:
-                await db.use_free_generation(user_id)
-                await db.log_balance_transaction(
-                    user_id, -1, 'free_generation', f'Бесплатная генерация #{gen_id}',
-                )
-            else:
-                await db.update_user_credits(user_id, -1)
-                await db.log_balance_transaction(
-                    user_id, -1, 'generation', f'Генерация #{gen_id}',
-                )
-            await db.update_last_generation(user_id)
-
-        credits_spent = 0 if is_free else 1
-        await db.update_generation_status(
-            gen_id, "complete",
-            audio_urls=audio_urls,
-            credits_spent=credits_spent,
-            song_titles=song_titles,
-            suno_audio_ids=song_ids,
+        # Deduct credit and complete in one transaction
+        # (paid = full MP3, unlocked immediately; otherwise preview only)
+        charge = await db.finalize_generation(
+            user_id, gen_id,
+            audio_urls=[t.url for t in tracks],
+            song_titles=[t.title for t in tracks],
+            suno_audio_ids=[t.id for t in tracks],
         )
-
-        # For paid generations, mark as unlocked immediately
-        if not is_free:
-            await db.unlock_generation(gen_id)
+        if charge is None:
+            # The poller finished it between our status check and the charge
+            logger.info("Callback: generation %s already complete, skipping duplicate", gen_id)
+            return web.json_response({"status": "ok"})
+        cache.invalidate_user(user_id)
+        cache.invalidate_generation(gen_id)
 
         # Send result to user via bot asynchronously (don't block the 200 response)
         if bot and gen.get("callback_chat_id"):
-            asyncio.create_task(
-                _deliver_result_to_user(bot, gen, gen_id, audio_urls, image_urls, song_titles, song_ids, task_id, is_free)
+            spawn(
+                _deliver_result_to_user(bot, gen, gen_id, tracks, task_id, charge != "paid")
             )
 
-        logger.info(f"Callback: generation {gen_id} completed with {len(audio_urls)} tracks")
+        logger.info("Callback: generation %s completed with %s tracks", gen_id, len(tracks))
 
     elif code != 200 or callback_type == "error":
         # Error
@@ -161,14 +160,14 @@ async def handle_suno_callback(request: web.Request) -> web.Response:
         await db.update_generation_status(gen_id, "error", error_message=error_msg)
 
         if bot and gen.get("callback_chat_id"):
-            asyncio.create_task(
+            spawn(
                 _deliver_error_to_user(bot, gen, error_msg)
             )
 
-        logger.warning(f"Callback: generation {gen_id} failed: {error_msg}")
+        logger.warning("Callback: generation %s failed: %s", gen_id, error_msg)
 
     else:
-        logger.info(f"Callback: unhandled code={code}, type={callback_type} for task_id={task_id}")
+        logger.info("Callback: unhandled code=%s, type=%s for task_id=%s", code, callback_type, task_id)
 
     return web.json_response({"status": "ok"})
 
@@ -192,16 +191,16 @@ async def handle_video_callback(request: web.Request) -> web.Response:
     task_id = data.get("task_id", "") if isinstance(data, dict) else ""
     msg = payload.get("msg", "")
 
-    logger.info(f"Video callback received: code={code}, task_id={task_id}, msg={msg}, data={data}")
+    logger.info("Video callback received: code=%s, task_id=%s, msg=%s, data=%s", code, task_id, msg, data)
 
     if not task_id:
-        logger.warning(f"Video callback: no task_id in payload: {payload}")
+        logger.warning("Video callback: no task_id in payload: %s", payload)
         return web.json_response({"status": "ok"})
 
     # Look up pending context
     ctx = _pending_video_tasks.pop(task_id, None)
     if not ctx:
-        logger.warning(f"Video callback: no pending task for task_id={task_id}")
+        logger.warning("Video callback: no pending task for task_id=%s", task_id)
         return web.json_response({"status": "ok"})
 
     chat_id = ctx["chat_id"]
@@ -213,11 +212,11 @@ async def handle_video_callback(request: web.Request) -> web.Response:
         video_url = data.get("video_url", "")
         if video_url and bot:
             # Send video asynchronously (don't block the 200 response)
-            asyncio.create_task(_deliver_video(bot, chat_id, video_url, title))
+            spawn(_deliver_video(bot, chat_id, video_url, title))
         elif not video_url:
-            logger.warning(f"Video callback: success but no video_url in data: {data}")
+            logger.warning("Video callback: success but no video_url in data: %s", data)
     else:
-        logger.warning(f"Video callback: failed for task_id={task_id}, code={code}, msg={msg}")
+        logger.warning("Video callback: failed for task_id=%s, code=%s, msg=%s", task_id, code, msg)
 
     return web.json_response({"status": "ok"})
 
@@ -231,31 +230,26 @@ async def _deliver_video(bot, chat_id: int, video_url: str, title: str):
             caption=f"🎬 Видеоклип: <b>{title}</b>",
             parse_mode="HTML",
         )
-        logger.info(f"Video delivered to chat_id={chat_id}: {title}")
+        logger.info("Video delivered to chat_id=%s: %s", chat_id, title)
     except Exception as e:
         err = str(e).lower()
         if any(kw in err for kw in ("blocked", "deactivated", "not found")):
             await db.mark_user_blocked(chat_id)
-            logger.info(f"Video delivery: user {chat_id} blocked the bot")
+            logger.info("Video delivery: user %s blocked the bot", chat_id)
         else:
-            logger.error(f"Video delivery failed for chat_id={chat_id}: {e}")
+            logger.error("Video delivery failed for chat_id=%s: %s", chat_id, e)
 
 
 async def _deliver_result_to_user(
-    bot, gen: dict, gen_id: int,
-    audio_urls: list[str], image_urls: list[str], song_titles: list[str],
-    song_ids: list[str] = None, original_task_id: str = "",
-    is_free: bool = False,
+    bot, gen: dict, gen_id: int, tracks: list[Track],
+    original_task_id: str = "", is_free: bool = False,
 ):
     """Send generation results to the user in Telegram (runs as background task)."""
     chat_id = gen["callback_chat_id"]
     user_id = gen["user_id"]
-    bot_link = f"https://t.me/{config.bot_username}?start=ref{user_id}"
     status_msg_id = gen.get("callback_message_id")
 
     try:
-        from aiogram.types import BufferedInputFile
-
         # Delete status message
         if status_msg_id:
             try:
@@ -263,83 +257,29 @@ async def _deliver_result_to_user(
             except Exception:
                 pass
 
-        for i, url in enumerate(audio_urls[:2]):
-            if not url:
-                continue
-            try:
-                img_url = image_urls[i] if i < len(image_urls) else ""
-                title = song_titles[i] if i < len(song_titles) else f"Вариант {i+1}"
-
-                # Send cover image
-                if img_url:
-                    try:
-                        await bot.send_photo(
-                            chat_id=chat_id,
-                            photo=img_url,
-                            caption=f"🎵 Обложка для трека: <b>{title}</b>",
-                            parse_mode="HTML",
-                        )
-                    except Exception as e:
-                        logger.warning(f"Callback: failed to send cover {i}: {e}")
-
-                # Download audio
-                async with httpx.AsyncClient() as http:
-                    resp = await http.get(url, timeout=60.0)
-                    resp.raise_for_status()
-                    audio_data = resp.content
+        # Free tracks: fetch both and cut both previews at once, then post
+        # them in order so the chat reads Вариант 1 → 2; track 1 goes out as
+        # soon as it is ready. Paid MP3s are streamed from the CDN straight
+        # into the upload, so they need no preparation.
+        previews = {
+            i: asyncio.create_task(prepare_preview(t.url))
+            for i, t in enumerate(tracks[:2]) if t.url
+        } if is_free else {}
 
+        try:
+            for i, track in enumerate(tracks[:2]):
+                if not track.url:
+                    continue
                 if is_free:
-                    # ─── FREE: Send voice preview ───
-                    try:
-                        preview_data = await create_preview(audio_data)
-                        voice_file = BufferedInputFile(
-                            preview_data,
-                            filename=f"preview_{i+1}.ogg",
-                        )
-                        await bot.send_voice(
-                            chat_id=chat_id,
-                            voice=voice_file,
-                            caption=PREVIEW_CAPTION.format(title=title, bot_link=bot_link),
-                            parse_mode="HTML",
-                            reply_markup=preview_track_kb(gen_id, i, user_id=user_id),
-                        )
-                    except Exception as e:
-                        logger.warning(f"Callback: preview creation failed for track {i}, sending full audio as fallback: {e}")
-                        # Fallback: send full audio file
-                        audio_file = BufferedInputFile(
-                            audio_data,
-                            filename=f"{title}.mp3",
-                        )
-                        await bot.send_audio(
-                            chat_id=chat_id,
-                            audio=audio_file,
-                            title=f"🎧 {title}",
-                            performer="AI Melody",
-                            caption=PREVIEW_CAPTION.format(title=title, bot_link=bot_link),
-                            parse_mode="HTML",
-                            reply_markup=preview_track_kb(gen_id, i, user_id=user_id),
-                        )
+                    await deliver_preview_track(bot, chat_id, gen_id, user_id, i, track, previews[i])
                 else:
-                    # ─── PAID: Send full MP3 ───
-                    audio_file = BufferedInputFile(
-                        audio_data,
-                        filename=f"{title}.mp3",
-                    )
-                    paid_caption = (
-                        f"🎵 <a href=\"{bot_link}\">Создай свою песню с помощью ИИ</a> — "
-                        f"получи +1🎵 за каждого друга!"
-                    )
-                    await bot.send_audio(
-                        chat_id=chat_id,
-                        audio=audio_file,
-                        title=title,
-                        performer="AI Melody",
-                        caption=paid_caption,
-                        parse_mode="HTML",
-                        reply_markup=track_kb(gen_id, i, user_id=user_id),
-                    )
-            except Exception as e:
-                logger.error(f"Callback: failed to send track {i}: {e}")
+                    await deliver_paid_track(bot, chat_id, gen_id, user_id, i, track)
+        finally:
+            # If a send raised, the other preview is never awaited; stop it
+            # and collect its result so nothing leaks or warns
+            for task in previews.values():
+                task.cancel()
+            await asyncio.gather(*previews.values(), return_exceptions=True)
 
         # Send after-generation keyboard
         if is_free:
@@ -358,31 +298,25 @@ async def _deliver_result_to_user(
             )
 
         # Video generation (if enabled and PAID) — fire-and-forget
-        if not is_free and config.video_generation_enabled and original_task_id and song_ids:
-            logger.info(f"Callback video check: enabled={config.video_generation_enabled}, song_ids={song_ids}")
+        if not is_free and config.video_generation_enabled and original_task_id:
+            logger.info("Callback video check: enabled=%s, task_id=%s", config.video_generation_enabled, original_task_id)
             try:
-                client = get_suno_client()
-                get_bot = lambda b=bot: b
-                for i, url in enumerate(audio_urls[:2]):
-                    if not url or i >= len(song_ids) or not song_ids[i]:
-                        continue
-                    try:
-                        title = song_titles[i] if i < len(song_titles) else f"Вариант {i+1}"
-                        video_result = await client.generate_video(original_task_id, song_ids[i])
-                        video_task_id = video_result["task_id"]
-                        register_video_task(video_task_id, chat_id, title, get_bot)
-                    except Exception as e:
-                        logger.warning(f"Callback: video generation request failed for track {i}: {e}")
+                await request_videos(
+                    original_task_id,
+                    [(t.id, t.title) for t in tracks[:2] if t.url and t.id],
+                    chat_id,
+                    lambda b=bot: b,
+                )
             except Exception as e:
-                logger.warning(f"Callback: video generation error: {e}")
+                logger.warning("Callback: video generation error: %s", e)
 
     except Exception as e:
         err = str(e).lower()
         if any(kw in err for kw in ("blocked", "deactivated", "not found")):
             await db.mark_user_blocked(gen["user_id"])
-            logger.info(f"Callback delivery: user {gen['user_id']} blocked the bot")
+            logger.info("Callback delivery: user %s blocked the bot", gen['user_id'])
         else:
-            logger.error(f"Callback: error sending results to user: {e}")
+            logger.error("Callback: error sending results to user: %s", e)
 
 
 def _humanize_error(error_msg: str) -> str:
@@ -396,8 +330,7 @@ def _humanize_error(error_msg: str) -> str:
     if "artist name" in lower:
         # Extract the artist name from the error if possible
         # e.g. "Your tags contain artist name maksim - we don't reference..."
-        import re
-        match = re.search(r'artist name\s+(\w+)', lower)
+        match = _ARTIST_NAME_RE.search(lower)
         name = match.group(1).title() if match else "исполнителя"
         return (
             f"❌ <b>Имя совпало с исполнителем</b>\n\n"
@@ -494,7 +427,7 @@ async def _deliver_error_to_user(bot, gen: dict, error_msg: str):
             )
             delivered = True
         except Exception as e:
-            logger.warning(f"Callback: failed to edit error msg: {e}")
+            logger.warning("Callback: failed to edit error msg: %s", e)
 
     if not delivered:
         try:
@@ -507,6 +440,6 @@ async def _deliver_error_to_user(bot, gen: dict, error_msg: str):
             err = str(e).lower()
             if any(kw in err for kw in ("blocked", "deactivated", "not found")):
                 await db.mark_user_blocked(gen.get("user_id", 0))
-                logger.info(f"Error delivery: user {gen.get('user_id')} blocked the bot")
+                logger.info("Error delivery: user %s blocked the bot", gen.get('user_id'))
             else:
-                logger.error(f"Callback: failed to send error msg to chat {chat_id}: {e}")
+                logger.error("Callback: failed to send error msg to chat %s: %s", chat_id, e)
@@ -1,15 +1,18 @@
 """Common command handlers: /start, /help, /balance, profile, menu navigation."""
 
+import functools
 import logging
-from datetime import datetime
+from datetime import date, datetime
 
 from aiogram import Router, F
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, CallbackQuery, ChatMemberUpdated
 from aiogram.fsm.context import FSMContext
 
+from app import cache
 from app import database as db
 from app.config import config
+from app.handlers.generation import show_history, start_creation
 from app.keyboards import (
     main_reply_kb, balance_kb, stars_kb, mode_kb,
     BTN_CREATE, BTN_BALANCE, BTN_TRACKS, BTN_HELP,
@@ -23,6 +26,14 @@ from app.texts import (
 router = Router()
 logger = logging.getLogger(__name__)
 
+# Pre-built send kwargs for static pages
+_HELP_PAYLOAD = {"text": HELP, "parse_mode": "HTML"}
+_INVITE_INSTRUCTIONS_PAYLOAD = {"text": INVITE_INSTRUCTIONS, "parse_mode": "HTML"}
+_BUY_STARS_PAYLOAD = {"text": BUY_STARS_HEADER, "parse_mode": "HTML"}
+
+# (chat_id, message_id) of messages with an edit_text request in flight
+_inflight_edits: set[tuple[int, int]] = set()
+
 
 def is_blocked_error(e: Exception) -> bool:
     """Check if an exception indicates the user blocked the bot."""
@@ -42,6 +53,28 @@ def _build_tariff_lines() -> str:
     return "\n".join(lines)
 
 
+async def _edit_text_once(callback: CallbackQuery, text: str, **kwargs) -> None:
+    """Edit the callback's message, dropping repeat taps while an edit is pending.
+
+    Users mashing the same button would otherwise queue identical
+    edit_text calls against Telegram's per-bot rate limit.
+    """
+    key = (callback.message.chat.id, callback.message.message_id)
+    if key in _inflight_edits:
+        return
+    _inflight_edits.add(key)
+    try:
+        await callback.message.edit_text(text, **kwargs)
+    finally:
+        _inflight_edits.discard(key)
+
+
+@functools.lru_cache(maxsize=16384)
+def _fmt_date(d: date) -> str:
+    """Format a registration date; keyed per day, so the cache stays small."""
+    return d.strftime("%d.%m.%Y")
+
+
 # ─── /start ───
 
 @router.message(CommandStart())
@@ -52,12 +85,11 @@ async def cmd_start(message: Message, state: FSMContext):
     referred_by = None
     args = message.text.split(maxsplit=1)
     if len(args) > 1 and args[1].startswith("ref"):
-        try:
-            referred_by = int(args[1][3:])
-            if referred_by == message.from_user.id:
-                referred_by = None
-        except (ValueError, IndexError):
-            referred_by = None
+        payload = args[1][3:]
+        # Self-referral and malformed payloads are rejected before int()
+        if (payload and payload != str(message.from_user.id)
+                and payload.isascii() and payload.isdigit()):
+            referred_by = int(payload)
 
     existing_user = await db.get_user(message.from_user.id)
     is_new = existing_user is None
@@ -78,29 +110,29 @@ async def cmd_start(message: Message, state: FSMContext):
         try:
             referrer = await db.get_user(referred_by)
             if referrer:
-                new_balance = await db.update_user_credits(referred_by, 1)
-                await db.log_balance_transaction(
+                new_balance = await db.charge_and_log(
                     referred_by, 1, 'referral',
                     f'Реферал от {message.from_user.id}',
                 )
+                cache.invalidate_user(referred_by)
                 bot = message.bot
                 await bot.send_message(
                     referred_by,
                     REFERRAL_BONUS.format(balance=new_balance),
                     parse_mode="HTML",
                 )
-                logger.info(f"Referral bonus: +1 credit to {referred_by} from {message.from_user.id}")
+                logger.info("Referral bonus: +1 credit to %s from %s", referred_by, message.from_user.id)
         except Exception as e:
             if is_blocked_error(e):
                 await db.mark_user_blocked(referred_by)
-                logger.info(f"Referral: inviter {referred_by} blocked the bot")
+                logger.info("Referral: inviter %s blocked the bot", referred_by)
             else:
-                logger.error(f"Failed to send referral bonus notification: {e}")
+                logger.error("Failed to send referral bonus notification: %s", e)
 
     if is_new:
         text = WELCOME.format(free=config.free_credits_on_signup)
         if config.free_credits_on_signup > 0:
-            await db.log_balance_transaction(
+            db.balance_log.put_nowait(
                 message.from_user.id, config.free_credits_on_signup,
                 'signup_bonus', 'Бонус за регистрацию',
             )
@@ -117,7 +149,6 @@ async def cmd_start(message: Message, state: FSMContext):
 @router.message(F.text == BTN_CREATE)
 async def btn_create(message: Message, state: FSMContext):
     """Handle 'Создать песню' reply button."""
-    from app.handlers.generation import start_creation
     await start_creation(message, state)
 
 
@@ -129,7 +160,7 @@ async def btn_balance(message: Message):
 
 async def _show_balance(message, user_id: int):
     """Reusable helper to show balance page. Can be called from other modules."""
-    user = await db.get_user(user_id)
+    user = await cache.get_user(user_id)
     if not user:
         await message.answer("Используйте /start для начала.", reply_markup=main_reply_kb())
         return
@@ -149,21 +180,20 @@ async def _show_balance(message, user_id: int):
 @router.message(F.text == BTN_TRACKS)
 async def btn_tracks(message: Message):
     """Handle 'Мои треки' reply button."""
-    from app.handlers.generation import show_history
     await show_history(message)
 
 
 @router.message(F.text == BTN_HELP)
 async def btn_help(message: Message):
     """Handle 'Помощь' reply button."""
-    await message.answer(HELP, parse_mode="HTML")
+    await message.answer(**_HELP_PAYLOAD)
 
 
 # ─── Command shortcuts ───
 
 @router.message(Command("help"))
 async def cmd_help(message: Message):
-    await message.answer(HELP, parse_mode="HTML")
+    await message.answer(**_HELP_PAYLOAD)
 
 
 @router.message(Command("balance"))
@@ -173,7 +203,6 @@ async def cmd_balance(message: Message):
 
 @router.message(Command("history"))
 async def cmd_history(message: Message):
-    from app.handlers.generation import show_history
     await show_history(message)
 
 
@@ -184,7 +213,6 @@ async def cmd_buy(message: Message):
 
 @router.message(Command("create"))
 async def cmd_create(message: Message, state: FSMContext):
-    from app.handlers.generation import start_creation
     await start_creation(message, state)
 
 
@@ -193,7 +221,7 @@ async def cmd_create(message: Message, state: FSMContext):
 @router.callback_query(F.data == "back_balance")
 async def cb_back_balance(callback: CallbackQuery):
     """Back to balance page from Stars."""
-    user = await db.get_user(callback.from_user.id)
+    user = await cache.get_user(callback.from_user.id)
     if not user:
         await callback.answer("Используйте /start")
         return
@@ -204,22 +232,20 @@ async def cb_back_balance(callback: CallbackQuery):
         free_line=free_line,
         tariffs=_build_tariff_lines(),
     )
-    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=balance_kb())
+    await _edit_text_once(callback, text, parse_mode="HTML", reply_markup=balance_kb())
     await callback.answer()
 
 
 @router.callback_query(F.data == "buy_stars")
 async def cb_buy_stars(callback: CallbackQuery):
     """Show Telegram Stars payment options."""
-    await callback.message.edit_text(
-        BUY_STARS_HEADER, parse_mode="HTML", reply_markup=stars_kb()
-    )
+    await _edit_text_once(callback, **_BUY_STARS_PAYLOAD, reply_markup=stars_kb())
     await callback.answer()
 
 
 @router.callback_query(F.data == "help")
 async def cb_help(callback: CallbackQuery):
-    await callback.message.edit_text(HELP, parse_mode="HTML")
+    await _edit_text_once(callback, **_HELP_PAYLOAD)
     await callback.answer()
 
 
@@ -231,20 +257,18 @@ async def cb_noop(callback: CallbackQuery):
 
 @router.callback_query(F.data == "profile")
 async def cb_profile(callback: CallbackQuery):
-    user = await db.get_user(callback.from_user.id)
-    if not user:
+    profile = await db.get_profile(callback.from_user.id)
+    if not profile:
         await callback.answer("Используйте /start")
         return
-    gens = await db.get_user_generations(callback.from_user.id, limit=1000)
-    referrals = await db.count_referrals(callback.from_user.id)
     text = PROFILE.format(
-        credits=user["credits"],
-        free=user["free_generations_left"],
-        tracks=len(gens),
-        referrals=referrals,
-        since=user["created_at"].strftime("%d.%m.%Y"),
+        credits=profile["credits"],
+        free=profile["free_generations_left"],
+        tracks=profile["tracks"],
+        referrals=profile["referrals"],
+        since=_fmt_date(profile["created_at"].date()),
     )
-    await callback.message.edit_text(text, parse_mode="HTML")
+    await _edit_text_once(callback, text, parse_mode="HTML")
     await callback.answer()
 
 
@@ -253,13 +277,10 @@ async def cb_profile(callback: CallbackQuery):
 @router.callback_query(F.data == "invite")
 async def cb_invite(callback: CallbackQuery):
     """Send instructions + shareable message with bot link for forwarding."""
-    bot_me = await callback.bot.get_me()
-    bot_link = f"https://t.me/{bot_me.username}?start=ref{callback.from_user.id}"
+    # bot_username is resolved once via get_me() in on_startup
+    bot_link = f"https://t.me/{config.bot_username}?start=ref{callback.from_user.id}"
 
-    await callback.message.answer(
-        INVITE_INSTRUCTIONS,
-        parse_mode="HTML",
-    )
+    await callback.message.answer(**_INVITE_INSTRUCTIONS_PAYLOAD)
 
     text = INVITE.format(bot_link=bot_link)
     await callback.message.answer(
@@ -280,7 +301,7 @@ async def on_my_chat_member(update: ChatMemberUpdated):
 
     if new_status in ("kicked", "left"):
         await db.mark_user_blocked(user_id)
-        logger.info(f"User {user_id} blocked the bot (my_chat_member: {new_status})")
+        logger.info("User %s blocked the bot (my_chat_member: %s)", user_id, new_status)
     elif new_status == "member":
         await db.mark_user_unblocked(user_id)
-        logger.info(f"User {user_id} unblocked the bot (my_chat_member: {new_status})")
+        logger.info("User %s unblocked the bot (my_chat_member: %s)", user_id, new_status)
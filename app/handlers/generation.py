@@ -1,41 +1,56 @@
 """Music generation flow handlers."""
 
 import asyncio
+import functools
 import json
 import logging
+import re
+from datetime import datetime, timedelta
 from io import BytesIO
+from typing import NamedTuple
 
-import httpx
-from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, BufferedInputFile, URLInputFile
+from aiogram import Bot, Router, F
+from aiogram.enums import ChatType
+from aiogram.types import (
+    Message, CallbackQuery, BufferedInputFile, URLInputFile, Chat,
+    InlineKeyboardButton, InlineKeyboardMarkup, InputMediaAudio,
+)
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 
+from app import cache
 from app import database as db
+from app.callback_data import CallbackAction
 from app.config import config
-from html import escape as html_escape
+from html import escape as html_escape, unescape as html_unescape
 
 from app.keyboards import (
-    mode_kb, gender_kb, style_kb, track_kb, history_track_kb, after_generation_kb,
-    preview_track_kb, preview_after_generation_kb,
+    mode_kb, gender_kb, style_kb, track_kb, history_downloads_kb, after_generation_kb,
+    preview_after_generation_kb,
     main_reply_kb, greeting_recipient_kb, greeting_occasion_kb, greeting_mood_kb,
     lyrics_review_kb, lyrics_confirm_kb,
-    STYLES, GREETING_RECIPIENTS, GREETING_OCCASION_LABELS, GREETING_MOOD_LABELS,
+    STYLE_LABELS, GREETING_RECIPIENT_LABELS, GREETING_OCCASION_LABELS, GREETING_MOOD_LABELS,
     stories_vibe_kb, stories_mood_kb, stories_name_kb,
     STORIES_VIBE_LABELS, STORIES_MOOD_LABELS,
 )
 from app.states import GenerationStates
-from app.suno_api import get_suno_client, SunoApiError, ContentPolicyError
-from app.audio_preview import create_preview
+from app.suno_api import get_suno_client, SunoApiError, ContentPolicyError, Track
+from app.http_client import audio_cache, fetch_audio
+from app.handlers.callback import request_videos
+from app.delivery import deliver_paid_track, deliver_preview_track, remember_file_id
+from app.gpt_compress import compress_prompt
 from app.accent import apply_stress_accents
+from app.tasks import spawn
 from app.texts import (
     CHOOSE_MODE, CHOOSE_GENDER, CHOOSE_STYLE,
     ENTER_PROMPT, ENTER_LYRICS, ENTER_CUSTOM_STYLE,
-    GENERATING, GENERATION_COMPLETE, GENERATION_ERROR,
+    GENERATING, GENERATING_FROM_LYRICS, GENERATING_FROM_TEXT,
+    GENERATION_COMPLETE, GENERATION_ERROR,
     CONTENT_VIOLATION, NO_CREDITS, BLOCKED,
     RATE_LIMIT_USER, RATE_LIMIT_GLOBAL,
-    HISTORY_EMPTY, HISTORY_HEADER, DOWNLOAD_SUCCESS, DOWNLOAD_NO_CREDITS,
+    HISTORY_EMPTY, HISTORY_HEADER,
     RATING_THANKS,
-    PREVIEW_CAPTION, PREVIEW_GENERATION_COMPLETE,
+    PREVIEW_GENERATION_COMPLETE,
     UNLOCK_SUCCESS, UNLOCK_NO_CREDITS, UNLOCK_ALREADY,
     GREETING_CHOOSE_RECIPIENT, GREETING_ENTER_NAME,
     GREETING_ENTER_CUSTOM_RECIPIENT,
@@ -52,45 +67,112 @@ router = Router()
 logger = logging.getLogger(__name__)
 
 
+def _dumps(obj) -> str:
+    """Serialize wizard inputs to JSON text, keeping Cyrillic unescaped."""
+    return json.dumps(obj, ensure_ascii=False)
+
+
+_ALERT_LIMIT = 200  # Telegram caps callback alert text at 200 chars
+_TAG_RE = re.compile(r"<[^>]+>")
+
+
+async def _reply_error(event: Message | CallbackQuery, text: str):
+    """Report an error in as few API calls as possible.
+
+    For a button press a short error goes into a single alert popup (tags
+    stripped, alerts are plain text); longer ones fall back to a chat message.
+    """
+    if isinstance(event, CallbackQuery):
+        plain = html_unescape(_TAG_RE.sub("", text))
+        if len(plain) <= _ALERT_LIMIT:
+            await event.answer(plain, show_alert=True)
+            return
+        await event.message.answer(text, parse_mode="HTML")
+        await event.answer()
+    else:
+        await event.answer(text, parse_mode="HTML")
+
+
+# ─── Rendered texts ───
+# Their arguments come from a small set of values, so each rendering is reused.
+# The daily limit can be changed from the admin panel, hence keyed on it too.
+
+@functools.lru_cache(maxsize=64)
+def _no_credits_text(credits: int) -> str:
+    return NO_CREDITS.format(credits=credits)
+
+
+@functools.lru_cache(maxsize=8)
+def _rate_limit_user_text(limit: int) -> str:
+    return RATE_LIMIT_USER.format(limit=limit)
+
+
+@functools.lru_cache(maxsize=16)
+def _content_violation_text(count: int) -> str:
+    return CONTENT_VIOLATION.format(count=count)
+
+
 # ─── Rate limit checks ───
 
-async def check_limits(user_id: int) -> str | None:
-    """Returns error message if rate limited, None if OK."""
-    user = await db.get_user(user_id)
+async def check_eligibility(user_id: int) -> tuple[str | None, bool, dict | None]:
+    """Rate limits and credits from one user read. Returns (error, has_credits, user).
+
+    ``error`` is a ready-to-send message if the user is blocked or rate limited.
+    """
+    user = await cache.get_user(user_id)
     if not user:
-        return "Используйте /start"
+        return "Используйте /start", False, None
     if user["is_blocked"]:
-        return BLOCKED
+        return BLOCKED, False, user
 
-    today_count = await db.count_user_generations_today(user_id)
+    has_credits = _has_credits(user_id, user)
+    # Nothing to spend — the caller reports NO_CREDITS anyway,
+    # so skip the aggregate queries
+    if user["credits"] <= 0 and user["free_generations_left"] <= 0:
+        return None, has_credits, user
+
+    # Independent aggregates — run them on two pool connections at once
+    today_count, hour_count = await asyncio.gather(
+        cache.count_user_generations_today(user_id),
+        cache.count_generations_last_hour(),
+    )
     if today_count >= config.max_generations_per_user_per_day:
-        return RATE_LIMIT_USER.format(limit=config.max_generations_per_user_per_day)
+        return _rate_limit_user_text(config.max_generations_per_user_per_day), has_credits, user
 
-    hour_count = await db.count_generations_last_hour()
     if hour_count >= config.max_generations_per_hour:
-        return RATE_LIMIT_GLOBAL
+        return RATE_LIMIT_GLOBAL, has_credits, user
 
-    return None
+    return None, has_credits, user
 
 
 async def check_credits(user_id: int) -> tuple[bool, dict]:
-    """Check if user has credits (paid or free). Returns (has_credits, user)."""
-    from datetime import datetime, timedelta
+    """Check if user has credits (paid or free). Returns (has_credits, user).
+
+    Last check before a paid Suno job starts, so it reads the DB directly
+    rather than the few-seconds-old cache.
+    """
     user = await db.get_user(user_id)
+    return _has_credits(user_id, user), user
 
-    has_free = user["free_generations_left"] > 0
-    if has_free and config.min_account_age_hours > 0:
-        account_age = datetime.now() - user["created_at"]
-        min_age = timedelta(hours=config.min_account_age_hours)
-        if account_age < min_age:
-            has_free = False
 
-    if has_free and config.min_telegram_user_id > 0:
-        if user_id > config.min_telegram_user_id:
-            has_free = False
+# Anti-abuse limits on free generations; env-only (the admin panel just
+# displays them), so they're fixed for the process lifetime
+_MIN_ACCOUNT_AGE = (
+    timedelta(hours=config.min_account_age_hours) if config.min_account_age_hours > 0 else None
+)
+_MAX_FREE_TG_ID = config.min_telegram_user_id or None
 
-    has = (user["credits"] > 0 or has_free)
-    return has, user
+
+def _has_credits(user_id: int, user: dict) -> bool:
+    if user["credits"] > 0:
+        return True
+    if user["free_generations_left"] <= 0:
+        return False
+    if _MAX_FREE_TG_ID and user_id > _MAX_FREE_TG_ID:
+        return False
+    if _MIN_ACCOUNT_AGE and datetime.now() - user["created_at"] < _MIN_ACCOUNT_AGE:
+        return False
+    return True
 
 
 # ─── Start creation flow ───
@@ -99,26 +181,14 @@ async def start_creation(message_or_cb, state: FSMContext):
     """Entry point for creation flow — shows mode selection (idea / lyrics)."""
     user_id = message_or_cb.from_user.id
 
-    # Rate limits
-    error = await check_limits(user_id)
+    # Rate limits + credits
+    error, has_credits, user = await check_eligibility(user_id)
     if error:
-        if isinstance(message_or_cb, CallbackQuery):
-            await message_or_cb.message.answer(error, parse_mode="HTML")
-            await message_or_cb.answer()
-        else:
-            await message_or_cb.answer(error, parse_mode="HTML")
+        await _reply_error(message_or_cb, error)
         return
-
-    # Credits check
-    has_credits, user = await check_credits(user_id)
     if not has_credits:
         total = user["credits"] + user["free_generations_left"]
-        text = NO_CREDITS.format(credits=total)
-        if isinstance(message_or_cb, CallbackQuery):
-            await message_or_cb.message.answer(text, parse_mode="HTML")
-            await message_or_cb.answer()
-        else:
-            await message_or_cb.answer(text, parse_mode="HTML")
+        await _reply_error(message_or_cb, _no_credits_text(total))
         return
 
     # Show mode selection (idea / lyrics)
@@ -137,9 +207,8 @@ async def cb_create(callback: CallbackQuery, state: FSMContext):
 
 # ─── Mode selection (idea / lyrics) ───
 
-@router.callback_query(F.data.startswith("mode:"))
-async def cb_mode(callback: CallbackQuery, state: FSMContext):
-    mode = callback.data.split(":")[1]
+async def cb_mode(callback: CallbackQuery, state: FSMContext, cb: CallbackAction):
+    mode = cb.value
 
     # Map mode to feedback text
     mode_feedback = {
@@ -176,9 +245,8 @@ async def cb_back_mode(callback: CallbackQuery, state: FSMContext):
 
 # ─── Gender selection ───
 
-@router.callback_query(F.data.startswith("gender:"))
-async def cb_gender(callback: CallbackQuery, state: FSMContext):
-    gender = callback.data.split(":")[1]
+async def cb_gender(callback: CallbackQuery, state: FSMContext, cb: CallbackAction):
+    gender = cb.value
     await state.update_data(voice_gender=gender)
     gender_label = "🚹 Мужской" if gender == "male" else "🚺 Женский"
     await callback.message.edit_text(f"✅ Голос: {gender_label}")
@@ -196,9 +264,8 @@ async def cb_back_gender(callback: CallbackQuery, state: FSMContext):
 
 # ─── Style selection ───
 
-@router.callback_query(F.data.startswith("style:"))
-async def cb_style(callback: CallbackQuery, state: FSMContext):
-    style = callback.data.split(":", 1)[1]
+async def cb_style(callback: CallbackQuery, state: FSMContext, cb: CallbackAction):
+    style = cb.value
 
     if style == "custom_style":
         await state.set_state(GenerationStates.entering_custom_style)
@@ -206,16 +273,9 @@ async def cb_style(callback: CallbackQuery, state: FSMContext):
         await callback.answer()
         return
 
-    await state.update_data(style=style)
-    data = await state.get_data()
+    data = await state.update_data(style=style)
 
-    # Find human-readable style label
-    style_label = style
-    for label, code in STYLES:
-        if code == style:
-            style_label = label
-            break
-    await callback.message.edit_text(f"✅ Стиль: {style_label}")
+    await callback.message.edit_text(f"✅ Стиль: {STYLE_LABELS[style]}")
 
     # Greeting mode: branch into greeting wizard
     if data.get("mode") == "greeting":
@@ -248,9 +308,7 @@ async def cb_style(callback: CallbackQuery, state: FSMContext):
 async def on_custom_style(message: Message, state: FSMContext):
     full_style = message.text.strip()
     custom_style = full_style[:90]
-    await state.update_data(style=custom_style, style_raw=full_style)
-    data = await state.get_data()
-    await state.set_state(GenerationStates.entering_prompt)
+    data = await state.update_data(style=custom_style, style_raw=full_style)
 
     # Greeting mode: branch into greeting wizard
     if data.get("mode") == "greeting":
@@ -270,6 +328,7 @@ async def on_custom_style(message: Message, state: FSMContext):
         )
         return
 
+    await state.set_state(GenerationStates.entering_prompt)
     # Show mode-appropriate prompt
     text = ENTER_LYRICS if data.get("mode") == "lyrics" else ENTER_PROMPT
     await message.answer(text, parse_mode="HTML")
@@ -284,36 +343,30 @@ async def on_prompt(message: Message, state: FSMContext):
     full_text = message.text.strip()
 
     # Store full text before truncation
-    raw_input = json.dumps({
+    raw_input = _dumps({
         "text": full_text,
         "style_raw": data.get("style_raw", data.get("style", "")),
-    }, ensure_ascii=False)
+    })
 
     # No truncation — GPT compression handles the 200-char lyrics API limit
     text = full_text
 
-    await state.update_data(prompt=text, user_mode=mode, raw_input=raw_input)
-    await do_generate(message, state)
+    data.update(prompt=text, user_mode=mode, raw_input=raw_input)
+    await state.set_data(data)
+    await do_generate(message, state, data=data)
 
 
 # ─── Greeting wizard handlers ───
 
 # Step 1: Recipient
-@router.callback_query(F.data.startswith("gr_rcpt:"))
-async def cb_greeting_recipient(callback: CallbackQuery, state: FSMContext):
-    value = callback.data.split(":", 1)[1]
+async def cb_greeting_recipient(callback: CallbackQuery, state: FSMContext, cb: CallbackAction):
+    value = cb.value
     if value == "custom":
         await state.set_state(GenerationStates.greeting_recipient)
         await callback.message.edit_text(GREETING_ENTER_CUSTOM_RECIPIENT, parse_mode="HTML")
         await callback.answer()
         return
-    # Find human-readable recipient label
-    rcpt_label = value
-    for label, code in GREETING_RECIPIENTS:
-        if code == value:
-            rcpt_label = label
-            break
-    await callback.message.edit_text(f"✅ Кому: {rcpt_label}")
+    await callback.message.edit_text(f"✅ Кому: {GREETING_RECIPIENT_LABELS[value]}")
     await state.update_data(gr_recipient=value)
     await state.set_state(GenerationStates.greeting_name)
     await callback.message.answer(GREETING_ENTER_NAME, parse_mode="HTML")
@@ -350,16 +403,15 @@ async def cb_back_gr_name(callback: CallbackQuery, state: FSMContext):
 
 
 # Step 3: Occasion
-@router.callback_query(F.data.startswith("gr_occ:"))
-async def cb_greeting_occasion(callback: CallbackQuery, state: FSMContext):
-    value = callback.data.split(":", 1)[1]
+async def cb_greeting_occasion(callback: CallbackQuery, state: FSMContext, cb: CallbackAction):
+    value = cb.value
     if value == "custom":
         await state.set_state(GenerationStates.greeting_occasion)
         await callback.message.edit_text(GREETING_ENTER_CUSTOM_OCCASION, parse_mode="HTML")
         await callback.answer()
         return
     # Resolve short ID to display label
-    label = GREETING_OCCASION_LABELS.get(value, value)
+    label = GREETING_OCCASION_LABELS[value]
     await callback.message.edit_text(f"✅ Повод: {label}")
     await state.update_data(gr_occasion=label)
     await state.set_state(GenerationStates.greeting_mood)
@@ -394,11 +446,10 @@ async def cb_back_gr_occasion(callback: CallbackQuery, state: FSMContext):
 
 
 # Step 4: Mood
-@router.callback_query(F.data.startswith("gr_mood:"))
-async def cb_greeting_mood(callback: CallbackQuery, state: FSMContext):
-    value = callback.data.split(":", 1)[1]
+async def cb_greeting_mood(callback: CallbackQuery, state: FSMContext, cb: CallbackAction):
+    value = cb.value
     # Resolve short ID to display label
-    label = GREETING_MOOD_LABELS.get(value, value)
+    label = GREETING_MOOD_LABELS[value]
     await callback.message.edit_text(f"✅ Настроение: {label}")
     await state.update_data(gr_mood=label)
     await state.set_state(GenerationStates.greeting_details)
@@ -411,42 +462,40 @@ async def cb_greeting_mood(callback: CallbackQuery, state: FSMContext):
 async def on_greeting_details(message: Message, state: FSMContext):
     full_details = message.text.strip()
     details = full_details
-    await state.update_data(gr_details=details)
 
     # Assemble the greeting prompt
     data = await state.get_data()
+    data["gr_details"] = details
     recipient = data.get("gr_recipient", "")
     name = data.get("gr_name", "")
     occasion = data.get("gr_occasion", "")
     mood = data.get("gr_mood", "")
 
     # Natural format for Suno — no "Повод:", "Настроение:" labels
-    prompt_parts = [f"поздравление для {recipient}"]
-    if name:
-        prompt_parts[0] = f"поздравление {recipient} {name}"
-    if occasion:
-        prompt_parts.append(f"с {occasion}" if not occasion.startswith("с ") else occasion)
-    if mood:
-        prompt_parts.append(mood)
-    assembled = ", ".join(prompt_parts)
+    assembled = ", ".join(filter(None, (
+        f"поздравление {recipient} {name}" if name else f"поздравление для {recipient}",
+        occasion if not occasion or occasion.startswith("с ") else f"с {occasion}",
+        mood,
+    )))
     if details:
         assembled += f". {details}"
 
     # Preserve original mode and raw wizard inputs (full text before truncation)
-    raw_input = json.dumps({
+    raw_input = _dumps({
         "recipient": data.get("gr_recipient_raw", recipient),
         "name": data.get("gr_name_raw", name),
         "occasion": data.get("gr_occasion_raw", occasion),
         "mood": mood,
         "details": full_details,
         "style_raw": data.get("style_raw", data.get("style", "")),
-    }, ensure_ascii=False)
+    })
 
-    await state.update_data(
+    data.update(
         prompt=assembled, mode="description",
         user_mode="greeting", raw_input=raw_input,
     )
-    await do_generate(message, state)
+    await state.set_data(data)
+    await do_generate(message, state, data=data)
 
 
 # Back to style (from greeting recipient)
@@ -463,15 +512,14 @@ async def cb_back_style(callback: CallbackQuery, state: FSMContext):
 # ─── Stories wizard handlers ───
 
 # Step 1: Vibe / Role
-@router.callback_query(F.data.startswith("st_vibe:"))
-async def cb_stories_vibe(callback: CallbackQuery, state: FSMContext):
-    value = callback.data.split(":", 1)[1]
+async def cb_stories_vibe(callback: CallbackQuery, state: FSMContext, cb: CallbackAction):
+    value = cb.value
     if value == "custom":
         await state.set_state(GenerationStates.stories_vibe)
         await callback.message.edit_text(STORIES_ENTER_CUSTOM_VIBE, parse_mode="HTML")
         await callback.answer()
         return
-    label = STORIES_VIBE_LABELS.get(value, value)
+    label = STORIES_VIBE_LABELS[value]
     await callback.message.edit_text(f"✅ Вайб: {label}")
     await state.update_data(st_vibe=label)
     await state.set_state(GenerationStates.stories_mood)
@@ -506,10 +554,9 @@ async def cb_back_st_vibe(callback: CallbackQuery, state: FSMContext):
 
 
 # Step 2: Mood
-@router.callback_query(F.data.startswith("st_mood:"))
-async def cb_stories_mood(callback: CallbackQuery, state: FSMContext):
-    value = callback.data.split(":", 1)[1]
-    label = STORIES_MOOD_LABELS.get(value, value)
+async def cb_stories_mood(callback: CallbackQuery, state: FSMContext, cb: CallbackAction):
+    value = cb.value
+    label = STORIES_MOOD_LABELS[value]
     await callback.message.edit_text(f"✅ Атмосфера: {label}")
     await state.update_data(st_mood=label)
     await state.set_state(GenerationStates.stories_context)
@@ -541,60 +588,65 @@ async def cb_back_st_context(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "st_name:skip")
 async def cb_stories_name_skip(callback: CallbackQuery, state: FSMContext):
     """Skip name → assemble prompt and generate."""
-    await state.update_data(st_name="")
+    data = await state.update_data(st_name="")
     await callback.message.edit_text("✅ Имя: пропущено")
     await callback.answer()
     # callback.message is the bot's message, so we pass user_id explicitly
-    await _assemble_stories_prompt(callback.message, state, user_id=callback.from_user.id)
+    await _assemble_stories_prompt(callback.message, state, data, user_id=callback.from_user.id)
 
 
 @router.message(GenerationStates.stories_name)
 async def on_stories_name(message: Message, state: FSMContext):
     full = message.text.strip()
-    await state.update_data(st_name=full[:40], st_name_raw=full)
-    await _assemble_stories_prompt(message, state)
+    data = await state.update_data(st_name=full[:40], st_name_raw=full)
+    await _assemble_stories_prompt(message, state, data)
 
 
-async def _assemble_stories_prompt(message: Message, state: FSMContext, user_id: int | None = None):
-    """Assemble the stories prompt from collected data and start generation."""
-    data = await state.get_data()
+async def _assemble_stories_prompt(
+    message: Message, state: FSMContext, data: dict, user_id: int | None = None,
+):
+    """Assemble the stories prompt from the FSM data just written and start generation."""
     vibe = data.get("st_vibe", "")
     mood = data.get("st_mood", "")
     context = data.get("st_context", "")
     name = data.get("st_name", "")
 
     # Natural format for Suno — concise, no labels
-    prompt_parts = ["короткая песня для сторис, один куплет и припев, от первого лица"]
-    if vibe:
-        prompt_parts.append(vibe)
-    if mood:
-        prompt_parts.append(mood)
-    if context:
-        prompt_parts.append(context)
-    if name:
-        prompt_parts.append(f"имя: {name}")
-
-    assembled = ", ".join(prompt_parts)
+    assembled = ", ".join(filter(None, (
+        "короткая песня для сторис, один куплет и припев, от первого лица",
+        vibe,
+        mood,
+        context,
+        f"имя: {name}" if name else "",
+    )))
 
     # Preserve original mode and raw wizard inputs (full text before truncation)
-    raw_input = json.dumps({
+    raw_input = _dumps({
         "vibe": data.get("st_vibe_raw", vibe),
         "mood": mood,
         "context": data.get("st_context_raw", context),
         "name": data.get("st_name_raw", name),
         "style_raw": data.get("style_raw", data.get("style", "")),
-    }, ensure_ascii=False)
+    })
 
-    await state.update_data(
+    data.update(
         prompt=assembled, mode="description",
         user_mode="stories", raw_input=raw_input,
     )
-    await do_generate(message, state, user_id=user_id)
+    await state.set_data(data)
+    await do_generate(message, state, user_id=user_id, data=data)
 
 
-async def do_generate(message: Message, state: FSMContext, user_id: int | None = None):
-    """Entry point after all inputs collected. Routes to lyrics preview or direct custom."""
-    data = await state.get_data()
+async def do_generate(
+    message: Message, state: FSMContext,
+    user_id: int | None = None, data: dict | None = None,
+):
+    """Entry point after all inputs collected. Routes to lyrics preview or direct custom.
+
+    Callers that just wrote the FSM data pass it as ``data`` to skip a re-read.
+    """
+    if data is None:
+        data = await state.get_data()
     if user_id is None:
         user_id = message.from_user.id
     mode = data.get("mode", "description")
@@ -603,7 +655,7 @@ async def do_generate(message: Message, state: FSMContext, user_id: int | None =
     has_credits, user = await check_credits(user_id)
     if not has_credits:
         await message.answer(
-            NO_CREDITS.format(credits=user["credits"]),
+            _no_credits_text(user["credits"]),
             parse_mode="HTML",
         )
         await state.clear()
@@ -611,15 +663,26 @@ async def do_generate(message: Message, state: FSMContext, user_id: int | None =
 
     if mode == "lyrics":
         # User already wrote lyrics — go straight to music generation
-        await do_generate_music(message, state, user_id=user_id)
+        await do_generate_music(message, state, user_id=user_id, data=data)
     else:
         # All other modes: generate lyrics first, show preview
-        await do_generate_lyrics(message, state, user_id=user_id)
+        await do_generate_lyrics(message, state, user_id=user_id, data=data)
 
 
-async def do_generate_lyrics(message: Message, state: FSMContext, user_id: int | None = None):
+def _lyrics_prompt(prompt: str) -> str:
+    """Prefix the user's idea with the language hint for the Lyrics API."""
+    if config.russian_language_prefix:
+        return f"песня на русском языке. {prompt}"
+    return prompt
+
+
+async def do_generate_lyrics(
+    message: Message, state: FSMContext,
+    user_id: int | None = None, data: dict | None = None,
+):
     """Step 1: Generate lyrics via Lyrics API and show for user review."""
-    data = await state.get_data()
+    if data is None:
+        data = await state.get_data()
     if user_id is None:
         user_id = message.from_user.id
     prompt = data.get("prompt", "")
@@ -634,34 +697,31 @@ async def do_generate_lyrics(message: Message, state: FSMContext, user_id: int |
     )
 
     # Build lyrics prompt with language context
-    lyrics_prompt_parts = []
-    if config.russian_language_prefix:
-        lyrics_prompt_parts.append("песня на русском языке")
-    lyrics_prompt_parts.append(prompt)
-    lyrics_prompt = ". ".join(lyrics_prompt_parts)
+    lyrics_prompt = _lyrics_prompt(prompt)
 
     # Lyrics API has a 200 character limit on prompt
     original_lyrics_prompt = lyrics_prompt
     if len(lyrics_prompt) > 200:
-        from app.gpt_compress import compress_prompt
         compressed = await compress_prompt(lyrics_prompt, limit=200)
         if compressed:
             lyrics_prompt = compressed
-            logger.info(f"Prompt compressed by GPT: {len(original_lyrics_prompt)} -> {len(lyrics_prompt)}")
+            logger.info("Prompt compressed by GPT: %s -> %s", len(original_lyrics_prompt), len(lyrics_prompt))
         else:
             lyrics_prompt = lyrics_prompt[:200]
-            logger.info(f"GPT compression failed, truncated to 200 chars")
-    await state.update_data(lyrics_prompt_sent=lyrics_prompt, lyrics_prompt_original=original_lyrics_prompt)
+            logger.info("GPT compression failed, truncated to 200 chars")
 
     try:
         client = get_suno_client()
         lyrics_result = await client.generate_lyrics(lyrics_prompt)
         lyrics_data = await client.wait_for_lyrics(lyrics_result["task_id"])
 
-        # Save lyrics + title in state for later use
+        # Save lyrics + title in state for later use, along with the prompt
+        # that produced them (one storage write; on failure the state is cleared)
         await state.update_data(
             generated_lyrics=lyrics_data["text"],
             generated_title=lyrics_data["title"],
+            lyrics_prompt_sent=lyrics_prompt,
+            lyrics_prompt_original=original_lyrics_prompt,
         )
         await state.set_state(GenerationStates.reviewing_lyrics)
 
@@ -692,9 +752,10 @@ async def do_generate_lyrics(message: Message, state: FSMContext, user_id: int |
 
     except ContentPolicyError:
         count = await db.increment_content_violations(user_id)
+        cache.invalidate_user(user_id)
         try:
             await status_msg.edit_text(
-                CONTENT_VIOLATION.format(count=count),
+                _content_violation_text(count),
                 parse_mode="HTML",
             )
         except Exception:
@@ -702,7 +763,7 @@ async def do_generate_lyrics(message: Message, state: FSMContext, user_id: int |
         await state.clear()
 
     except SunoApiError as e:
-        logger.error(f"Lyrics API error: {e}")
+        logger.error("Lyrics API error: %s", e)
         try:
             await status_msg.edit_text(LYRICS_GENERATION_ERROR, parse_mode="HTML")
         except Exception:
@@ -710,7 +771,7 @@ async def do_generate_lyrics(message: Message, state: FSMContext, user_id: int |
         await state.clear()
 
     except Exception as e:
-        logger.error(f"Unexpected error in lyrics generation: {e}", exc_info=True)
+        logger.error("Unexpected error in lyrics generation: %s", e, exc_info=True)
         try:
             await status_msg.edit_text(LYRICS_GENERATION_ERROR, parse_mode="HTML")
         except Exception:
@@ -769,14 +830,14 @@ async def on_edited_lyrics(message: Message, state: FSMContext):
 
     data = await state.get_data()
     # Save original lyrics before overwriting
-    await state.update_data(
+    data.update(
         _original_lyrics=data.get("generated_lyrics", ""),
         generated_lyrics=edited,
         _lyrics_was_edited=True,
     )
+    await state.set_data(data)
 
     # Validation warnings
-    import re
     has_tags = bool(re.search(r'\[(?:Verse|Chorus|Bridge|Hook|Outro|Intro|Pre-Chorus|Refrain)\]', edited, re.IGNORECASE))
     warnings = []
 
@@ -795,7 +856,7 @@ async def on_edited_lyrics(message: Message, state: FSMContext):
         return
 
     # No warnings — proceed directly
-    await do_generate_music(message, state)
+    await do_generate_music(message, state, data=data)
 
 
 @router.callback_query(F.data == "lyrics:confirm_edited")
@@ -826,9 +887,13 @@ async def cb_lyrics_re_edit(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-async def do_generate_music(message: Message, state: FSMContext, user_id: int | None = None):
+async def do_generate_music(
+    message: Message, state: FSMContext,
+    user_id: int | None = None, data: dict | None = None,
+):
     """Step 2: Generate music using custom mode with lyrics from state."""
-    data = await state.get_data()
+    if data is None:
+        data = await state.get_data()
     if user_id is None:
         user_id = message.from_user.id
     mode = data.get("mode", "description")
@@ -838,19 +903,8 @@ async def do_generate_music(message: Message, state: FSMContext, user_id: int |
 
     await state.set_state(GenerationStates.generating)
 
-    if mode == "lyrics":
-        status_text = (
-            "🎵 Отлично! Создаю музыку по твоим стихам...\n"
-            "Мне нужно несколько минут."
-        )
-    else:
-        status_text = (
-            "🎵 Отлично! Создаю музыку по тексту...\n"
-            "Мне нужно 1-2 минуты."
-        )
-
     status_msg = await message.answer(
-        status_text,
+        GENERATING_FROM_LYRICS if mode == "lyrics" else GENERATING_FROM_TEXT,
         parse_mode="HTML",
         reply_markup=main_reply_kb(),
     )
@@ -864,15 +918,6 @@ async def do_generate_music(message: Message, state: FSMContext, user_id: int |
     if data.get("_lyrics_was_edited"):
         edited_lyrics_text = original_lyrics  # current value is the edited version
 
-    # Apply stress accents to lyrics before sending to Suno
-    if mode == "lyrics":
-        lyrics_for_suno = prompt
-    else:
-        lyrics_for_suno = data.get("generated_lyrics", "")
-
-    accented_text = await asyncio.to_thread(apply_stress_accents, lyrics_for_suno)
-    logger.info(f"Accent applied to lyrics, length: {len(lyrics_for_suno)} -> {len(accented_text)}")
-
     # Enrich raw_input with lyrics prompt before/after GPT compression
     raw_input_str = data.get("raw_input")
     lyrics_prompt_original = data.get("lyrics_prompt_original")
@@ -886,10 +931,9 @@ async def do_generate_music(message: Message, state: FSMContext, user_id: int |
         raw_data["lyrics_prompt_sent"] = lyrics_prompt_sent
         if lyrics_prompt_original != lyrics_prompt_sent:
             raw_data["gpt_compressed"] = True
-        raw_input_str = json.dumps(raw_data, ensure_ascii=False)
+        raw_input_str = _dumps(raw_data)
 
-    gen_id = await db.create_generation(
-        user_id=user_id,
+    await _run_generation(message, state, user_id, status_msg, dict(
         prompt=prompt,
         style=style,
         voice_gender=voice_gender,
@@ -899,87 +943,223 @@ async def do_generate_music(message: Message, state: FSMContext, user_id: int |
         generated_lyrics=data.get("_original_lyrics") or original_lyrics,
         edited_lyrics=edited_lyrics_text,
         generated_title=generated_title,
-        accented_lyrics=accented_text,
-    )
+    ), lyrics=prompt if mode == "lyrics" else data.get("generated_lyrics", ""))
+
 
+async def _run_generation(
+    message: Message, state: FSMContext, user_id: int, status_msg: Message,
+    fields: dict, lyrics: str | None, regen: bool = False,
+):
+    """Submit a generation to Suno, record it and hand it off for delivery.
+
+    ``fields`` are create_generation's keyword arguments. ``lyrics`` get
+    stress accents applied before going to Suno; without them new lyrics
+    are written from the prompt first.
+    """
+    gen_id = None
     try:
         client = get_suno_client()
 
-        if mode == "lyrics":
-            # User's own lyrics — use accented version
-            result = await client.generate(
-                prompt=accented_text,
-                style=style,
-                voice_gender=voice_gender,
-                mode="custom",
-                lyrics=accented_text,
-                instrumental=False,
-            )
+        if not lyrics:
+            lyrics_result = await client.generate_lyrics(_lyrics_prompt(fields["prompt"]))
+            lyrics_data = await client.wait_for_lyrics(lyrics_result["task_id"])
+            lyrics = lyrics_data["text"]
+            fields = {
+                **fields,
+                "generated_lyrics": lyrics,
+                "generated_title": lyrics_data["title"],
+            }
+
+        accented = await asyncio.to_thread(apply_stress_accents, lyrics)
+        logger.info("Accent applied to lyrics, length: %s -> %s", len(lyrics), len(accented))
+        fields = {**fields, "accented_lyrics": accented}
+
+        if fields["mode"] == "lyrics":
+            # User's own lyrics — the accented text doubles as the prompt
+            suno_prompt = fields["accented_lyrics"]
         else:
-            # Lyrics were generated (or edited) — use accented version
-            generated_title = data.get("generated_title", prompt[:80])
-
-            result = await client.generate(
-                prompt=generated_title,
-                style=style,
-                voice_gender=voice_gender,
-                mode="custom",
-                lyrics=accented_text,
-                instrumental=False,
-            )
+            suno_prompt = fields.get("generated_title") or fields["prompt"][:80]
+
+        result = await client.generate(
+            prompt=suno_prompt,
+            style=fields["style"],
+            voice_gender=fields["voice_gender"],
+            mode="custom",
+            lyrics=fields["accented_lyrics"],
+            instrumental=False,
+        )
 
         task_id = result["task_id"]
-        await db.update_generation_status(gen_id, "processing", suno_song_ids=[task_id])
+        # Submitted: insert the row already in "processing" with the task_id
+        # and the chat/status message to answer in (used by the Suno webhook,
+        # or by the poller after a restart), one round-trip instead of three
+        gen_id = await db.create_generation(
+            user_id=user_id,
+            **fields,
+            status="processing",
+            suno_song_ids=[task_id],
+            callback_chat_id=message.chat.id,
+            callback_message_id=status_msg.message_id,
+        )
+        cache.invalidate_user(user_id)
 
         if config.callback_base_url:
-            await db.update_generation_callback_info(
-                gen_id, message.chat.id, status_msg.message_id
+            logger.info(
+                "%s %s submitted with callback, task_id=%s",
+                "Regen" if regen else "Generation", gen_id, task_id,
             )
-            logger.info(f"Generation {gen_id} submitted with callback, task_id={task_id}")
-            await state.clear()
             return
 
-        songs = await client.wait_for_completion(task_id)
-
-        audio_urls = []
-        image_urls = []
-        song_titles = []
-        song_ids = []
-        for s in songs:
-            url = s.get("audioUrl") or s.get("streamAudioUrl", "")
-            audio_urls.append(url)
-            image_urls.append(s.get("imageUrl") or s.get("image_url", ""))
-            song_titles.append(s.get("title", f"AI Melody Track"))
-            song_ids.append(s.get("id", ""))
-
-        # Determine if this is a free generation (preview) or paid (full MP3)
-        is_free = user["free_generations_left"] > 0
-
-        if is_free:
-            await db.use_free_generation(user_id)
-            await db.log_balance_transaction(
-                user_id, -1, 'free_generation', f'Бесплатная генерация #{gen_id}',
-            )
-            credits_spent = 0
-        else:
-            await db.update_user_credits(user_id, -1)
-            await db.log_balance_transaction(
-                user_id, -1, 'generation', f'Генерация #{gen_id}',
-            )
-            credits_spent = 1
-
-        await db.update_last_generation(user_id)
-        await db.update_generation_status(
-            gen_id, "complete",
-            audio_urls=audio_urls,
-            credits_spent=credits_spent,
-            song_titles=song_titles,
-            suno_audio_ids=song_ids,
+        # Waiting for Suno takes minutes; hand it to the completion poller
+        await _enqueue_completion(message, user_id, gen_id, task_id, status_msg, regen=regen)
+
+    except Exception as e:
+        await _fail_generation(e, user_id, gen_id, status_msg)
+
+    finally:
+        await state.clear()
+
+
+# ─── Completion polling (no-callback mode) ───
+
+COMPLETION_POLL_INTERVAL = 10  # seconds between status rounds
+COMPLETION_TIMEOUT = 300  # seconds
+COMPLETION_POLL_CONCURRENCY = 8  # status requests in flight per round
+
+
+class PendingCompletion(NamedTuple):
+    message: Message
+    user_id: int
+    gen_id: int
+    status_msg: Message
+    regen: bool
+    deadline: float
+
+
+# task_id → generation waiting for Suno, checked by the shared poller.
+# Rebuilt from the generations table on startup (resume_pending_completions).
+_pending_completions: dict[str, PendingCompletion] = {}
+_poller: asyncio.Task | None = None
+
+
+def start_completion_poller():
+    """Start the loop that polls Suno for every pending generation (no-callback mode)."""
+    global _poller
+    if _poller is None:
+        _poller = asyncio.create_task(_completion_poller())
+        logger.info("Started generation completion poller")
+
+
+async def resume_pending_completions(bot: Bot):
+    """Queue generations that were still waiting for Suno when the bot stopped.
+
+    Their rows keep the task_id and the chat/status message, which is enough
+    to rebuild the messages the poller answers through.
+    """
+    deadline = asyncio.get_running_loop().time() + COMPLETION_TIMEOUT
+    gens = await db.get_resumable_generations()
+    for gen in gens:
+        status_msg = Message(
+            message_id=gen["callback_message_id"],
+            date=gen["created_at"],
+            chat=Chat(id=gen["callback_chat_id"], type=ChatType.PRIVATE),
+        ).as_(bot)
+        _pending_completions[gen["suno_song_ids"][0]] = PendingCompletion(
+            status_msg, gen["user_id"], gen["id"], status_msg, False, deadline,
         )
+    if gens:
+        logger.info("Resumed polling for %s pending generation(s)", len(gens))
+
+
+async def stop_completion_poller():
+    global _poller
+    if _poller is not None:
+        _poller.cancel()
+        await asyncio.gather(_poller, return_exceptions=True)
+        _poller = None
+
+
+async def _completion_poller():
+    """One status round for all pending generations every few seconds.
+
+    Waiting costs a dict entry instead of a sleeping task per generation;
+    finished ones are handed to a delivery task.
+    """
+    sem = asyncio.Semaphore(COMPLETION_POLL_CONCURRENCY)
+    loop = asyncio.get_running_loop()
 
-        # For paid generations, mark as unlocked immediately
-        if not is_free:
-            await db.unlock_generation(gen_id)
+    async def check(task_id: str, job: PendingCompletion):
+        async with sem:
+            try:
+                # Resolved per check: the admin model switch closes and
+                # replaces the shared client
+                client = get_suno_client()
+                songs = client.completed_songs(await client.get_task_status(task_id))
+                if songs is None and loop.time() > job.deadline:
+                    raise SunoApiError(f"Generation timeout after {COMPLETION_TIMEOUT}s for task {task_id}")
+            except Exception as e:
+                del _pending_completions[task_id]
+                spawn(_fail_generation(e, job.user_id, job.gen_id, job.status_msg))
+                return
+        if songs is not None:
+            del _pending_completions[task_id]
+            spawn(_finish_generation(
+                job.message, job.user_id, job.gen_id, task_id, job.status_msg, job.regen, songs,
+            ))
+
+    while True:
+        await asyncio.sleep(COMPLETION_POLL_INTERVAL)
+        if _pending_completions:
+            await asyncio.gather(*(
+                check(task_id, job) for task_id, job in list(_pending_completions.items())
+            ))
+
+
+async def _enqueue_completion(
+    message: Message, user_id: int, gen_id: int, task_id: str,
+    status_msg: Message, regen: bool = False,
+):
+    if _poller is None:
+        # Poller not running (e.g. handlers used outside run_bot)
+        spawn(_complete_generation(message, user_id, gen_id, task_id, status_msg, regen))
+        return
+    deadline = asyncio.get_running_loop().time() + COMPLETION_TIMEOUT
+    _pending_completions[task_id] = PendingCompletion(
+        message, user_id, gen_id, status_msg, regen, deadline,
+    )
+
+
+async def _complete_generation(
+    message: Message, user_id: int, gen_id: int, task_id: str,
+    status_msg: Message, regen: bool = False,
+):
+    """Wait for Suno on its own, then finish the generation."""
+    try:
+        songs = await get_suno_client().wait_for_completion(task_id)
+    except Exception as e:
+        await _fail_generation(e, user_id, gen_id, status_msg)
+        return
+    await _finish_generation(message, user_id, gen_id, task_id, status_msg, regen, songs)
+
+
+async def _finish_generation(
+    message: Message, user_id: int, gen_id: int, task_id: str,
+    status_msg: Message, regen: bool, tracks: list[Track],
+):
+    """Charge the user and deliver the finished tracks."""
+    try:
+        # Charge against the balance as it is now (it may have changed during
+        # the 1-2 min generation) and complete in one transaction; only a
+        # spent credit unlocks the full MP3, anything else gets the preview
+        charge = await db.finalize_generation(
+            user_id, gen_id,
+            audio_urls=[t.url for t in tracks],
+            song_titles=[t.title for t in tracks],
+            suno_audio_ids=[t.id for t in tracks],
+            label=" (повтор)" if regen else "",
+        )
+        cache.invalidate_user(user_id)
+        cache.invalidate_generation(gen_id)
 
         # Delete status message
         try:
@@ -987,63 +1167,17 @@ async def do_generate_music(message: Message, state: FSMContext, user_id: int |
         except Exception:
             pass
 
-        if is_free:
-            # ─── FREE: Send voice previews (30 sec) ───
-            for i, url in enumerate(audio_urls[:2]):
-                if not url:
-                    continue
-                try:
-                    img_url = image_urls[i] if i < len(image_urls) else ""
-                    title = song_titles[i] if i < len(song_titles) else f"Вариант {i+1}"
-
-                    # Send cover image if available
-                    if img_url:
-                        try:
-                            await message.answer_photo(
-                                photo=img_url,
-                                caption=f"🎵 Обложка для трека: <b>{title}</b>",
-                                parse_mode="HTML",
-                            )
-                        except Exception as e:
-                            logger.warning(f"Failed to send cover image {i}: {e}")
-
-                    # Download audio and create 30-sec preview
-                    async with httpx.AsyncClient() as http:
-                        resp = await http.get(url, timeout=60.0)
-                        resp.raise_for_status()
-                        audio_data = resp.content
+        if charge is None:
+            # Already completed (and delivered) by the Suno webhook
+            logger.info("Generation %s already complete, skipping delivery", gen_id)
+            return
 
-                    try:
-                        preview_data = await create_preview(audio_data)
-                        voice_file = BufferedInputFile(
-                            preview_data,
-                            filename=f"preview_{i+1}.ogg",
-                        )
-                        bot_link = f"https://t.me/{config.bot_username}?start=ref{user_id}"
-                        await message.answer_voice(
-                            voice_file,
-                            caption=PREVIEW_CAPTION.format(title=title, bot_link=bot_link),
-                            parse_mode="HTML",
-                            reply_markup=preview_track_kb(gen_id, i, user_id=user_id),
-                        )
-                    except Exception as e:
-                        logger.warning(f"Preview creation failed for track {i}, sending full audio as fallback: {e}")
-                        # Fallback: send full audio file
-                        audio_file = BufferedInputFile(
-                            audio_data,
-                            filename=f"{title}.mp3",
-                        )
-                        bot_link = f"https://t.me/{config.bot_username}?start=ref{user_id}"
-                        await message.answer_audio(
-                            audio_file,
-                            title=f"🎧 {title}",
-                            performer="AI Melody",
-                            caption=PREVIEW_CAPTION.format(title=title, bot_link=bot_link),
-                            parse_mode="HTML",
-                            reply_markup=preview_track_kb(gen_id, i, user_id=user_id),
-                        )
-                except Exception as e:
-                    logger.error(f"Failed to send preview {i}: {e}")
+        if charge != "paid":
+            # ─── FREE: Send voice previews (30 sec), both tracks at once ───
+            await asyncio.gather(*(
+                deliver_preview_track(message.bot, message.chat.id, gen_id, user_id, i, t)
+                for i, t in enumerate(tracks[:2]) if t.url
+            ), return_exceptions=True)
 
             # Send preview after-generation keyboard
             await message.answer(
@@ -1052,47 +1186,16 @@ async def do_generate_music(message: Message, state: FSMContext, user_id: int |
                 reply_markup=preview_after_generation_kb(gen_id),
             )
         else:
-            # ─── PAID: Send full MP3 (current behavior) ───
-            for i, url in enumerate(audio_urls[:2]):
-                if not url:
-                    continue
-                try:
-                    img_url = image_urls[i] if i < len(image_urls) else ""
-                    title = song_titles[i] if i < len(song_titles) else f"Вариант {i+1}"
-                    if img_url:
-                        try:
-                            await message.answer_photo(
-                                photo=img_url,
-                                caption=f"🎵 Обложка для трека: <b>{title}</b>",
-                                parse_mode="HTML",
-                            )
-                        except Exception as e:
-                            logger.warning(f"Failed to send cover image {i}: {e}")
-
-                    async with httpx.AsyncClient() as http:
-                        resp = await http.get(url, timeout=60.0)
-                        resp.raise_for_status()
-                        audio_data = resp.content
-
-                    audio_file = BufferedInputFile(
-                        audio_data,
-                        filename=f"{title}.mp3",
-                    )
-                    bot_link = f"https://t.me/{config.bot_username}?start=ref{user_id}"
-                    paid_caption = (
-                        f"🎵 <a href=\"{bot_link}\">Создай свою песню с помощью ИИ</a> — "
-                        f"получи +1🎵 за каждого друга!"
-                    )
-                    await message.answer_audio(
-                        audio_file,
-                        title=title,
-                        performer="AI Melody",
-                        caption=paid_caption,
-                        parse_mode="HTML",
-                        reply_markup=track_kb(gen_id, i, user_id=user_id),
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send track {i}: {e}")
+            # ─── PAID: Send full MP3, both tracks at once ───
+            await asyncio.gather(*(
+                deliver_paid_track(message.bot, message.chat.id, gen_id, user_id, i, t)
+                for i, t in enumerate(tracks[:2]) if t.url
+            ), return_exceptions=True)
+
+            # Video generation (if enabled) — don't hold up the completion message
+            logger.info("Video check: enabled=%s, task_id=%s", config.video_generation_enabled, task_id)
+            if config.video_generation_enabled:
+                spawn(_dispatch_videos(message, task_id, tracks))
 
             # Send after-generation keyboard
             await message.answer(
@@ -1101,66 +1204,69 @@ async def do_generate_music(message: Message, state: FSMContext, user_id: int |
                 reply_markup=after_generation_kb(gen_id),
             )
 
-        # Video generation (if enabled)
-        logger.info(f"Video check: enabled={config.video_generation_enabled}, song_ids={song_ids}, task_id={task_id}")
-        if not is_free and config.video_generation_enabled:
-            from app.handlers.callback import register_video_task
-            get_bot = lambda b=message.bot: b
-            for i, url in enumerate(audio_urls[:2]):
-                if not url or not song_ids[i]:
-                    continue
-                try:
-                    title = song_titles[i] if i < len(song_titles) else f"Вариант {i+1}"
-                    video_result = await client.generate_video(task_id, song_ids[i])
-                    register_video_task(video_result["task_id"], message.chat.id, title, get_bot)
-                except Exception as e:
-                    logger.warning(f"Video generation request failed for track {i}: {e}")
+    except Exception as e:
+        await _fail_generation(e, user_id, gen_id, status_msg)
+
 
-    except ContentPolicyError:
+async def _fail_generation(
+    e: Exception, user_id: int, gen_id: int | None, status_msg: Message,
+):
+    """Mark a generation as failed and tell the user why.
+
+    gen_id is None when Suno rejected the request before a row was created.
+    """
+    if isinstance(e, ContentPolicyError):
         count = await db.increment_content_violations(user_id)
-        await db.update_generation_status(gen_id, "error", error_message="content_policy")
-        try:
-            await status_msg.edit_text(
-                CONTENT_VIOLATION.format(count=count),
-                parse_mode="HTML",
-            )
-        except Exception:
-            pass
+        cache.invalidate_user(user_id)
+        if gen_id is not None:
+            await db.update_generation_status(gen_id, "error", error_message="content_policy")
+        text = _content_violation_text(count)
+    else:
+        if isinstance(e, SunoApiError):
+            logger.error("Suno API error for gen %s (user %s): %s", gen_id, user_id, e)
+        else:
+            logger.error("Unexpected error for gen %s (user %s): %s", gen_id, user_id, e, exc_info=e)
+        if gen_id is not None:
+            await db.update_generation_status(gen_id, "error", error_message=str(e))
+        text = GENERATION_ERROR
+    try:
+        await status_msg.edit_text(text, parse_mode="HTML")
+    except Exception:
+        pass
 
-    except SunoApiError as e:
-        logger.error(f"Suno API error for gen {gen_id}: {e}")
-        await db.update_generation_status(gen_id, "error", error_message=str(e))
-        try:
-            await status_msg.edit_text(GENERATION_ERROR, parse_mode="HTML")
-        except Exception:
-            pass
 
-    except Exception as e:
-        logger.error(f"Unexpected error for gen {gen_id}: {e}", exc_info=True)
-        await db.update_generation_status(gen_id, "error", error_message=str(e))
-        try:
-            await status_msg.edit_text(GENERATION_ERROR, parse_mode="HTML")
-        except Exception:
-            pass
+# ─── Track delivery ───
 
-    finally:
-        await state.clear()
+def _track_file_id(gen: dict, idx: int) -> str | None:
+    """Telegram file_id of a full track that was already uploaded once."""
+    ids = gen.get("tg_file_ids") or []
+    return ids[idx] if idx < len(ids) else None
+
+
+async def _dispatch_videos(message: Message, task_id: str, tracks: list[Track]):
+    """Request MP4 clips for delivered tracks (runs as background task)."""
+    await request_videos(
+        task_id,
+        [(t.id, t.title) for t in tracks[:2] if t.url and t.id],
+        message.chat.id,
+        lambda b=message.bot: b,
+    )
 
 
 # ─── Rating ───
 
-@router.callback_query(F.data.startswith("rate:"))
-async def cb_rate(callback: CallbackQuery):
+_RATE_KEEP_PREFIXES = ("feedback:", "regenerate:", "create")
+
+
+async def cb_rate(callback: CallbackQuery, state: FSMContext, cb: CallbackAction):
     """Save user's rating for a generation."""
-    parts = callback.data.split(":")
-    gen_id = int(parts[1])
-    rating = int(parts[2])
+    gen_id, rating = cb.ints
 
     if rating < 1 or rating > 5:
         await callback.answer("Некорректная оценка", show_alert=True)
         return
 
-    gen = await db.get_generation(gen_id)
+    gen = await cache.get_generation(gen_id)
     if not gen:
         await callback.answer("Генерация не найдена", show_alert=True)
         return
@@ -1170,36 +1276,32 @@ async def cb_rate(callback: CallbackQuery):
         return
 
     await db.update_generation_rating(gen_id, rating)
+    cache.invalidate_generation(gen_id)
 
     # Update the after-generation keyboard: replace rating row with confirmation
     try:
-        from aiogram.utils.keyboard import InlineKeyboardBuilder
-        from aiogram.types import InlineKeyboardButton
-
-        builder = InlineKeyboardBuilder()
-        builder.row(
-            InlineKeyboardButton(text=f"⭐ Ваша оценка: {rating}/5 — спасибо!", callback_data="noop")
-        )
-        # Keep other buttons (feedback, regenerate, create)
-        if callback.message.reply_markup:
-            for row in callback.message.reply_markup.inline_keyboard:
-                for btn in row:
-                    if btn.callback_data and btn.callback_data.startswith(("feedback:", "regenerate:", "create")):
-                        builder.row(btn)
-                        break
-        await callback.message.edit_reply_markup(reply_markup=builder.as_markup())
+        # Keep the action rows (feedback, regenerate, create), drop the rating rows
+        old_rows = callback.message.reply_markup.inline_keyboard if callback.message.reply_markup else []
+        kept_rows = [
+            row for row in old_rows
+            if row[0].callback_data and row[0].callback_data.startswith(_RATE_KEEP_PREFIXES)
+        ]
+        new_kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=f"⭐ Ваша оценка: {rating}/5 — спасибо!", callback_data="noop")],
+            *kept_rows,
+        ])
+        await callback.message.edit_reply_markup(reply_markup=new_kb)
     except Exception as e:
-        logger.warning(f"Failed to update rating keyboard: {e}")
+        logger.warning("Failed to update rating keyboard: %s", e)
 
     await callback.answer(f"⭐ Оценка {rating}/5 сохранена!")
 
 
-@router.callback_query(F.data.startswith("feedback:"))
-async def cb_feedback(callback: CallbackQuery, state: FSMContext):
+async def cb_feedback(callback: CallbackQuery, state: FSMContext, cb: CallbackAction):
     """Ask user to type their comment/feedback."""
-    gen_id = int(callback.data.split(":")[1])
+    gen_id, = cb.ints
 
-    gen = await db.get_generation(gen_id)
+    gen = await cache.get_generation(gen_id)
     if not gen:
         await callback.answer("Генерация не найдена", show_alert=True)
         return
@@ -1227,7 +1329,7 @@ async def on_feedback_text(message: Message, state: FSMContext):
 
     if gen_id and comment:
         await db.save_generation_comment(gen_id, comment)
-        logger.info(f"Feedback saved for gen {gen_id} from user {message.from_user.id}")
+        logger.info("Feedback saved for gen %s from user %s", gen_id, message.from_user.id)
 
     await state.clear()
     await message.answer(
@@ -1237,14 +1339,15 @@ async def on_feedback_text(message: Message, state: FSMContext):
     )
 
 
-@router.callback_query(F.data.startswith("download:"))
-async def cb_download(callback: CallbackQuery):
-    """Send the track as a document file for easy download/sharing."""
-    parts = callback.data.split(":")
-    gen_id = int(parts[1])
-    idx = int(parts[2])
+async def cb_download(callback: CallbackQuery, state: FSMContext, cb: CallbackAction):
+    """Send the track as a file for easy download/sharing.
+
+    A track uploaded before is resent as audio by its file_id; otherwise it
+    goes out as a document from the CDN.
+    """
+    gen_id, idx = cb.ints
 
-    gen = await db.get_generation(gen_id)
+    gen = await cache.get_generation(gen_id)
     if not gen or not gen.get("audio_urls"):
         await callback.answer("Трек не найден", show_alert=True)
         return
@@ -1259,129 +1362,73 @@ async def cb_download(callback: CallbackQuery):
         return
 
     try:
-        async with httpx.AsyncClient() as http:
-            resp = await http.get(urls[idx], timeout=60.0)
-            resp.raise_for_status()
-            audio_data = resp.content
-
         titles = gen.get("song_titles") or []
         title = titles[idx] if idx < len(titles) else f"AI Melody Track"
+        caption = f"🎶 {title}\n\n🤖 Создано в @{config.bot_username}"
+
+        file_id = _track_file_id(gen, idx)
+        if file_id:
+            # Already on Telegram's servers: resend without touching the CDN.
+            # Stored ids are audio ids, and Telegram won't resend one as a document
+            try:
+                await callback.message.answer_audio(file_id, caption=caption)
+                await callback.answer("✅ Файл отправлен!")
+                return
+            except TelegramBadRequest as e:
+                logger.warning("Cached file_id rejected for %s/%s: %s", gen_id, idx, e)
+
+        if audio_cache.get(urls[idx]) is None:
+            # Stream CDN → Telegram in chunks instead of holding the whole MP3
+            try:
+                await callback.message.answer_document(
+                    URLInputFile(urls[idx], filename=f"{title}.mp3", timeout=60),
+                    caption=caption,
+                )
+                await callback.answer("✅ Файл отправлен!")
+                return
+            except Exception as e:
+                logger.warning("Streamed download failed for %s/%s, buffering: %s", gen_id, idx, e)
+
+        audio_data = await fetch_audio(urls[idx])
         doc_file = BufferedInputFile(audio_data, filename=f"{title}.mp3")
-        await callback.message.answer_document(
-            doc_file,
-            caption=f"🎶 {title}\n\n🤖 Создано в @{config.bot_username}",
-        )
+        await callback.message.answer_document(doc_file, caption=caption)
         await callback.answer("✅ Файл отправлен!")
     except Exception as e:
-        logger.error(f"Download track error: {e}")
+        logger.error("Download track error: %s", e)
         await callback.answer("Ошибка скачивания", show_alert=True)
 
 # ─── Result actions ───
 
-@router.callback_query(F.data.startswith("listen:"))
-async def cb_listen(callback: CallbackQuery):
-    """Re-send voice preview."""
-    parts = callback.data.split(":")
-    gen_id = int(parts[1])
-    idx = int(parts[2])
-
-    gen = await db.get_generation(gen_id)
-    if not gen or not gen.get("audio_urls"):
-        await callback.answer("Трек не найден", show_alert=True)
-        return
-
-    urls = gen["audio_urls"]
-    if idx >= len(urls) or not urls[idx]:
-        await callback.answer("Трек недоступен", show_alert=True)
-        return
-
-    try:
-        voice = URLInputFile(urls[idx], filename=f"preview_{idx+1}.ogg")
-        await callback.message.answer_voice(voice, caption=f"🔊 Вариант {idx+1}")
-    except Exception as e:
-        logger.error(f"Listen error: {e}")
-        await callback.answer("Ошибка воспроизведения", show_alert=True)
-    await callback.answer()
-
-
-@router.callback_query(F.data.startswith("download:"))
-async def cb_download(callback: CallbackQuery):
-    """Download MP3 for 1 credit."""
-    parts = callback.data.split(":")
-    gen_id = int(parts[1])
-    idx = int(parts[2])
-
-    user = await db.get_user(callback.from_user.id)
-    if not user:
-        await callback.answer("Используйте /start", show_alert=True)
-        return
-
-    if user["credits"] <= 0 and user["free_generations_left"] <= 0:
-        await callback.answer(
-            f"🎵 Для скачивания нужен 1 балл. Баланс: {user['credits']}",
-            show_alert=True,
-        )
-        return
-
-    gen = await db.get_generation(gen_id)
-    if not gen or not gen.get("audio_urls"):
-        await callback.answer("Трек не найден", show_alert=True)
-        return
-
-    urls = gen["audio_urls"]
-    if idx >= len(urls) or not urls[idx]:
-        await callback.answer("Трек недоступен", show_alert=True)
-        return
-
-    if user["free_generations_left"] > 0:
-        await db.use_free_generation(callback.from_user.id)
-    else:
-        await db.update_user_credits(callback.from_user.id, -1)
-    await db.log_balance_transaction(
-        callback.from_user.id, -1, 'download', f'Скачивание #{gen_id}',
+async def _send_unlocked_track(message: Message, gen: dict, i: int, url: str, user_id: int):
+    """Send one full track of an unlocked generation, by file_id when known."""
+    titles = gen.get("song_titles") or []
+    title = titles[i] if i < len(titles) else f"AI Melody (вариант {i+1})"
+    track_title = f"{title} (вариант {i+1})"
+    audio_file = _track_file_id(gen, i)
+    if not audio_file:
+        audio_data = await fetch_audio(url)
+        audio_file = BufferedInputFile(audio_data, filename=f"{track_title}.mp3")
+    sent = await message.answer_audio(
+        audio_file, caption=UNLOCK_SUCCESS if i == 0 else "",
+        title=track_title, performer="AI Melody",
+        parse_mode="HTML",
+        reply_markup=track_kb(gen["id"], i, user_id=user_id),
     )
-
-    try:
-        async with httpx.AsyncClient() as http:
-            resp = await http.get(urls[idx], timeout=60.0)
-            resp.raise_for_status()
-            audio_data = resp.content
-
-        titles = gen.get("song_titles") or []
-        title = titles[idx] if idx < len(titles) else f"AI Melody Track"
-        audio_file = BufferedInputFile(
-            audio_data,
-            filename=f"{title}.mp3",
-        )
-        await callback.message.answer_audio(
-            audio_file,
-            caption=DOWNLOAD_SUCCESS,
-            title=title,
-            performer="AI Melody",
-        )
-        await callback.answer("✅ Скачано!")
-    except Exception as e:
-        logger.error(f"Download error: {e}")
-        await db.update_user_credits(callback.from_user.id, 1)
-        await db.log_balance_transaction(
-            callback.from_user.id, 1, 'refund', f'Возврат за ошибку скачивания #{gen_id}',
-        )
-        await callback.answer("Ошибка скачивания. Кредит возвращён.", show_alert=True)
+    if not isinstance(audio_file, str):
+        await remember_file_id(gen["id"], i, sent)
 
 
-@router.callback_query(F.data.startswith("buy_track:"))
-async def cb_buy_track(callback: CallbackQuery):
+async def cb_buy_track(callback: CallbackQuery, state: FSMContext, cb: CallbackAction):
     """Buy full track from preview — send Telegram Stars invoice."""
-    parts = callback.data.split(":")
-    gen_id = int(parts[1])
-    idx = int(parts[2])
+    gen_id, idx = cb.ints
 
-    user = await db.get_user(callback.from_user.id)
+    user, gen = await asyncio.gather(
+        cache.get_user(callback.from_user.id), cache.get_generation(gen_id),
+    )
     if not user:
         await callback.answer("Используйте /start", show_alert=True)
         return
 
-    gen = await db.get_generation(gen_id)
     if not gen or not gen.get("audio_urls"):
         await callback.answer("Трек не найден", show_alert=True)
         return
@@ -1394,29 +1441,14 @@ async def cb_buy_track(callback: CallbackQuery):
     # Check if already unlocked
     if gen.get("is_unlocked"):
         await callback.answer(UNLOCK_ALREADY, show_alert=True)
-        # Re-send all tracks
-        urls = gen["audio_urls"]
-        for i, url in enumerate(urls[:2]):
-            if not url:
-                continue
-            try:
-                async with httpx.AsyncClient() as http:
-                    resp = await http.get(url, timeout=60.0)
-                    resp.raise_for_status()
-                    audio_data = resp.content
-                titles = gen.get("song_titles") or []
-                title = titles[i] if i < len(titles) else f"AI Melody (вариант {i+1})"
-                track_title = f"{title} (вариант {i+1})"
-                audio_file = BufferedInputFile(audio_data, filename=f"{track_title}.mp3")
-                caption = UNLOCK_SUCCESS if i == 0 else ""
-                await callback.message.answer_audio(
-                    audio_file, caption=caption,
-                    title=track_title, performer="AI Melody",
-                    parse_mode="HTML",
-                    reply_markup=track_kb(gen_id, i, user_id=callback.from_user.id),
-                )
-            except Exception as e:
-                logger.error(f"Re-send unlocked track {i} error: {e}")
+        # Re-send all tracks, both at once; one failing doesn't stop the other
+        results = await asyncio.gather(*(
+            _send_unlocked_track(callback.message, gen, i, url, callback.from_user.id)
+            for i, url in enumerate(gen["audio_urls"][:2]) if url
+        ), return_exceptions=True)
+        for e in results:
+            if isinstance(e, Exception):
+                logger.error("Re-send unlocked track error: %s", e)
         return
 
     urls = gen["audio_urls"]
@@ -1424,93 +1456,71 @@ async def cb_buy_track(callback: CallbackQuery):
         await callback.answer("Трек недоступен", show_alert=True)
         return
 
-    # Check if user has credits to buy
-    if user["credits"] >= 1:
-        # Pay with existing credits
-        await db.update_user_credits(callback.from_user.id, -1)
-        await db.log_balance_transaction(
-            callback.from_user.id, -1, 'unlock', f'Покупка трека #{gen_id}',
-        )
-        await db.unlock_generation(gen_id)
+    # Pay with an existing credit; the charge itself checks the balance, so
+    # two quick taps can't spend one credit twice
+    uid = callback.from_user.id
+    if await db.spend_credit(uid, 'unlock', f'Покупка трека #{gen_id}') is None:
+        # No credits — show balance page with all payment options
+        from app.handlers.common import _show_balance
+        cache.invalidate_user(uid)
+        await callback.answer("❌ Недостаточно баллов. Пополните баланс!", show_alert=True)
+        await _show_balance(callback.message, uid)
+        return
+    cache.invalidate_user(uid)
 
-        # Send all full MP3 tracks
-        try:
-            for i, url in enumerate(urls[:2]):
-                if not url:
-                    continue
-                async with httpx.AsyncClient() as http:
-                    resp = await http.get(url, timeout=60.0)
-                    resp.raise_for_status()
-                    audio_data = resp.content
+    await db.unlock_generation(gen_id)
+    cache.invalidate_generation(gen_id)
 
+    # Send all full MP3 tracks concurrently; any failure cancels the
+    # rest and falls through to the refund below
+    try:
+        async with asyncio.TaskGroup() as tg:
+            for i, url in enumerate(urls[:2]):
+                if url:
+                    tg.create_task(_send_unlocked_track(
+                        callback.message, gen, i, url, uid,
+                    ))
+        await callback.answer("✅ Трек куплен!")
+
+        # Trigger video generation if enabled
+        if config.video_generation_enabled and gen.get("suno_song_ids") and gen.get("suno_audio_ids"):
+            try:
                 titles = gen.get("song_titles") or []
-                title = titles[i] if i < len(titles) else f"AI Melody (вариант {i+1})"
-                track_title = f"{title} (вариант {i+1})"
-                audio_file = BufferedInputFile(audio_data, filename=f"{track_title}.mp3")
-                caption = UNLOCK_SUCCESS if i == 0 else ""
-                await callback.message.answer_audio(
-                    audio_file, caption=caption,
-                    title=track_title, performer="AI Melody",
+                await request_videos(
+                    gen["suno_song_ids"][0],
+                    [
+                        (audio_id, titles[i] if i < len(titles) else f"AI Melody (вариант {i+1})")
+                        for i, audio_id in enumerate(gen["suno_audio_ids"][:2]) if audio_id
+                    ],
+                    callback.message.chat.id,
+                    lambda b=callback.bot: b,
+                )
+                await callback.message.answer(
+                    "🎬 <b>Генерирую видеоклип...</b>\nВидео будет отправлено, когда будет готово.",
                     parse_mode="HTML",
-                    reply_markup=track_kb(gen_id, i, user_id=callback.from_user.id),
                 )
-            await callback.answer("✅ Трек куплен!")
-
-            # Trigger video generation if enabled
-            if config.video_generation_enabled and gen.get("suno_song_ids") and gen.get("suno_audio_ids"):
-                try:
-                    client = get_suno_client()
-                    from app.handlers.callback import register_video_task
-                    task_id = gen["suno_song_ids"][0]
-                    audio_ids = gen["suno_audio_ids"]
-                    get_bot = lambda b=callback.bot: b
-                    for i in range(min(2, len(audio_ids))):
-                        if not audio_ids[i]:
-                            continue
-                        try:
-                            titles = gen.get("song_titles") or []
-                            t = titles[i] if i < len(titles) else title
-                            video_result = await client.generate_video(task_id, audio_ids[i])
-                            register_video_task(
-                                video_result["task_id"],
-                                callback.message.chat.id,
-                                t,
-                                get_bot,
-                            )
-                        except Exception as e:
-                            logger.warning(f"Video generation after unlock failed for track {i}: {e}")
-                    await callback.message.answer(
-                        "🎬 <b>Генерирую видеоклип...</b>\nВидео будет отправлено, когда будет готово.",
-                        parse_mode="HTML",
-                    )
-                except Exception as e:
-                    logger.warning(f"Video generation after unlock failed: {e}")
-
-        except Exception as e:
-            logger.error(f"Unlock track delivery error: {e}")
-            # Refund
-            await db.update_user_credits(callback.from_user.id, 1)
-            await db.log_balance_transaction(
-                callback.from_user.id, 1, 'refund', f'Возврат за ошибку покупки #{gen_id}',
-            )
-            await callback.answer("Ошибка доставки трека. Кредит возвращён.", show_alert=True)
-    else:
-        # No credits — show balance page with all payment options
-        from app.handlers.common import _show_balance
-        await callback.answer("❌ Недостаточно баллов. Пополните баланс!", show_alert=True)
-        await _show_balance(callback.message, callback.from_user.id)
+            except Exception as e:
+                logger.warning("Video generation after unlock failed: %s", e)
 
+    except Exception as e:
+        logger.error("Unlock track delivery error: %r", e)
+        # Refund
+        await db.charge_and_log(
+            uid, 1, 'refund', f'Возврат за ошибку покупки #{gen_id}',
+        )
+        cache.invalidate_user(uid)
+        await callback.answer("Ошибка доставки трека. Кредит возвращён.", show_alert=True)
 
-@router.callback_query(F.data.startswith("regenerate:"))
-async def cb_regenerate(callback: CallbackQuery, state: FSMContext):
+
+async def cb_regenerate(callback: CallbackQuery, state: FSMContext, cb: CallbackAction):
     """Regenerate with same params."""
-    gen_id = int(callback.data.split(":")[1])
-    gen = await db.get_generation(gen_id)
+    gen_id, = cb.ints
+    gen = await cache.get_generation(gen_id)
     if not gen:
         await callback.answer("Генерация не найдена", show_alert=True)
         return
 
-    await state.update_data(
+    data = await state.update_data(
         mode=gen["mode"],
         style=gen.get("style", ""),
         voice_gender=gen.get("voice_gender"),
@@ -1519,41 +1529,27 @@ async def cb_regenerate(callback: CallbackQuery, state: FSMContext):
 
     user_id = callback.from_user.id
 
-    # Rate limit check (prevents bypassing daily limit via regeneration)
-    error = await check_limits(user_id)
+    # Rate limit check (prevents bypassing daily limit via regeneration) + credits
+    error, has_credits, user = await check_eligibility(user_id)
     if error:
-        await callback.message.answer(error, parse_mode="HTML")
-        await callback.answer()
+        await _reply_error(callback, error)
         return
-
-    # Credits check
-    has_credits, user = await check_credits(user_id)
     if not has_credits:
-        await callback.message.answer(
-            NO_CREDITS.format(credits=user["credits"]),
-            parse_mode="HTML",
-        )
-        await callback.answer()
+        await _reply_error(callback, _no_credits_text(user["credits"]))
         return
 
     await callback.answer("⚡ Запускаю новую генерацию...")
     msg = await callback.message.answer(GENERATING, parse_mode="HTML")
 
-    data = await state.get_data()
-
-    # Determine lyrics for accent processing
+    # Reuse the previous lyrics (skips the Lyrics API); without any,
+    # _run_generation writes new ones
     regen_mode = data.get("mode", "description")
     if regen_mode == "lyrics":
         regen_lyrics = data.get("prompt", "")
     else:
         regen_lyrics = data.get("generated_lyrics") or gen.get("generated_lyrics", "")
 
-    # Apply stress accents
-    accented_text = await asyncio.to_thread(apply_stress_accents, regen_lyrics) if regen_lyrics else regen_lyrics
-    logger.info(f"Accent applied to regen lyrics, length: {len(regen_lyrics)} -> {len(accented_text)}")
-
-    gen_id_new = await db.create_generation(
-        user_id=user_id,
+    await _run_generation(callback.message, state, user_id, msg, dict(
         prompt=data.get("prompt", ""),
         style=data.get("style", ""),
         voice_gender=data.get("voice_gender"),
@@ -1563,185 +1559,39 @@ async def cb_regenerate(callback: CallbackQuery, state: FSMContext):
         generated_lyrics=data.get("generated_lyrics") or gen.get("generated_lyrics"),
         edited_lyrics=data.get("edited_lyrics") or gen.get("edited_lyrics"),
         generated_title=data.get("generated_title") or gen.get("generated_title"),
-        accented_lyrics=accented_text if regen_lyrics else None,
-    )
-
-    try:
-        client = get_suno_client()
-
-        if regen_mode == "lyrics":
-            result = await client.generate(
-                prompt=accented_text,
-                style=data.get("style", ""),
-                voice_gender=data.get("voice_gender"),
-                mode="custom",
-                lyrics=accented_text,
-                instrumental=False,
-            )
-        else:
-            # Reuse lyrics from previous generation (skip Lyrics API)
-            generated_lyrics = regen_lyrics
-            generated_title = data.get("generated_title") or gen.get("generated_title", data.get("prompt", "")[:80])
-
-            if not generated_lyrics:
-                # Fallback: if no saved lyrics, generate new ones
-                lyrics_prompt_parts = []
-                if config.russian_language_prefix:
-                    lyrics_prompt_parts.append("песня на русском языке")
-                lyrics_prompt_parts.append(data.get("prompt", ""))
-                lyrics_prompt = ". ".join(lyrics_prompt_parts)
-
-                lyrics_result = await client.generate_lyrics(lyrics_prompt)
-                lyrics_data = await client.wait_for_lyrics(lyrics_result["task_id"])
-                generated_lyrics = lyrics_data["text"]
-                generated_title = lyrics_data["title"]
-                # Apply accents to newly generated lyrics
-                accented_text = await asyncio.to_thread(apply_stress_accents, generated_lyrics)
-
-            result = await client.generate(
-                prompt=generated_title,
-                style=data.get("style", ""),
-                voice_gender=data.get("voice_gender"),
-                mode="custom",
-                lyrics=accented_text,
-                instrumental=False,
-            )
+    ), lyrics=regen_lyrics, regen=True)
 
-        task_id = result["task_id"]
-        await db.update_generation_status(gen_id_new, "processing", suno_song_ids=[task_id])
 
-        if config.callback_base_url:
-            await db.update_generation_callback_info(
-                gen_id_new, callback.message.chat.id, msg.message_id
-            )
-            logger.info(f"Regen {gen_id_new} submitted with callback, task_id={task_id}")
-            await state.clear()
-            return
-
-        songs = await client.wait_for_completion(task_id)
-
-        audio_urls = []
-        image_urls = []
-        song_titles = []
-        song_ids = []
-        for s in songs:
-            url = s.get("audioUrl") or s.get("streamAudioUrl", "")
-            audio_urls.append(url)
-            image_urls.append(s.get("imageUrl") or s.get("image_url", ""))
-            song_titles.append(s.get("title", f"AI Melody Track"))
-            song_ids.append(s.get("id", ""))
-
-        # Re-fetch user from DB to get fresh free_generations_left
-        # (may have changed during the 1-2 min generation)
-        user = await db.get_user(user_id)
-        if user["free_generations_left"] > 0:
-            await db.use_free_generation(user_id)
-        else:
-            await db.update_user_credits(user_id, -1)
-        await db.log_balance_transaction(
-            user_id, -1, 'generation', f'Генерация #{gen_id_new} (повтор)',
-        )
-
-        await db.update_last_generation(user_id)
-        await db.update_generation_status(gen_id_new, "complete", audio_urls=audio_urls, credits_spent=1, song_titles=song_titles, suno_audio_ids=song_ids)
-
-        # Delete status message
-        try:
-            await msg.delete()
-        except Exception:
-            pass
-
-        # SoNata-style delivery: per track — image, then audio with buttons
-        for i, url in enumerate(audio_urls[:2]):
-            if not url:
-                continue
-            try:
-                img_url = image_urls[i] if i < len(image_urls) else ""
-                title = song_titles[i] if i < len(song_titles) else f"Вариант {i+1}"
-                if img_url:
-                    try:
-                        await callback.message.answer_photo(
-                            photo=img_url,
-                            caption=f"🎵 Обложка для трека: <b>{title}</b>",
-                            parse_mode="HTML",
-                        )
-                    except Exception as e:
-                        logger.warning(f"Regen: failed to send cover image {i}: {e}")
+# ─── History ───
 
-                async with httpx.AsyncClient() as http:
-                    resp = await http.get(url, timeout=60.0)
-                    resp.raise_for_status()
-                    audio_data = resp.content
+HISTORY_FETCH_CONCURRENCY = 8
 
-                audio_file = BufferedInputFile(
-                    audio_data,
-                    filename=f"{title}.mp3",
-                )
-                regen_bot_link = f"https://t.me/{config.bot_username}?start=ref{callback.from_user.id}"
-                regen_caption = (
-                    f"🎵 <a href=\"{regen_bot_link}\">Создай свою песню с помощью ИИ</a> — "
-                    f"получи +1🎵 за каждого друга!"
-                )
-                await callback.message.answer_audio(
-                    audio_file,
-                    title=title,
-                    performer="AI Melody",
-                    caption=regen_caption,
-                    parse_mode="HTML",
-                    reply_markup=track_kb(gen_id_new, i, user_id=callback.from_user.id),
-                )
-            except Exception as e:
-                logger.error(f"Regen track send error {i}: {e}")
 
-        await callback.message.answer(
-            GENERATION_COMPLETE,
-            parse_mode="HTML",
-            reply_markup=after_generation_kb(gen_id_new),
-        )
+def _history_item(num: int, g: dict) -> tuple[str, list[tuple[int, str, str, str | None]]]:
+    """Caption and playable variants (idx, url, title, file_id) of one generation.
 
-        # Video generation (if enabled)
-        logger.info(f"Regen video check: enabled={config.video_generation_enabled}, song_ids={song_ids}, task_id={task_id}")
-        if config.video_generation_enabled:
-            from app.handlers.callback import register_video_task
-            get_bot = lambda b=callback.bot: b
-            for i, url in enumerate(audio_urls[:2]):
-                if not url or not song_ids[i]:
-                    continue
-                try:
-                    title = song_titles[i] if i < len(song_titles) else f"Вариант {i+1}"
-                    video_result = await client.generate_video(task_id, song_ids[i])
-                    register_video_task(video_result["task_id"], callback.message.chat.id, title, get_bot)
-                except Exception as e:
-                    logger.warning(f"Regen video generation request failed for track {i}: {e}")
+    Each row field is read once; NULL columns render like empty ones.
+    """
+    prompt = g.get("prompt") or ""
+    audio_urls = g.get("audio_urls") or []
+    rating = g.get("rating")
 
-    except ContentPolicyError:
-        count = await db.increment_content_violations(user_id)
-        await db.update_generation_status(gen_id_new, "error", error_message="content_policy")
-        try:
-            await msg.edit_text(
-                CONTENT_VIOLATION.format(count=count),
-                parse_mode="HTML",
-            )
-        except Exception:
-            pass
-    except SunoApiError as e:
-        logger.error(f"Regen API error: {e}")
-        await db.update_generation_status(gen_id_new, "error", error_message=str(e))
-        try:
-            await msg.edit_text(GENERATION_ERROR, parse_mode="HTML")
-        except Exception:
-            pass
-    except Exception as e:
-        logger.error(f"Regen unexpected error: {e}", exc_info=True)
-        try:
-            await msg.edit_text(GENERATION_ERROR, parse_mode="HTML")
-        except Exception:
-            pass
-    finally:
-        await state.clear()
+    prompt_short = (prompt[:60] + "...") if len(prompt) > 60 else prompt
+    caption = (
+        f"🎵 <b>{num}. {prompt_short}</b>\n"
+        f"{'📝 Стихи' if g.get('mode') == 'lyrics' else '💡 Идея'} • "
+        f"🎼 {g.get('style') or '—'}{f'  ⭐ {rating}/5' if rating else ''}\n"
+        f"📅 {g['created_at'].strftime('%d.%m.%Y %H:%M')}"
+    )
 
+    base = prompt[:50] or f"Трек {num}"
+    suffix = len(audio_urls) > 1
+    tracks = [
+        (idx, url, f"{base} (вар. {idx+1})" if suffix else base, _track_file_id(g, idx))
+        for idx, url in enumerate(audio_urls[:2]) if url
+    ]
+    return caption, tracks
 
-# ─── History ───
 
 async def show_history(message: Message):
     gens = await db.get_user_generations(message.from_user.id, limit=10)
@@ -1755,56 +1605,120 @@ async def show_history(message: Message):
         parse_mode="HTML",
     )
 
-    for i, g in enumerate(gens):
-        gen_id = g["id"]
-        date = g["created_at"].strftime("%d.%m.%Y %H:%M")
-        style = g.get("style", "—")
-        prompt = g.get("prompt", "")
-        prompt_short = (prompt[:60] + "...") if len(prompt) > 60 else prompt
-        rating = f"  ⭐ {g['rating']}/5" if g.get("rating") else ""
-        mode_label = "📝 Стихи" if g.get("mode") == "lyrics" else "💡 Идея"
-
-        caption = (
-            f"🎵 <b>{prompt_short}</b>\n"
-            f"{mode_label} • 🎼 {style}{rating}\n"
-            f"📅 {date}"
-        )
+    # Render every caption and track list first, so the loop below only
+    # awaits I/O. CDN downloads all start up front (bounded) and are sent in
+    # history order as each becomes ready. Tracks already uploaded once are
+    # resent by file_id and need no download at all. Both variants of a
+    # generation go out as one album; download buttons for the page follow
+    # in one message.
+    items = [
+        (num, g["id"], *_history_item(num, g))
+        for num, g in enumerate(gens, 1)
+    ]
+
+    sem = asyncio.Semaphore(HISTORY_FETCH_CONCURRENCY)
+
+    async def fetch(url: str):
+        async with sem:
+            return await fetch_audio(url, timeout=30.0)
+
+    downloads = {
+        (gen_id, idx): asyncio.create_task(fetch(url))
+        for _, gen_id, _, tracks in items
+        for idx, url, _, file_id in tracks if not file_id
+    }
 
-        audio_urls = g.get("audio_urls") or []
-        sent_audio = False
+    sent_tracks: list[tuple[int, int, int]] = []  # (number, gen_id, idx)
+    try:
+        for num, gen_id, caption, tracks in items:
+            media: list[InputMediaAudio] = []
+            media_idx: list[int] = []
 
-        for idx, url in enumerate(audio_urls[:2]):
-            if not url:
-                continue
-            try:
-                async with httpx.AsyncClient() as http:
-                    resp = await http.get(url, timeout=30.0)
-                    resp.raise_for_status()
-                    audio_data = resp.content
-
-                title = (prompt[:50] or f"Трек {i+1}") + (f" (вар. {idx+1})" if len(audio_urls) > 1 else "")
-                audio_file = BufferedInputFile(
-                    audio_data,
-                    filename=f"{title}.mp3",
-                )
-                await message.answer_audio(
-                    audio_file,
-                    caption=caption if idx == 0 else None,
+            for idx, _, title, audio_file in tracks:
+                if not audio_file:
+                    try:
+                        audio_data = await downloads[(gen_id, idx)]
+                    except Exception as e:
+                        logger.warning("History: failed to download audio %s/%s: %s", gen_id, idx, e)
+                        continue
+                    audio_file = BufferedInputFile(audio_data, filename=f"{title}.mp3")
+                media.append(InputMediaAudio(
+                    media=audio_file,
+                    caption=caption if not media else None,
                     parse_mode="HTML",
                     title=title,
                     performer="AI Melody",
-                    reply_markup=history_track_kb(gen_id, idx, user_id=message.from_user.id),
-                )
-                sent_audio = True
+                ))
+                media_idx.append(idx)
+
+            sent: list[Message] = []
+            try:
+                if len(media) > 1:
+                    sent = await message.answer_media_group(media)
+                elif media:
+                    m = media[0]
+                    sent = [await message.answer_audio(
+                        m.media, caption=caption, parse_mode="HTML",
+                        title=m.title, performer=m.performer,
+                    )]
             except Exception as e:
-                logger.warning(f"History: failed to send audio {gen_id}/{idx}: {e}")
+                logger.warning("History: failed to send audio for %s: %s", gen_id, e)
 
-        # Fallback: text-only if audio not available
-        if not sent_audio:
-            await message.answer(caption, parse_mode="HTML")
+            for idx, m, msg in zip(media_idx, media, sent):
+                if not isinstance(m.media, str):
+                    await remember_file_id(gen_id, idx, msg)
+                sent_tracks.append((num, gen_id, idx))
+
+            # Fallback: text-only if audio not available
+            if not sent:
+                await message.answer(caption, parse_mode="HTML")
+
+        if sent_tracks:
+            await message.answer(
+                "⬇️ <b>Скачать файлы:</b>",
+                parse_mode="HTML",
+                reply_markup=history_downloads_kb(sent_tracks, user_id=message.from_user.id),
+            )
+    finally:
+        # Don't leave downloads running if sending stopped early
+        for task in downloads.values():
+            task.cancel()
 
 
 @router.callback_query(F.data == "history")
 async def cb_history(callback: CallbackQuery):
     await callback.answer()
     await show_history(callback.message)
+
+
+# ─── Callback dispatch ───
+
+# Prefix-style buttons ("kind:...") handled by this router. Parsed once and
+# routed by dict lookup instead of a startswith() filter per handler.
+CB_HANDLERS = {
+    "mode": cb_mode,
+    "gender": cb_gender,
+    "style": cb_style,
+    "gr_rcpt": cb_greeting_recipient,
+    "gr_occ": cb_greeting_occasion,
+    "gr_mood": cb_greeting_mood,
+    "st_vibe": cb_stories_vibe,
+    "st_mood": cb_stories_mood,
+    "rate": cb_rate,
+    "feedback": cb_feedback,
+    "download": cb_download,
+    "buy_track": cb_buy_track,
+    "regenerate": cb_regenerate,
+}
+
+
+def _match_cb(callback: CallbackQuery) -> dict | bool:
+    if not callback.data:
+        return False
+    cb = CallbackAction.parse(callback.data)
+    return {"cb": cb} if cb.kind in CB_HANDLERS else False
+
+
+@router.callback_query(_match_cb)
+async def cb_dispatch(callback: CallbackQuery, state: FSMContext, cb: CallbackAction):
+    await CB_HANDLERS[cb.kind](callback, state, cb)
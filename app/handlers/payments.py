@@ -1,19 +1,27 @@
 """Telegram Stars + T-Bank payment handlers."""
 
+import asyncio
 import logging
+import re
 import uuid
 
-import httpx
 from aiogram import Router, F
 from aiogram.types import (
     Message, CallbackQuery, LabeledPrice,
-    PreCheckoutQuery, InlineKeyboardMarkup, InlineKeyboardButton,
+    PreCheckoutQuery,
     BufferedInputFile,
 )
 
+from app import cache
+from app import tbank_api
 from app import database as db
+from app.callback_data import CallbackAction
 from app.config import config
-from app.keyboards import main_reply_kb, balance_kb, card_kb, track_kb
+from app.delivery import remember_file_id
+from app.http_client import fetch_audio
+from app.tasks import spawn
+from app.handlers.callback import request_videos
+from app.keyboards import main_reply_kb, balance_kb, card_kb, tbank_pay_kb, track_kb
 from app.texts import (
     PAYMENT_SUCCESS, NO_CREDITS, BUY_CARD_HEADER,
     TBANK_PAYMENT_LINK, TBANK_PAYMENT_ERROR,
@@ -23,6 +31,9 @@ from app.texts import (
 router = Router()
 logger = logging.getLogger(__name__)
 
+# Stars invoice payload for a credit package: "credits_<credits>_<stars>"
+_CREDITS_PAYLOAD_RE = re.compile(r"credits_(\d+)_(\d+)$")
+
 
 async def _notify_admins_payment(
     bot, user_id: int, username: str | None, first_name: str | None,
@@ -43,11 +54,13 @@ async def _notify_admins_payment(
     if extra:
         text += f"{extra}\n"
 
-    for admin_id in config.admin_ids:
-        try:
-            await bot.send_message(admin_id, text, parse_mode="HTML")
-        except Exception as e:
-            logger.warning(f"Failed to notify admin {admin_id} about payment: {e}")
+    results = await asyncio.gather(*(
+        bot.send_message(admin_id, text, parse_mode="HTML")
+        for admin_id in config.admin_ids
+    ), return_exceptions=True)
+    for admin_id, result in zip(config.admin_ids, results):
+        if isinstance(result, Exception):
+            logger.warning("Failed to notify admin %s about payment: %s", admin_id, result)
 
 
 # ─── Telegram Stars flow ───
@@ -55,14 +68,9 @@ async def _notify_admins_payment(
 @router.callback_query(F.data.startswith("buy_credits:"))
 async def cb_buy_credits(callback: CallbackQuery):
     """Send Telegram Stars invoice."""
-    parts = callback.data.split(":")
-    credits = int(parts[1])
-    stars = int(parts[2])
+    credits, stars = CallbackAction.parse(callback.data).ints
 
-    pkg = next(
-        (p for p in config.credit_packages if p["credits"] == credits),
-        None,
-    )
+    pkg = config.credit_packages_by_credits.get(credits)
     if not pkg:
         await callback.answer("Пакет не найден", show_alert=True)
         return
@@ -77,7 +85,7 @@ async def cb_buy_credits(callback: CallbackQuery):
         )
         await callback.answer()
     except Exception as e:
-        logger.error(f"Invoice error: {e}")
+        logger.error("Invoice error: %s", e)
         await callback.answer("Ошибка создания платежа", show_alert=True)
 
 
@@ -87,6 +95,45 @@ async def on_pre_checkout(pre_checkout_query: PreCheckoutQuery):
     await pre_checkout_query.answer(ok=True)
 
 
+async def _deliver_unlocked_track(message: Message, gen_id: int, idx: int):
+    """Send the full MP3 of a track bought with Stars (runs as background task)."""
+    gen = await db.get_generation(gen_id)
+    urls = gen.get("audio_urls") if gen else None
+    if not urls or idx >= len(urls) or not urls[idx]:
+        return
+    try:
+        audio_data = await fetch_audio(urls[idx])
+
+        title = gen.get("prompt", "AI Melody Track")[:60]
+        audio_file = BufferedInputFile(audio_data, filename=f"{title}.mp3")
+        sent = await message.answer_audio(
+            audio_file, caption=UNLOCK_SUCCESS,
+            title=title, performer="AI Melody",
+            parse_mode="HTML",
+            reply_markup=track_kb(gen_id, idx, user_id=message.from_user.id),
+        )
+        await remember_file_id(gen_id, idx, sent)
+
+        # Trigger video generation if enabled
+        if config.video_generation_enabled and gen.get("suno_song_ids") and gen.get("suno_audio_ids"):
+            try:
+                await request_videos(
+                    gen["suno_song_ids"][0],
+                    [(audio_id, title) for audio_id in gen["suno_audio_ids"][:2] if audio_id],
+                    message.chat.id,
+                    lambda b=message.bot: b,
+                )
+            except Exception as e:
+                logger.warning("Video gen after Stars unlock failed: %s", e)
+
+    except Exception as e:
+        logger.error("Failed to deliver unlocked track: %s", e)
+        await message.answer(
+            "❌ Ошибка доставки трека. Обратитесь в поддержку.",
+            parse_mode="HTML",
+        )
+
+
 @router.message(F.successful_payment)
 async def on_successful_payment(message: Message):
     """Handle successful payment — add credits or unlock track."""
@@ -95,9 +142,7 @@ async def on_successful_payment(message: Message):
 
     if payload.startswith("unlock:"):
         # ─── Track unlock payment ───
-        parts = payload.split(":")
-        gen_id = int(parts[1])
-        idx = int(parts[2])
+        gen_id, idx = CallbackAction.parse(payload).ints
 
         # Record the payment
         await db.create_payment(
@@ -108,70 +153,22 @@ async def on_successful_payment(message: Message):
         )
 
         await db.unlock_generation(gen_id)
-        await db.log_balance_transaction(
+        cache.invalidate_generation(gen_id)
+        db.balance_log.put_nowait(
             message.from_user.id, 0, 'unlock_stars',
             f'Покупка трека #{gen_id} за {payment.total_amount}⭐',
         )
 
-        # Deliver the full track
-        gen = await db.get_generation(gen_id)
-        if gen and gen.get("audio_urls"):
-            urls = gen["audio_urls"]
-            if idx < len(urls) and urls[idx]:
-                try:
-                    async with httpx.AsyncClient() as http:
-                        resp = await http.get(urls[idx], timeout=60.0)
-                        resp.raise_for_status()
-                        audio_data = resp.content
-
-                    title = gen.get("prompt", "AI Melody Track")[:60]
-                    audio_file = BufferedInputFile(audio_data, filename=f"{title}.mp3")
-                    await message.answer_audio(
-                        audio_file, caption=UNLOCK_SUCCESS,
-                        title=title, performer="AI Melody",
-                        parse_mode="HTML",
-                        reply_markup=track_kb(gen_id, idx, user_id=message.from_user.id),
-                    )
-
-                    # Trigger video generation if enabled
-                    if config.video_generation_enabled and gen.get("suno_song_ids") and gen.get("suno_audio_ids"):
-                        try:
-                            from app.suno_api import get_suno_client
-                            from app.handlers.callback import register_video_task
-                            client = get_suno_client()
-                            task_id = gen["suno_song_ids"][0]
-                            audio_ids = gen["suno_audio_ids"]
-                            get_bot = lambda b=message.bot: b
-                            for vi in range(min(2, len(audio_ids))):
-                                if not audio_ids[vi]:
-                                    continue
-                                try:
-                                    video_result = await client.generate_video(task_id, audio_ids[vi])
-                                    register_video_task(
-                                        video_result["task_id"],
-                                        message.chat.id,
-                                        title,
-                                        get_bot,
-                                    )
-                                except Exception as e:
-                                    logger.warning(f"Video gen after Stars unlock failed for track {vi}: {e}")
-                        except Exception as e:
-                            logger.warning(f"Video gen after Stars unlock failed: {e}")
-
-                except Exception as e:
-                    logger.error(f"Failed to deliver unlocked track: {e}")
-                    await message.answer(
-                        "❌ Ошибка доставки трека. Обратитесь в поддержку.",
-                        parse_mode="HTML",
-                    )
+        # Download + upload can take a while; don't hold the update on it
+        spawn(_deliver_unlocked_track(message, gen_id, idx))
 
         logger.info(
-            f"Unlock payment: user={message.from_user.id} gen_id={gen_id} "
-            f"stars={payment.total_amount} charge_id={payment.telegram_payment_charge_id}"
+            "Unlock payment: user=%s gen_id=%s stars=%s charge_id=%s",
+            message.from_user.id, gen_id, payment.total_amount, payment.telegram_payment_charge_id,
         )
 
         # Notify admins
-        await _notify_admins_payment(
+        spawn(_notify_admins_payment(
             message.bot,
             user_id=message.from_user.id,
             username=message.from_user.username,
@@ -180,13 +177,18 @@ async def on_successful_payment(message: Message):
             amount_display=f"⭐{payment.total_amount}",
             credits=0,
             extra=f"🎵 Трек: #{gen_id}",
-        )
+        ))
 
     else:
         # ─── Credit package purchase ───
-        parts = payload.split("_")
-        credits = int(parts[1])
-        stars = int(parts[2])
+        m = _CREDITS_PAYLOAD_RE.match(payload)
+        if not m:
+            logger.error(
+                "Unknown invoice payload %r (charge_id=%s)",
+                payload, payment.telegram_payment_charge_id,
+            )
+            return
+        credits, stars = int(m[1]), int(m[2])
 
         await db.create_payment(
             user_id=message.from_user.id,
@@ -194,8 +196,9 @@ async def on_successful_payment(message: Message):
             stars=stars,
             credits=credits,
         )
+        cache.invalidate_user(message.from_user.id)
 
-        user = await db.get_user(message.from_user.id)
+        user = await cache.get_user(message.from_user.id)
         balance = user["credits"] + user["free_generations_left"]
 
         await message.answer(
@@ -204,12 +207,12 @@ async def on_successful_payment(message: Message):
             reply_markup=main_reply_kb(),
         )
         logger.info(
-            f"Payment: user={message.from_user.id} credits={credits} stars={stars} "
-            f"charge_id={payment.telegram_payment_charge_id}"
+            "Payment: user=%s credits=%s stars=%s charge_id=%s",
+            message.from_user.id, credits, stars, payment.telegram_payment_charge_id,
         )
 
         # Notify admins
-        await _notify_admins_payment(
+        spawn(_notify_admins_payment(
             message.bot,
             user_id=message.from_user.id,
             username=message.from_user.username,
@@ -217,7 +220,7 @@ async def on_successful_payment(message: Message):
             payment_type="⭐ Покупка кредитов (Stars)",
             amount_display=f"⭐{stars}",
             credits=credits,
-        )
+        ))
 
 
 # ─── T-Bank card payment flow ───
@@ -234,16 +237,9 @@ async def cb_buy_card(callback: CallbackQuery):
 @router.callback_query(F.data.startswith("buy_tbank:"))
 async def cb_buy_tbank(callback: CallbackQuery):
     """Initiate T-Bank payment — create order and send payment link."""
-    from app import tbank_api
-
-    parts = callback.data.split(":")
-    credits = int(parts[1])
-    amount_rub = int(parts[2])
+    credits, amount_rub = CallbackAction.parse(callback.data).ints
 
-    pkg = next(
-        (p for p in config.credit_packages_rub if p["credits"] == credits),
-        None,
-    )
+    pkg = config.credit_packages_rub_by_credits.get(credits)
     if not pkg:
         await callback.answer("Пакет не найден", show_alert=True)
         return
@@ -274,7 +270,7 @@ async def cb_buy_tbank(callback: CallbackQuery):
 
         if not result.get("Success"):
             error_msg = result.get("Message", "Unknown error")
-            logger.error(f"T-Bank Init failed: {error_msg} (code={result.get('ErrorCode')})")
+            logger.error("T-Bank Init failed: %s (code=%s)", error_msg, result.get('ErrorCode'))
             await callback.message.edit_text(
                 TBANK_PAYMENT_ERROR, parse_mode="HTML", reply_markup=card_kb()
             )
@@ -293,20 +289,15 @@ async def cb_buy_tbank(callback: CallbackQuery):
                 )
 
         # Send payment link to user
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💳 Перейти к оплате", url=payment_url)],
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="buy_card")],
-        ])
-
         await callback.message.edit_text(
             TBANK_PAYMENT_LINK.format(credits=credits, rub=amount_rub),
             parse_mode="HTML",
-            reply_markup=kb,
+            reply_markup=tbank_pay_kb(payment_url),
         )
         await callback.answer()
 
     except Exception as e:
-        logger.error(f"T-Bank payment error: {e}", exc_info=True)
+        logger.error("T-Bank payment error: %s", e, exc_info=True)
         await callback.message.edit_text(
             TBANK_PAYMENT_ERROR, parse_mode="HTML", reply_markup=card_kb()
         )
@@ -0,0 +1,281 @@
+"""Shared HTTP client for fetching generated audio from the Suno CDN."""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import aiohttp
+import httpx
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_TIMEOUT = 60.0
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# A generated track is a few MB; anything bigger is not audio we asked for
+MAX_AUDIO_BYTES = 25 * 1024 * 1024
+
+# Recently downloaded tracks, so reopening history doesn't hit the CDN again
+AUDIO_CACHE_TTL = 600  # seconds
+AUDIO_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Some CDN edges are very slow to answer httpx; if the response headers take
+# longer than this the download is retried over aiohttp against the resolved
+# (post-redirect) URL. Only time to headers counts, so a slow but flowing body
+# is never thrown away and fetched again.
+SLOW_DOWNLOAD_AFTER = 5.0  # seconds
+
+# Large files are fetched as several byte ranges in parallel (overlapping
+# per-connection TTFB and TCP windows) when the CDN supports it
+RANGED_DOWNLOAD_MIN = 2_000_000  # bytes
+RANGED_DOWNLOAD_PARTS = 4
+
+# Completions arrive in bursts tens of seconds apart; keep idle CDN sockets
+# (and their TLS sessions) around longer than httpx's 5 s default
+CDN_KEEPALIVE_EXPIRY = 60.0  # seconds
+
+# Cap on simultaneous CDN downloads across all handlers, so a burst of
+# history/download taps can't exhaust sockets or memory
+DOWNLOAD_CONCURRENCY = 16
+_download_sem = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+
+
+class DownloadTooLarge(Exception):
+    """The CDN response exceeds MAX_AUDIO_BYTES."""
+
+
+class BoundedTTLCache:
+    """LRU of byte blobs with a per-entry TTL and a cap on total size."""
+
+    def __init__(self, ttl: float, max_bytes: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0  # bytes currently held
+        self._data: OrderedDict[str, tuple[float, bytearray]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> bytearray | None:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, blob = entry
+        if expires <= time.monotonic():
+            self._pop(key)
+            return None
+        self._data.move_to_end(key)
+        return blob
+
+    def put(self, key: str, blob: bytearray):
+        if len(blob) > self.max_bytes:
+            return
+        self._pop(key)
+        self._data[key] = (time.monotonic() + self.ttl, blob)
+        self.size += len(blob)
+        while self.size > self.max_bytes:
+            _, (_, old) = self._data.popitem(last=False)
+            self.size -= len(old)
+
+    def _pop(self, key: str):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+audio_cache = BoundedTTLCache(AUDIO_CACHE_TTL, AUDIO_CACHE_MAX_BYTES)
+
+# Global client instances — keep CDN connections alive between downloads
+_client: httpx.AsyncClient | None = None
+_fallback_session: aiohttp.ClientSession | None = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=DOWNLOAD_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=100, max_keepalive_connections=40,
+                keepalive_expiry=CDN_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return _client
+
+
+def _get_fallback_session() -> aiohttp.ClientSession:
+    global _fallback_session
+    if _fallback_session is None or _fallback_session.closed:
+        _fallback_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100),
+        )
+    return _fallback_session
+
+
+async def close_http_client():
+    global _client, _fallback_session
+    if _client and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+    if _fallback_session and not _fallback_session.closed:
+        await _fallback_session.close()
+    _fallback_session = None
+
+
+async def _read_body(size: int, chunks) -> bytearray:
+    """Copy an async chunk iterator into one buffer pre-sized to ``size``.
+
+    Raises DownloadTooLarge before reading if the declared size is over
+    MAX_AUDIO_BYTES, or as soon as the received bytes pass it.
+    """
+    if size > MAX_AUDIO_BYTES:
+        raise DownloadTooLarge(f"Content-Length {size} exceeds {MAX_AUDIO_BYTES}")
+    buf = bytearray(size)
+    pos = 0
+    async for chunk in chunks:
+        end = pos + len(chunk)
+        if end > MAX_AUDIO_BYTES:
+            raise DownloadTooLarge(f"Body exceeds {MAX_AUDIO_BYTES} bytes")
+        buf[pos:end] = chunk
+        pos = end
+    # Content-Length may be missing or wrong (e.g. compressed transfer)
+    del buf[pos:]
+    return buf
+
+
+async def _open_httpx(url: str, timeout: float) -> httpx.Response:
+    """Send a GET and return once the response headers are in."""
+    client = get_http_client()
+    request = client.build_request("GET", url, timeout=timeout)
+    return await client.send(request, stream=True)
+
+
+async def _read_httpx(
+    resp: httpx.Response, timeout: float, ranged: bool = True,
+) -> bytearray:
+    """Read the body of a response from _open_httpx, then close it."""
+    client = get_http_client()
+    try:
+        resp.raise_for_status()
+        size = int(resp.headers.get("content-length") or 0)
+        if (
+            ranged
+            and size > RANGED_DOWNLOAD_MIN
+            and resp.headers.get("accept-ranges") == "bytes"
+            and not resp.headers.get("content-encoding")
+        ):
+            return await _fetch_ranged(client, resp, size, timeout)
+        return await _read_body(size, resp.aiter_bytes(DOWNLOAD_CHUNK_SIZE))
+    finally:
+        await resp.aclose()
+
+
+async def _fetch_ranged(
+    client: httpx.AsyncClient, resp: httpx.Response, size: int, timeout: float,
+) -> bytearray:
+    """Read the head of an open response while the rest arrives as Range requests.
+
+    If any range request fails, the open response is simply read to the end.
+    If the open response itself ends before the first range, the file is
+    fetched again with a plain GET rather than returned with a gap.
+    """
+    if size > MAX_AUDIO_BYTES:
+        raise DownloadTooLarge(f"Content-Length {size} exceeds {MAX_AUDIO_BYTES}")
+    buf = bytearray(size)
+    step = -(-size // RANGED_DOWNLOAD_PARTS)
+    url = str(resp.url)
+
+    async def fetch_range(lo: int):
+        hi = min(lo + step, size)
+        headers = {"Range": f"bytes={lo}-{hi - 1}"}
+        async with client.stream("GET", url, headers=headers, timeout=timeout) as r:
+            if r.status_code != 206:
+                raise httpx.HTTPError(f"Range request returned {r.status_code}")
+            pos = lo
+            async for chunk in r.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                end = pos + len(chunk)
+                if end > hi:
+                    raise httpx.HTTPError("Range response longer than requested")
+                buf[pos:end] = chunk
+                pos = end
+            if pos != hi:
+                raise httpx.HTTPError("Range response shorter than requested")
+
+    tasks = [asyncio.create_task(fetch_range(lo)) for lo in range(step, size, step)]
+    chunks = resp.aiter_bytes(DOWNLOAD_CHUNK_SIZE)
+    pos = 0
+    try:
+        async for chunk in chunks:
+            end = pos + len(chunk)
+            buf[pos:min(end, size)] = chunk[:size - pos]
+            pos = end
+            if pos >= step:
+                break
+        if pos >= step:
+            try:
+                await asyncio.gather(*tasks)
+                return buf
+            except httpx.HTTPError as e:
+                logger.info("Ranged download failed, reading the full response instead: %s", e)
+    finally:
+        # Stop every range before buf is touched again or handed back, so
+        # a straggler can't write into it or keep a pooled connection
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if pos < step:
+        logger.info("Ranged download: response ended at %s of %s bytes, refetching", pos, size)
+        resp = await _open_httpx(url, timeout)
+        return await _read_httpx(resp, timeout, ranged=False)
+
+    async for chunk in chunks:
+        end = pos + len(chunk)
+        if end > size:
+            raise DownloadTooLarge(f"Body exceeds Content-Length {size}")
+        buf[pos:end] = chunk
+        pos = end
+    del buf[pos:]
+    return buf
+
+
+async def _fetch_aiohttp(url: str, timeout: float) -> bytearray:
+    # Resolve redirects first so the download goes straight to the signed URL
+    head = await get_http_client().head(url, follow_redirects=True, timeout=timeout)
+    resolved = str(head.url)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with _get_fallback_session().get(resolved, timeout=client_timeout) as resp:
+        resp.raise_for_status()
+        size = resp.content_length or 0
+        return await _read_body(size, resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE))
+
+
+async def fetch_audio(url: str, timeout: float = DOWNLOAD_TIMEOUT) -> bytearray:
+    """Download a file in chunks into one buffer sized from Content-Length.
+
+    Avoids httpx collecting the body into a list of chunks and then joining
+    them into a second full-size copy. A CDN that takes more than
+    SLOW_DOWNLOAD_AFTER seconds to answer is retried over aiohttp. At most
+    DOWNLOAD_CONCURRENCY downloads run at once. Results are kept
+    in ``audio_cache`` for a few minutes; callers must not modify the
+    returned buffer.
+    """
+    cached = audio_cache.get(url)
+    if cached is not None:
+        return cached
+
+    async with _download_sem:
+        try:
+            async with asyncio.timeout(min(SLOW_DOWNLOAD_AFTER, timeout)):
+                resp = await _open_httpx(url, timeout)
+        except TimeoutError:
+            if timeout <= SLOW_DOWNLOAD_AFTER:
+                raise
+            logger.info("Slow CDN response, retrying via aiohttp: %s", url)
+            buf = await _fetch_aiohttp(url, timeout - SLOW_DOWNLOAD_AFTER)
+        else:
+            buf = await _read_httpx(resp, timeout)
+
+    audio_cache.put(url, buf)
+    logger.debug("Audio cache: %s files, %s bytes", len(audio_cache), audio_cache.size)
+    return buf
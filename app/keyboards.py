@@ -1,5 +1,10 @@
-"""Keyboard builders for the bot — Reply keyboard + Inline keyboards."""
+"""Keyboard builders for the bot — Reply keyboard + Inline keyboards.
 
+Builders that take no arguments are static, so each is built once and the
+same markup object is reused on every send.
+"""
+
+import functools
 from urllib.parse import quote
 
 from aiogram.types import (
@@ -22,6 +27,13 @@ def _share_url(user_id: int) -> str:
     return f"https://t.me/share/url?url={quote(bot_link)}&text={quote(text)}"
 
 
+class IdDict(dict):
+    """Label map that returns the key itself for unknown codes."""
+
+    def __missing__(self, key):
+        return key
+
+
 # ─── Button text constants (used for matching in handlers) ───
 
 BTN_CREATE = "🎵 Создать песню"
@@ -32,6 +44,7 @@ BTN_HELP = "❓ Помощь"
 
 # ─── Persistent Reply Keyboard (always visible) ───
 
+@functools.cache
 def main_reply_kb() -> ReplyKeyboardMarkup:
     """Persistent bottom menu — 2x2 layout."""
     return ReplyKeyboardMarkup(
@@ -46,6 +59,7 @@ def main_reply_kb() -> ReplyKeyboardMarkup:
 
 # ─── Mode selection (Есть идея / Есть стихи) ───
 
+@functools.cache
 def mode_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -65,6 +79,7 @@ def mode_kb() -> InlineKeyboardMarkup:
 
 # ─── Gender selection ───
 
+@functools.cache
 def gender_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(
@@ -91,7 +106,11 @@ STYLES = [
     ("🎉 Праздничная", "holiday celebration"),
 ]
 
+# Callback code → button label
+STYLE_LABELS = IdDict((code, label) for label, code in STYLES)
 
+
+@functools.cache
 def style_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for i in range(0, len(STYLES), 3):
@@ -116,6 +135,8 @@ GREETING_RECIPIENTS = [
     ("🎖 Мужчине (23 февраля)", "мужчине (защитнику)"),
 ]
 
+GREETING_RECIPIENT_LABELS = IdDict((code, label) for label, code in GREETING_RECIPIENTS)
+
 GREETING_OCCASIONS = [
     ("🎂 День рождения", "bday"),
     ("🎖 23 февраля", "feb23"),
@@ -126,7 +147,7 @@ GREETING_OCCASIONS = [
     ("🎄 Новый год", "newyear"),
 ]
 
-GREETING_OCCASION_LABELS = {
+GREETING_OCCASION_LABELS = IdDict({
     "bday": "День рождения",
     "feb23": "23 февраля — День защитника Отечества",
     "mar8": "8 марта — Международный женский день",
@@ -134,7 +155,7 @@ GREETING_OCCASION_LABELS = {
     "jubilee": "Юбилей",
     "grad": "Выпускной",
     "newyear": "Новый год",
-}
+})
 
 GREETING_MOODS = [
     ("🎩 Серьёзное / трогательное", "serious"),
@@ -142,13 +163,14 @@ GREETING_MOODS = [
     ("🎭 Микс", "mix"),
 ]
 
-GREETING_MOOD_LABELS = {
+GREETING_MOOD_LABELS = IdDict({
     "serious": "трогательное и душевное",
     "funny": "шутливое и весёлое",
     "mix": "и смешное, и трогательное",
-}
+})
 
 
+@functools.cache
 def greeting_recipient_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for label, data in GREETING_RECIPIENTS:
@@ -158,6 +180,7 @@ def greeting_recipient_kb() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@functools.cache
 def greeting_occasion_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for i in range(0, len(GREETING_OCCASIONS), 2):
@@ -170,6 +193,7 @@ def greeting_occasion_kb() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@functools.cache
 def greeting_mood_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for label, data in GREETING_MOODS:
@@ -192,7 +216,7 @@ STORIES_VIBES = [
     ("✨ Мечтатель", "dreamer"),
 ]
 
-STORIES_VIBE_LABELS = {
+STORIES_VIBE_LABELS = IdDict({
     "boss": "босс, я главный",
     "chill": "на чиле, расслабленно",
     "fire": "в огне, энергия",
@@ -202,7 +226,7 @@ STORIES_VIBE_LABELS = {
     "cozy": "уютно, тепло",
     "swagger": "дерзкий вайб, крутой",
     "dreamer": "мечтатель, в облаках",
-}
+})
 
 STORIES_MOODS = [
     ("😎 Дерзко", "bold"),
@@ -216,7 +240,7 @@ STORIES_MOODS = [
     ("🌞 Позитивно", "sunny"),
 ]
 
-STORIES_MOOD_LABELS = {
+STORIES_MOOD_LABELS = IdDict({
     "bold": "дерзко и уверенно",
     "cute": "мило и романтично",
     "funny": "прикольно, с юмором",
@@ -226,9 +250,10 @@ STORIES_MOOD_LABELS = {
     "evening": "вечернее, атмосферное",
     "provocative": "провокационно и дерзко",
     "sunny": "солнечно и позитивно",
-}
+})
 
 
+@functools.cache
 def stories_vibe_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for i in range(0, len(STORIES_VIBES), 3):
@@ -241,6 +266,7 @@ def stories_vibe_kb() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@functools.cache
 def stories_mood_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for i in range(0, len(STORIES_MOODS), 3):
@@ -252,6 +278,7 @@ def stories_mood_kb() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@functools.cache
 def stories_name_kb() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="⏩ Пропустить имя", callback_data="st_name:skip"))
@@ -261,6 +288,7 @@ def stories_name_kb() -> InlineKeyboardMarkup:
 
 # ─── Lyrics preview keyboard ───
 
+@functools.cache
 def lyrics_review_kb() -> InlineKeyboardMarkup:
     """Keyboard for lyrics preview: approve or edit."""
     builder = InlineKeyboardBuilder()
@@ -271,6 +299,7 @@ def lyrics_review_kb() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@functools.cache
 def lyrics_confirm_kb() -> InlineKeyboardMarkup:
     """Keyboard for confirming edited lyrics despite warnings."""
     builder = InlineKeyboardBuilder()
@@ -283,6 +312,7 @@ def lyrics_confirm_kb() -> InlineKeyboardMarkup:
 
 # ─── Balance / Buy page ───
 
+@functools.cache
 def balance_kb() -> InlineKeyboardMarkup:
     """Balance page — choose payment method."""
     builder = InlineKeyboardBuilder()
@@ -299,6 +329,7 @@ def balance_kb() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@functools.cache
 def card_kb() -> InlineKeyboardMarkup:
     """T-Bank card payment options (ruble prices)."""
     builder = InlineKeyboardBuilder()
@@ -313,6 +344,18 @@ def card_kb() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+_BACK_TO_CARD_BTN = InlineKeyboardButton(text="⬅️ Назад", callback_data="buy_card")
+
+
+def tbank_pay_kb(payment_url: str) -> InlineKeyboardMarkup:
+    """Link to a T-Bank payment page; the URL is per order, the back button is shared."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="💳 Перейти к оплате", url=payment_url)],
+        [_BACK_TO_CARD_BTN],
+    ])
+
+
+@functools.cache
 def stars_kb() -> InlineKeyboardMarkup:
     """Telegram Stars payment options."""
     builder = InlineKeyboardBuilder()
@@ -329,6 +372,18 @@ def stars_kb() -> InlineKeyboardMarkup:
 
 # ─── Result keyboard ───
 
+# Per-track and after-generation keyboards depend on gen_id, so only their
+# fixed buttons are shared; the share button is cached per user
+_RATE_LABEL_BTN = InlineKeyboardButton(text="⭐ Оцените результат:", callback_data="noop")
+_CREATE_NEW_BTN = InlineKeyboardButton(text="🎵 Создать новую песню", callback_data="create")
+_STAR_LABELS = ("1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣")
+
+
+@functools.lru_cache(maxsize=4096)
+def _share_button(user_id: int) -> InlineKeyboardButton:
+    return InlineKeyboardButton(text="📤 Поделиться (+1🎵 за друга)", url=_share_url(user_id))
+
+
 def preview_track_kb(gen_id: int, idx: int, user_id: int = 0) -> InlineKeyboardMarkup:
     """Per-track keyboard for preview (free generation): buy + share."""
     builder = InlineKeyboardBuilder()
@@ -339,12 +394,7 @@ def preview_track_kb(gen_id: int, idx: int, user_id: int = 0) -> InlineKeyboardM
         ),
     )
     if user_id:
-        builder.row(
-            InlineKeyboardButton(
-                text="📤 Поделиться (+1🎵 за друга)",
-                url=_share_url(user_id),
-            ),
-        )
+        builder.row(_share_button(user_id))
     return builder.as_markup()
 
 
@@ -358,82 +408,64 @@ def track_kb(gen_id: int, idx: int, user_id: int = 0) -> InlineKeyboardMarkup:
         ),
     )
     if user_id:
-        builder.row(
-            InlineKeyboardButton(
-                text="📤 Поделиться (+1🎵 за друга)",
-                url=_share_url(user_id),
-            ),
-        )
+        builder.row(_share_button(user_id))
     return builder.as_markup()
 
 
-def history_track_kb(gen_id: int, idx: int, user_id: int = 0) -> InlineKeyboardMarkup:
-    """Per-track keyboard for history: download + share."""
+def history_downloads_kb(
+    tracks: list[tuple[int, int, int]], user_id: int = 0,
+) -> InlineKeyboardMarkup:
+    """Download buttons for a whole history page + share.
+
+    ``tracks`` holds (number in history, gen_id, idx); one row per generation.
+    """
     builder = InlineKeyboardBuilder()
-    builder.row(
-        InlineKeyboardButton(
-            text="⬇️ Скачать файл",
+    row: list[InlineKeyboardButton] = []
+    for n, (num, gen_id, idx) in enumerate(tracks):
+        row.append(InlineKeyboardButton(
+            text=f"⬇️ {num} · вар. {idx+1}",
             callback_data=f"download:{gen_id}:{idx}",
-        ),
-    )
+        ))
+        if n + 1 == len(tracks) or tracks[n + 1][1] != gen_id:
+            builder.row(*row)
+            row = []
     if user_id:
-        builder.row(
-            InlineKeyboardButton(
-                text="📤 Поделиться (+1🎵 за друга)",
-                url=_share_url(user_id),
-            ),
-        )
+        builder.row(_share_button(user_id))
     return builder.as_markup()
 
 
+# Button layouts of the after-generation keyboards. Only callback_data with
+# a {gen_id} placeholder is formatted per call; fixed buttons are prebuilt.
+_Layout = tuple[tuple[InlineKeyboardButton | tuple[str, str], ...], ...]
+
+_RATE_ROWS: _Layout = (
+    (_RATE_LABEL_BTN,),
+    tuple((label, f"rate:{{gen_id}}:{i}") for i, label in enumerate(_STAR_LABELS, 1)),
+    (("✍️ Оставить комментарий / предложение", "feedback:{gen_id}"),),
+)
+_PREVIEW_AFTER_GENERATION: _Layout = _RATE_ROWS + ((_CREATE_NEW_BTN,),)
+_AFTER_GENERATION: _Layout = _RATE_ROWS + (
+    (("🔄 Ещё варианты (−1🎵)", "regenerate:{gen_id}"),),
+    (_CREATE_NEW_BTN,),
+)
+
+
+def _render_layout(layout: _Layout, gen_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            b if isinstance(b, InlineKeyboardButton)
+            else InlineKeyboardButton(text=b[0], callback_data=b[1].format(gen_id=gen_id))
+            for b in row
+        ]
+        for row in layout
+    ])
+
+
 def preview_after_generation_kb(gen_id: int) -> InlineKeyboardMarkup:
     """Keyboard shown after preview tracks: rate + feedback + create another."""
-    builder = InlineKeyboardBuilder()
-    # Rating label
-    builder.row(
-        InlineKeyboardButton(text="⭐ Оцените результат:", callback_data="noop"),
-    )
-    star_labels = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣"]
-    rating_row = [
-        InlineKeyboardButton(text=label, callback_data=f"rate:{gen_id}:{i}")
-        for i, label in enumerate(star_labels, 1)
-    ]
-    builder.row(*rating_row)
-    builder.row(
-        InlineKeyboardButton(
-            text="✍️ Оставить комментарий / предложение",
-            callback_data=f"feedback:{gen_id}",
-        ),
-    )
-    builder.row(
-        InlineKeyboardButton(text="🎵 Создать новую песню", callback_data="create"),
-    )
-    return builder.as_markup()
+    return _render_layout(_PREVIEW_AFTER_GENERATION, gen_id)
 
 
 def after_generation_kb(gen_id: int) -> InlineKeyboardMarkup:
     """Keyboard shown after all tracks: rate + feedback + regenerate + create another."""
-    builder = InlineKeyboardBuilder()
-    # Rating label
-    builder.row(
-        InlineKeyboardButton(text="⭐ Оцените результат:", callback_data="noop"),
-    )
-    star_labels = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣"]
-    rating_row = [
-        InlineKeyboardButton(text=label, callback_data=f"rate:{gen_id}:{i}")
-        for i, label in enumerate(star_labels, 1)
-    ]
-    builder.row(*rating_row)
-    builder.row(
-        InlineKeyboardButton(
-            text="✍️ Оставить комментарий / предложение",
-            callback_data=f"feedback:{gen_id}",
-        ),
-    )
-    builder.row(
-        InlineKeyboardButton(text="🔄 Ещё варианты (−1🎵)", callback_data=f"regenerate:{gen_id}"),
-    )
-    builder.row(
-        InlineKeyboardButton(text="🎵 Создать новую песню", callback_data="create"),
-    )
-    return builder.as_markup()
+    return _render_layout(_AFTER_GENERATION, gen_id)
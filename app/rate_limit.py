@@ -0,0 +1,98 @@
+"""Outgoing Telegram send throttling.
+
+Telegram allows roughly 30 messages per second per bot and about 20 per
+minute in a group; going over earns RetryAfter errors that stall the
+sender for seconds. SendRateLimiter is a bot session middleware that
+paces every send* call through a global token bucket plus one per chat,
+so bursts (history, both tracks + covers) queue briefly instead of
+getting throttled. A media group counts as one message per item.
+"""
+
+import asyncio
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import (
+    CopyMessage,
+    ForwardMessage,
+    SendAudio,
+    SendDocument,
+    SendMediaGroup,
+    SendMessage,
+    SendPhoto,
+    SendVideo,
+    SendVoice,
+)
+
+GLOBAL_SENDS_PER_SEC = 25
+# Private chats tolerate short bursts (history sends up to 20 tracks)
+PRIVATE_CHAT_RATE = 1.0  # sends per second
+PRIVATE_CHAT_BURST = 20
+GROUP_CHAT_RATE = 20 / 60
+GROUP_CHAT_BURST = 3
+MAX_TRACKED_CHATS = 10_000
+
+_SEND_METHODS = (
+    SendMessage, SendAudio, SendVoice, SendPhoto, SendDocument, SendVideo,
+    SendMediaGroup, CopyMessage, ForwardMessage,
+)
+
+
+class TokenBucket:
+    """Async token bucket; waiters are served in FIFO order."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self, n: int = 1):
+        """Take ``n`` tokens; more than ``capacity`` leaves the bucket in debt."""
+        async with self._lock:
+            self._refill()
+            if self.tokens < n:
+                await asyncio.sleep((n - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= n
+
+
+class SendRateLimiter(BaseRequestMiddleware):
+    """Pace send* Bot API calls globally and per chat."""
+
+    def __init__(self):
+        self._global = TokenBucket(GLOBAL_SENDS_PER_SEC, GLOBAL_SENDS_PER_SEC)
+        self._chats: dict[int | str, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_TRACKED_CHATS:
+                # A full bucket behaves exactly like a new one
+                self._chats = {k: b for k, b in self._chats.items() if not b.is_full()}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = (
+                TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST) if is_group
+                else TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+            )
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, _SEND_METHODS):
+            # Telegram counts every item of an album as a message
+            n = len(method.media) if isinstance(method, SendMediaGroup) else 1
+            # Per chat first so one busy chat doesn't hold global tokens
+            await self._chat_bucket(method.chat_id).acquire(n)
+            await self._global.acquire(n)
+        return await make_request(bot, method)
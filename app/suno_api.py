@@ -1,12 +1,14 @@
 """Suno API client via SunoAPI.org v1 API."""
 
 import asyncio
+import functools
 import logging
-from typing import Optional
+from typing import NamedTuple, Optional
 
 import httpx
 
 from app.config import config
+from app.rate_limit import TokenBucket
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +23,44 @@ class ContentPolicyError(SunoApiError):
     pass
 
 
+class Track(NamedTuple):
+    """One finished Suno song, with the API's key variants resolved."""
+    url: str
+    img: str
+    title: str
+    id: str
+
+
+def parse_tracks(songs: list[dict]) -> list[Track]:
+    """Normalize sunoData items from record-info (camelCase) or a callback (snake_case)."""
+    # A plain `or` chain stops at the first non-empty key and stays inside
+    # the comprehension; next() over a key tuple would add a generator per song
+    return [
+        Track(
+            s.get("audioUrl") or s.get("streamAudioUrl")
+            or s.get("audio_url") or s.get("stream_audio_url", ""),
+            s.get("imageUrl") or s.get("image_url", ""),
+            s.get("title", "AI Melody Track"),
+            s.get("id", ""),
+        )
+        for s in songs
+    ]
+
+
+@functools.lru_cache(maxsize=256)
+def _style_tag(style: str, voice_gender: Optional[str]) -> str:
+    """Suno style string with the vocal gender prepended, e.g. "female vocal, pop"."""
+    if not voice_gender:
+        return style
+    return f"{voice_gender} vocal, {style}" if style else f"{voice_gender} vocal"
+
+
+@functools.lru_cache(maxsize=16)
+def _gender_code(voice_gender: str) -> str:
+    """Map a voice gender to the API's vocalGender param (m/f)."""
+    return "f" if "female" in voice_gender.lower() else "m"
+
+
 class SunoClient:
     """Client for interacting with Suno API through SunoAPI.org v1 API."""
 
@@ -35,10 +75,25 @@ class SunoClient:
             },
             timeout=120.0,
         )
+        # Bound in-flight API calls and pace new submits so bursts of users
+        # queue here instead of getting 429s from SunoAPI.org
+        self._sem = asyncio.Semaphore(config.max_concurrent_suno)
+        self._submit_rate = TokenBucket(
+            config.suno_requests_per_sec, config.max_concurrent_suno,
+        )
 
     async def close(self):
         await self.client.aclose()
 
+    async def _post(self, url: str, payload: dict) -> httpx.Response:
+        await self._submit_rate.acquire()
+        async with self._sem:
+            return await self.client.post(url, json=payload)
+
+    async def _get(self, url: str) -> httpx.Response:
+        async with self._sem:
+            return await self.client.get(url)
+
     async def generate_lyrics(self, prompt: str) -> dict:
         """
         Generate lyrics from a description via Lyrics API.
@@ -54,10 +109,10 @@ class SunoClient:
         else:
             payload["callBackUrl"] = "https://example.com/callback/lyrics"
 
-        logger.info(f"Lyrics generation request: /api/v1/lyrics | {payload}")
+        logger.info("Lyrics generation request: /api/v1/lyrics | %s", payload)
 
         try:
-            response = await self.client.post("/api/v1/lyrics", json=payload)
+            response = await self._post("/api/v1/lyrics", payload)
             response.raise_for_status()
             result = response.json()
 
@@ -93,7 +148,7 @@ class SunoClient:
 
         while (asyncio.get_event_loop().time() - start_time) < timeout:
             try:
-                response = await self.client.get(
+                response = await self._get(
                     f"/api/v1/lyrics/record-info?taskId={task_id}"
                 )
                 response.raise_for_status()
@@ -105,7 +160,7 @@ class SunoClient:
                 data = result.get("data", {})
                 status = data.get("status", "")
 
-                logger.info(f"Lyrics task {task_id} status: {status}")
+                logger.info("Lyrics task %s status: %s", task_id, status)
 
                 if status == "SUCCESS":
                     response_data = data.get("response", {})
@@ -114,7 +169,7 @@ class SunoClient:
                         first = lyrics_list[0]
                         lyrics_text = first.get("text", "")
                         lyrics_title = first.get("title", "Untitled")
-                        logger.info(f"Lyrics generated: title='{lyrics_title}', length={len(lyrics_text)}")
+                        logger.info("Lyrics generated: title='%s', length=%s", lyrics_title, len(lyrics_text))
                         return {"text": lyrics_text, "title": lyrics_title}
                     raise SunoApiError(f"No lyrics data in response: {data}")
 
@@ -154,9 +209,7 @@ class SunoClient:
             dict with task_id for polling
         """
         # Build the style tag incorporating gender
-        full_style = style
-        if not instrumental and voice_gender:
-            full_style = f"{voice_gender} vocal, {style}" if style else f"{voice_gender} vocal"
+        full_style = _style_tag(style, None if instrumental else voice_gender)
 
         if mode == "custom" and lyrics:
             # Custom mode: customMode=true, prompt=lyrics, style & title required
@@ -170,8 +223,7 @@ class SunoClient:
             }
             # Pass vocalGender as a separate API param (m/f)
             if voice_gender:
-                gender_code = "f" if "female" in voice_gender.lower() else "m"
-                payload["vocalGender"] = gender_code
+                payload["vocalGender"] = _gender_code(voice_gender)
         elif mode == "instrumental":
             # Instrumental: customMode=false, instrumental=true
             payload = {
@@ -183,7 +235,7 @@ class SunoClient:
         else:
             # Description mode: non-custom, single prompt (up to 500 chars)
             # Suno auto-generates lyrics and music from the description
-            logger.info(f"Description mode: non-custom, single prompt")
+            logger.info("Description mode: non-custom, single prompt")
             payload = {
                 "prompt": prompt[:500],
                 "customMode": False,
@@ -195,10 +247,10 @@ class SunoClient:
         if config.callback_base_url:
             payload["callBackUrl"] = f"{config.callback_base_url.rstrip('/')}/callback/suno"
 
-        logger.info(f"Suno v1 generate request: /api/v1/generate | {payload}")
+        logger.info("Suno v1 generate request: /api/v1/generate | %s", payload)
 
         try:
-            response = await self.client.post("/api/v1/generate", json=payload)
+            response = await self._post("/api/v1/generate", payload)
             response.raise_for_status()
             result = response.json()
 
@@ -254,7 +306,7 @@ class SunoClient:
     async def get_task_status(self, task_id: str) -> dict:
         """Check task status via polling endpoint."""
         try:
-            response = await self.client.get(
+            response = await self._get(
                 f"/api/v1/generate/record-info?taskId={task_id}"
             )
             response.raise_for_status()
@@ -267,51 +319,57 @@ class SunoClient:
         except httpx.HTTPStatusError as e:
             raise SunoApiError(f"Status check error {e.response.status_code}: {e.response.text}")
 
+    @staticmethod
+    def completed_songs(status_data: dict) -> list[Track] | None:
+        """Interpret a record-info status.
+
+        Returns the finished songs as Tracks, None while still
+        processing; raises ContentPolicyError / SunoApiError on failure.
+        """
+        status = status_data.get("status", "")
+        logger.info("Task %s status: %s", status_data.get('taskId', '?'), status)
+
+        if status in ("SUCCESS", "FIRST_SUCCESS"):
+            # Extract sunoData from response
+            response = status_data.get("response", {})
+            suno_data = response.get("sunoData", [])
+            if suno_data:
+                return parse_tracks(suno_data)
+            raise SunoApiError(f"No sunoData in successful response: {status_data}")
+
+        elif status == "SENSITIVE_WORD_ERROR":
+            error_msg = status_data.get("errorMessage", "Content filtered due to sensitive words")
+            raise ContentPolicyError(error_msg)
+
+        elif status in ("CREATE_TASK_FAILED", "GENERATE_AUDIO_FAILED", "CALLBACK_EXCEPTION"):
+            error_msg = status_data.get("errorMessage", f"Generation failed: {status}")
+            raise SunoApiError(error_msg)
+
+        elif status != "PENDING":
+            logger.warning("Unknown task status: %s", status)
+            if status_data.get("errorMessage"):
+                logger.warning("Error message: %s", status_data['errorMessage'])
+        return None
+
     async def wait_for_completion(
         self, task_id: str, timeout: int = 300, poll_interval: int = 10
-    ) -> list[dict]:
+    ) -> list[Track]:
         """
         Poll until task is complete or timeout.
 
-        Returns list of song dicts from sunoData with audioUrl populated.
+        Returns the finished songs as Tracks.
         """
         start_time = asyncio.get_event_loop().time()
         await asyncio.sleep(5)  # Initial wait
 
         while (asyncio.get_event_loop().time() - start_time) < timeout:
-            status_data = await self.get_task_status(task_id)
-            status = status_data.get("status", "")
-
-            logger.info(f"Task {task_id} status: {status}")
-
-            if status in ("SUCCESS", "FIRST_SUCCESS"):
-                # Extract sunoData from response
-                response = status_data.get("response", {})
-                suno_data = response.get("sunoData", [])
-                if suno_data:
-                    return suno_data
-                raise SunoApiError(f"No sunoData in successful response: {status_data}")
-
-            elif status == "SENSITIVE_WORD_ERROR":
-                error_msg = status_data.get("errorMessage", "Content filtered due to sensitive words")
-                raise ContentPolicyError(error_msg)
-
-            elif status in ("CREATE_TASK_FAILED", "GENERATE_AUDIO_FAILED", "CALLBACK_EXCEPTION"):
-                error_msg = status_data.get("errorMessage", f"Generation failed: {status}")
-                raise SunoApiError(error_msg)
-
-            elif status == "PENDING":
-                pass  # Still processing
-
-            else:
-                logger.warning(f"Unknown task status: {status}")
-                if status_data.get("errorMessage"):
-                    logger.warning(f"Error message: {status_data['errorMessage']}")
-
+            songs = self.completed_songs(await self.get_task_status(task_id))
+            if songs is not None:
+                return songs
             await asyncio.sleep(poll_interval)
 
         # Timeout
-        logger.warning(f"Generation timeout for task: {task_id}")
+        logger.warning("Generation timeout for task: %s", task_id)
         raise SunoApiError(f"Generation timeout after {timeout}s for task {task_id}")
 
     # ─── Video (MP4) generation ───
@@ -335,10 +393,10 @@ class SunoClient:
         if config.callback_base_url:
             payload["callBackUrl"] = f"{config.callback_base_url.rstrip('/')}/callback/video"
 
-        logger.info(f"Video generation request: /api/v1/mp4/generate | {payload}")
+        logger.info("Video generation request: /api/v1/mp4/generate | %s", payload)
 
         try:
-            response = await self.client.post("/api/v1/mp4/generate", json=payload)
+            response = await self._post("/api/v1/mp4/generate", payload)
             response.raise_for_status()
             result = response.json()
 
@@ -148,6 +148,16 @@ GENERATING_MUSIC = (
     "⏳ Подождите ещё 1-2 минуты."
 )
 
+GENERATING_FROM_LYRICS = (
+    "🎵 Отлично! Создаю музыку по твоим стихам...\n"
+    "Мне нужно несколько минут."
+)
+
+GENERATING_FROM_TEXT = (
+    "🎵 Отлично! Создаю музыку по тексту...\n"
+    "Мне нужно 1-2 минуты."
+)
+
 # ─── Lyrics preview texts ───
 
 GENERATING_LYRICS = (
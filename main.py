@@ -4,11 +4,13 @@ import asyncio
 import logging
 from datetime import datetime, timezone
 
-from aiohttp import web
+from aiohttp import TCPConnector, web
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
 
+from app import cache
 from app import database as db
 from app.texts import GENERATION_TIMEOUT, TBANK_PAYMENT_SUCCESS
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -17,6 +19,9 @@ from aiogram.types import BotCommand
 from app.config import config
 from app.database import init_db, close_db
 from app.suno_api import close_suno_client
+from app.http_client import close_http_client
+from app.gpt_compress import close_gpt_client
+from app.rate_limit import SendRateLimiter
 from app.handlers import common, generation, payments, broadcast
 from app.admin import create_admin_app
 from app.handlers.callback import handle_suno_callback, handle_video_callback
@@ -25,6 +30,11 @@ from app.keyboards import main_reply_kb
 GENERATION_TIMEOUT_MINUTES = 10
 WATCHDOG_CHECK_INTERVAL = 120  # seconds
 
+# Bot API connection pool (shared keep-alive sockets to api.telegram.org)
+BOT_HTTP_POOL_LIMIT = 200
+BOT_HTTP_POOL_PER_HOST = 100
+BOT_HTTP_KEEPALIVE_SEC = 75
+
 # Logging
 logging.basicConfig(
     level=logging.INFO,
@@ -47,7 +57,16 @@ async def on_startup(bot: Bot):
 
     me = await bot.get_me()
     config.bot_username = me.username
-    logger.info(f"Bot @{me.username} started (id={me.id})")
+    logger.info("Bot @%s started (id=%s)", me.username, me.id)
+
+    # Without a callback URL, pending generations are polled from one loop
+    if not config.callback_base_url:
+        logger.warning(
+            "CALLBACK_BASE_URL not set — polling Suno for results; "
+            "set it to have Suno push completions instead"
+        )
+        generation.start_completion_poller()
+        await generation.resume_pending_completions(bot)
 
     # Set only /start in the Telegram commands menu (removes old BotFather commands)
     await bot.set_my_commands([
@@ -57,7 +76,10 @@ async def on_startup(bot: Bot):
 
 async def on_shutdown(bot: Bot):
     logger.info("Bot shutting down...")
+    await generation.stop_completion_poller()
     await close_suno_client()
+    await close_http_client()
+    await close_gpt_client()
     # Close T-Bank HTTP session
     try:
         from app.tbank_api import close_session as close_tbank
@@ -68,11 +90,46 @@ async def on_shutdown(bot: Bot):
     logger.info("Cleanup complete")
 
 
+class BotApiConnector(TCPConnector):
+    """TCPConnector that keeps more sockets to api.telegram.org alive."""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("limit_per_host", BOT_HTTP_POOL_PER_HOST)
+        kwargs.setdefault("keepalive_timeout", BOT_HTTP_KEEPALIVE_SEC)
+        super().__init__(**kwargs)
+
+
+class BotApiSession(AiohttpSession):
+    """AiohttpSession whose ClientSession is built on BotApiConnector."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # aiogram has no public hook for connector options; it builds the
+        # connector from this class (also what its proxy setup swaps out)
+        if hasattr(self, "_connector_type"):
+            self._connector_type = BotApiConnector
+        else:
+            logger.warning("AiohttpSession has no _connector_type, using aiogram's default connector")
+
+
+def create_bot_session() -> AiohttpSession:
+    """Build one aiohttp session sized for bursts of button taps.
+
+    All handlers reuse it via ``bot`` so TCP+TLS connections to the Bot API
+    stay alive between calls instead of being re-established.
+    """
+    session = BotApiSession(limit=BOT_HTTP_POOL_LIMIT)
+    # Pace sends under Telegram's flood limits instead of hitting RetryAfter
+    session.middleware(SendRateLimiter())
+    return session
+
+
 async def run_bot():
     """Start the Telegram bot polling."""
     global bot_instance
     bot_instance = Bot(
         token=config.bot_token,
+        session=create_bot_session(),
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
     dp = Dispatcher(storage=MemoryStorage())
@@ -115,11 +172,11 @@ async def run_admin():
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", config.admin_port)
     await site.start()
-    logger.info(f"Admin panel started at http://localhost:{config.admin_port}/admin/?token={config.admin_token}")
+    logger.info("Admin panel started at http://localhost:%s/admin/?token=%s", config.admin_port, config.admin_token)
     if config.callback_base_url:
-        logger.info(f"Suno callback URL: {config.callback_base_url.rstrip('/')}/callback/suno")
+        logger.info("Suno callback URL: %s/callback/suno", config.callback_base_url.rstrip('/'))
         if config.tbank_enabled:
-            logger.info(f"T-Bank callback URL: {config.callback_base_url.rstrip('/')}/callback/tbank")
+            logger.info("T-Bank callback URL: %s/callback/tbank", config.callback_base_url.rstrip('/'))
 
     # Start generation watchdog
     asyncio.create_task(generation_watchdog())
@@ -131,7 +188,7 @@ async def run_admin():
 
 async def generation_watchdog():
     """Periodically check for stuck generations and notify users."""
-    logger.info(f"Generation watchdog started (timeout={GENERATION_TIMEOUT_MINUTES}m, interval={WATCHDOG_CHECK_INTERVAL}s)")
+    logger.info("Generation watchdog started (timeout=%sm, interval=%ss)", GENERATION_TIMEOUT_MINUTES, WATCHDOG_CHECK_INTERVAL)
     # Wait for bot to be ready
     await asyncio.sleep(10)
 
@@ -139,7 +196,7 @@ async def generation_watchdog():
         try:
             stuck = await db.get_stuck_generations(timeout_minutes=GENERATION_TIMEOUT_MINUTES)
             if stuck:
-                logger.warning(f"Watchdog: found {len(stuck)} stuck generation(s)")
+                logger.warning("Watchdog: found %s stuck generation(s)", len(stuck))
 
             for gen in stuck:
                 gen_id = gen["id"]
@@ -150,7 +207,7 @@ async def generation_watchdog():
                 await db.update_generation_status(
                     gen_id, "error", error_message="timeout"
                 )
-                logger.info(f"Watchdog: generation {gen_id} marked as timeout error")
+                logger.info("Watchdog: generation %s marked as timeout error", gen_id)
 
                 # Notify user
                 if chat_id and bot_instance:
@@ -165,7 +222,7 @@ async def generation_watchdog():
                             )
                             delivered = True
                         except Exception as e:
-                            logger.warning(f"Watchdog: failed to edit msg for gen {gen_id}: {e}")
+                            logger.warning("Watchdog: failed to edit msg for gen %s: %s", gen_id, e)
 
                     if not delivered:
                         try:
@@ -178,12 +235,12 @@ async def generation_watchdog():
                             err = str(e).lower()
                             if any(kw in err for kw in ("blocked", "deactivated", "not found")):
                                 await db.mark_user_blocked(chat_id)
-                                logger.info(f"Watchdog: user {chat_id} blocked the bot")
+                                logger.info("Watchdog: user %s blocked the bot", chat_id)
                             else:
-                                logger.error(f"Watchdog: failed to send msg for gen {gen_id}: {e}")
+                                logger.error("Watchdog: failed to send msg for gen %s: %s", gen_id, e)
 
         except Exception as e:
-            logger.error(f"Watchdog error: {e}", exc_info=True)
+            logger.error("Watchdog error: %s", e, exc_info=True)
 
         await asyncio.sleep(WATCHDOG_CHECK_INTERVAL)
 
@@ -196,15 +253,14 @@ async def handle_tbank_notification(request: web.Request) -> web.Response:
     """
     try:
         data = await request.json()
-        logger.info(f"T-Bank notification: Status={data.get('Status')}, "
-                     f"OrderId={data.get('OrderId')}, "
-                     f"PaymentId={data.get('PaymentId')}, "
-                     f"Amount={data.get('Amount')}")
+        logger.info("T-Bank notification: Status=%s, OrderId=%s, PaymentId=%s, Amount=%s",
+                    data.get('Status'), data.get('OrderId'),
+                    data.get('PaymentId'), data.get('Amount'))
 
         # Verify notification token
         from app.tbank_api import verify_notification_token
         if not verify_notification_token(data):
-            logger.warning(f"T-Bank notification: invalid token for OrderId={data.get('OrderId')}")
+            logger.warning("T-Bank notification: invalid token for OrderId=%s", data.get('OrderId'))
             return web.Response(text="OK", status=200)
 
         status = data.get("Status", "")
@@ -215,13 +271,16 @@ async def handle_tbank_notification(request: web.Request) -> web.Response:
         if status == "CONFIRMED":
             payment = await db.complete_tbank_payment(order_id, payment_id)
 
+            if payment:
+                cache.invalidate_user(payment["user_id"])
+
             if payment and bot_instance:
                 user_id = payment["user_id"]
                 credits = payment["credits_purchased"]
                 amount_rub = payment["amount_rub"]
 
                 # Get updated balance
-                user = await db.get_user(user_id)
+                user = await cache.get_user(user_id)
                 if user:
                     balance = user["credits"] + user["free_generations_left"]
                     try:
@@ -237,12 +296,12 @@ async def handle_tbank_notification(request: web.Request) -> web.Response:
                         err = str(e).lower()
                         if any(kw in err for kw in ("blocked", "deactivated", "not found")):
                             await db.mark_user_blocked(user_id)
-                            logger.info(f"T-Bank: user {user_id} blocked the bot")
+                            logger.info("T-Bank: user %s blocked the bot", user_id)
                         else:
-                            logger.error(f"T-Bank: failed to notify user {user_id}: {e}")
+                            logger.error("T-Bank: failed to notify user %s: %s", user_id, e)
 
-                logger.info(f"T-Bank payment completed: user={user_id}, "
-                             f"credits={credits}, amount={amount_rub}₽, order={order_id}")
+                logger.info("T-Bank payment completed: user=%s, credits=%s, amount=%s₽, order=%s",
+                            user_id, credits, amount_rub, order_id)
 
                 # Notify admins about T-Bank payment
                 username = user.get("username") if user else None
@@ -261,15 +320,15 @@ async def handle_tbank_notification(request: web.Request) -> web.Response:
                     try:
                         await bot_instance.send_message(admin_id, admin_text, parse_mode="HTML")
                     except Exception as e:
-                        logger.warning(f"Failed to notify admin {admin_id} about T-Bank payment: {e}")
+                        logger.warning("Failed to notify admin %s about T-Bank payment: %s", admin_id, e)
 
             elif not payment:
-                logger.warning(f"T-Bank: no pending payment found for OrderId={order_id}")
+                logger.warning("T-Bank: no pending payment found for OrderId=%s", order_id)
 
         return web.Response(text="OK", status=200)
 
     except Exception as e:
-        logger.error(f"T-Bank notification error: {e}", exc_info=True)
+        logger.error("T-Bank notification error: %s", e, exc_info=True)
         return web.Response(text="OK", status=200)
 
 